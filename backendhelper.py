@@ -0,0 +1,469 @@
+"""
+Inference backends for YoloModel.
+
+A backend runs the detector on a list of images and returns, per image, the
+detections as array with rows [xmin, ymin, xmax, ymax, confidence, class]
+in image coordinates, together with the image as RGB array. The durations
+of preprocessing, forward pass and NMS of the last call (in seconds, for
+all images) are in backend.timings.
+"""
+
+import ast
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+try:
+    # same resize as the torch backend, PIL is used if OpenCV is not installed
+    import cv2
+except ImportError:
+    cv2 = None
+
+log = logging.getLogger(__name__)
+log.propagate = False
+log.setLevel(logging.INFO)
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(
+    logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+)
+log.addHandler(handler)
+
+BACKENDS = ("torch", "onnx")
+
+
+class TorchBackend:
+    """
+    YOLOv5 loaded with torch.hub, inference and NMS by AutoShape.
+
+    With cache_dir, the loaded AutoShape model is pickled to the cache on
+    first start, keyed by a hash of the weights, the yolov5 path and the torch
+    version. Later starts load it from there without going through torch.hub,
+    which avoids the repo checks (and network access without yolov5_path).
+    """
+
+    name = "torch"
+
+    def __init__(
+        self,
+        model_path,
+        yolov5_path=None,
+        confidence_threshold=0.25,
+        iou_threshold=0.45,
+        agnostic=False,
+        multi_label=False,
+        max_det=10,
+        amp=False,
+        cache_dir=None,
+    ):
+        import torch
+
+        self.model = None
+        if cache_dir is not None:
+            cache_path = os.path.join(
+                cache_dir, _cache_key(model_path, yolov5_path, torch.__version__)
+            )
+            self.model = _load_cached_model(cache_path)
+        if self.model is None:
+            if yolov5_path is None:
+                self.model = torch.hub.load("ultralytics/yolov5", "custom", model_path)
+            else:
+                self.model = torch.hub.load(
+                    yolov5_path, "custom", model_path, source="local"
+                )
+            if cache_dir is not None:
+                _store_cached_model(self.model, cache_path)
+        self.model.conf = confidence_threshold
+        self.model.iou = iou_threshold
+        self.model.agnostic = agnostic  # NMS class-agnostic
+        self.model.multi_label = multi_label  # NMS multiple labels per box
+        self.model.max_det = max_det  # maximum number of detections per image
+        self.model.amp = amp  # Automatic Mixed Precision (AMP) inference
+        self.model.classes = None  # (optional list) filter by class, i.e. = [0, 15, 16] for COCO persons, cats and dogs
+        self.names = self.model.names
+        # a tensor of the strides per detection layer in older yolov5 versions
+        stride = getattr(self.model, "stride", 32)
+        self.stride = int(stride.max()) if hasattr(stride, "max") else int(stride)
+        self.timings = {}
+
+    def set_num_threads(self, num_threads):
+        import torch
+
+        torch.set_num_threads(num_threads)
+
+    def predict(self, images, size=640, augment=False, max_det=None):
+        """
+        max_det: overrides the maximum number of detections per image
+        """
+        default_max_det = self.model.max_det
+        if max_det is not None:
+            self.model.max_det = max_det
+        try:
+            results = self.model.forward(images, augment=augment, size=size)
+        finally:
+            self.model.max_det = default_max_det
+        # AutoShape reports milliseconds per image for each step
+        self.timings = dict(
+            zip(
+                ("preprocess", "forward", "nms"),
+                (t * results.n / 1000 for t in results.t),
+            )
+        )
+        # older yolov5 versions name the input images imgs, newer ones ims
+        result_images = getattr(results, "imgs", None)
+        if result_images is None:
+            result_images = results.ims
+        return [
+            (results.xyxy[i].cpu().numpy(), result_images[i])
+            for i in range(len(result_images))
+        ]
+
+
+class OnnxBackend:
+    """
+    YOLOv5 exported to ONNX (export.py --include onnx), run with ONNX Runtime
+    on the CPU. Letterboxing and NMS are done with NumPy and follow AutoShape.
+
+    Models with a fixed input shape are fed images letterboxed to that shape,
+    models exported with --dynamic get the same shape AutoShape would use.
+    With quantize, an int8 copy of the model (weights quantized dynamically)
+    is created next to it on first use and loaded instead.
+    """
+
+    name = "onnx"
+
+    def __init__(
+        self,
+        model_path,
+        confidence_threshold=0.25,
+        iou_threshold=0.45,
+        agnostic=False,
+        multi_label=False,
+        max_det=10,
+        quantize=False,
+        num_threads=None,
+    ):
+        if quantize:
+            model_path = quantize_model(model_path)
+        self.model_path = model_path
+        self.session = self._create_session(num_threads)
+        self.conf = confidence_threshold
+        self.iou = iou_threshold
+        self.agnostic = agnostic
+        self.multi_label = multi_label
+        self.max_det = max_det
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_type = np.float16 if "float16" in model_input.type else np.float32
+        batch_size, _, height, width = model_input.shape
+        # dynamic dimensions are strings or None
+        self.batch_size = batch_size if isinstance(batch_size, int) else None
+        if isinstance(height, int) and isinstance(width, int):
+            self.input_shape = (height, width)
+        else:
+            self.input_shape = None
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.stride = int(metadata.get("stride", 32))
+        self.timings = {}
+        self.names = None
+        if "names" in metadata:
+            self.names = ast.literal_eval(metadata["names"])
+
+    def _create_session(self, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        return onnxruntime.InferenceSession(
+            self.model_path, options, providers=["CPUExecutionProvider"]
+        )
+
+    def set_num_threads(self, num_threads):
+        """
+        Recreates the session with num_threads intra-op threads. Also needed
+        in forked processes, the thread pool of the session does not survive
+        the fork.
+        """
+        self.session = self._create_session(num_threads)
+
+    def predict(self, images, size=640, augment=False, max_det=None):
+        """
+        augment (test-time augmentation) is not supported and ignored.
+        max_det: overrides the maximum number of detections per image
+        """
+        t0 = time.monotonic()
+        arrays = [to_rgb_array(image) for image in images]
+        if self.input_shape is not None:
+            input_shape = self.input_shape
+        else:
+            input_shape = np.max(
+                [letterbox_shape(array, size, self.stride) for array in arrays], 0
+            )
+        x = np.stack([letterbox(array, input_shape) for array in arrays])
+        x = x.transpose((0, 3, 1, 2)).astype(self.input_type) / 255
+        t1 = time.monotonic()
+
+        batch_size = self.batch_size or len(x)
+        predictions = []
+        for start in range(0, len(x), batch_size):
+            batch = x[start : start + batch_size]
+            if len(batch) < batch_size:  # fixed batch size, pad the last batch
+                padding = np.zeros((batch_size - len(batch),) + batch.shape[1:])
+                batch = np.concatenate([batch, padding.astype(batch.dtype)])
+            output = self.session.run(None, {self.input_name: batch})[0]
+            predictions += list(output[: len(x) - start])
+        t2 = time.monotonic()
+
+        results = []
+        for prediction, array in zip(predictions, arrays):
+            detections = non_max_suppression(
+                prediction.astype(np.float32),
+                self.conf,
+                self.iou,
+                agnostic=self.agnostic,
+                multi_label=self.multi_label,
+                max_det=max_det or self.max_det,
+            )
+            detections[:, :4] = scale_boxes(
+                detections[:, :4], input_shape, array.shape[:2]
+            )
+            results.append((detections, array))
+        self.timings = {
+            "preprocess": t1 - t0,
+            "forward": t2 - t1,
+            "nms": time.monotonic() - t2,
+        }
+        return results
+
+
+def create_backend(backend, model_path, **kwargs):
+    """
+    Creates the backend with the given name, kwargs are passed on to it.
+    """
+    if backend == "torch":
+        return TorchBackend(model_path, **kwargs)
+    if backend == "onnx":
+        return OnnxBackend(model_path, **kwargs)
+    raise ValueError(
+        "Unknown backend: {}, expected one of {}".format(backend, BACKENDS)
+    )
+
+
+def _cache_key(model_path, yolov5_path, torch_version):
+    digest = hashlib.sha256()
+    if os.path.isfile(model_path):
+        with open(model_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    else:
+        digest.update(model_path.encode("utf-8"))
+    if yolov5_path is not None:
+        yolov5_path = os.path.abspath(yolov5_path)
+    digest.update(json.dumps([yolov5_path, torch_version]).encode("utf-8"))
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return "{}-{}.pt".format(name, digest.hexdigest()[:16])
+
+
+def _load_cached_model(cache_path):
+    """
+    Returns the model pickled at cache_path, None if there is none or it
+    cannot be loaded.
+    """
+    import torch
+
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path + ".json", "r") as f:
+            info = json.load(f)
+        # the pickle references the yolov5 classes by module name
+        if info["module_root"] not in sys.path:
+            sys.path.insert(0, info["module_root"])
+        try:
+            model = torch.load(cache_path, map_location="cpu", weights_only=False)
+        except TypeError:  # torch < 1.13 has no weights_only
+            model = torch.load(cache_path, map_location="cpu")
+    except Exception as e:
+        log.warning("Loading cached model {} failed: {}".format(cache_path, e))
+        return None
+    log.info("Loaded cached model {}".format(cache_path))
+    return model
+
+
+def _store_cached_model(model, cache_path):
+    import torch
+
+    module_name = type(model).__module__
+    module_root = os.path.abspath(sys.modules[module_name].__file__)
+    for _ in module_name.split("."):
+        module_root = os.path.dirname(module_root)
+    try:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        # written to temporary files first, so an interrupted write is not loaded
+        torch.save(model, cache_path + ".tmp")
+        with open(cache_path + ".json.tmp", "w") as f:
+            json.dump({"module_root": module_root}, f)
+        os.replace(cache_path + ".json.tmp", cache_path + ".json")
+        os.replace(cache_path + ".tmp", cache_path)
+    except Exception as e:
+        log.warning("Caching model to {} failed: {}".format(cache_path, e))
+        return
+    log.info("Cached model to {}".format(cache_path))
+
+
+def quantize_model(model_path):
+    """
+    Returns the path of an int8 copy of the model, creates it if needed.
+    """
+    quantized_path = os.path.splitext(model_path)[0] + ".int8.onnx"
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        log.info("Quantizing {} to {}".format(model_path, quantized_path))
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QUInt8)
+    return quantized_path
+
+
+def to_rgb_array(image):
+    if isinstance(image, Image.Image):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return np.asarray(image)
+    if image.ndim == 2:
+        return np.stack([image] * 3, axis=-1)
+    return image[..., :3]
+
+
+def letterbox_shape(image, size, stride):
+    """
+    Returns the (height, width) an image (array or PIL image) is letterboxed
+    to when inferred alone at size, a batch is letterboxed to the largest
+    of its images, as in YOLOv5's AutoShape.
+    """
+    if isinstance(image, Image.Image):
+        width, height = image.size
+    else:
+        height, width = image.shape[:2]
+    gain = size / max(height, width)
+    return tuple(math.ceil(int(y * gain) / stride) * stride for y in (height, width))
+
+
+def letterbox(image, new_shape, color=114):
+    """
+    Resizes an image (array HWC) to fit into new_shape (height, width),
+    keeping the aspect ratio, and pads it to new_shape.
+    """
+    height, width = image.shape[:2]
+    ratio = min(new_shape[0] / height, new_shape[1] / width)
+    new_width, new_height = int(round(width * ratio)), int(round(height * ratio))
+    if (new_width, new_height) != (width, height):
+        if cv2 is not None:
+            image = cv2.resize(
+                image, (new_width, new_height), interpolation=cv2.INTER_LINEAR
+            )
+        else:
+            image = np.asarray(
+                Image.fromarray(image).resize((new_width, new_height), Image.BILINEAR)
+            )
+    dw = (new_shape[1] - new_width) / 2
+    dh = (new_shape[0] - new_height) / 2
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    return np.pad(
+        image,
+        ((top, bottom), (left, right), (0, 0)),
+        mode="constant",
+        constant_values=color,
+    )
+
+
+def scale_boxes(boxes, input_shape, image_shape):
+    """
+    Maps boxes (xyxy) from the letterboxed input back to the image.
+    """
+    gain = min(input_shape[0] / image_shape[0], input_shape[1] / image_shape[1])
+    pad_x = (input_shape[1] - image_shape[1] * gain) / 2
+    pad_y = (input_shape[0] - image_shape[0] * gain) / 2
+    boxes = (boxes - np.array([pad_x, pad_y, pad_x, pad_y])) / gain
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, image_shape[1])
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, image_shape[0])
+    return boxes
+
+
+def non_max_suppression(
+    prediction,
+    conf_threshold=0.25,
+    iou_threshold=0.45,
+    agnostic=False,
+    multi_label=False,
+    max_det=300,
+    max_wh=7680,
+    max_nms=30000,
+):
+    """
+    NMS on the raw output of a YOLOv5 model for one image, rows
+    [x, y, w, h, objectness, class scores...].
+    Returns an array with rows [xmin, ymin, xmax, ymax, confidence, class].
+    """
+    num_classes = prediction.shape[1] - 5
+    multi_label &= num_classes > 1
+    x = prediction[prediction[:, 4] > conf_threshold]
+    scores = x[:, 5:] * x[:, 4:5]
+    boxes = np.empty((len(x), 4), dtype=np.float32)
+    boxes[:, :2] = x[:, :2] - x[:, 2:4] / 2
+    boxes[:, 2:] = x[:, :2] + x[:, 2:4] / 2
+    if multi_label:
+        i, j = np.nonzero(scores > conf_threshold)
+        detections = np.concatenate(
+            [boxes[i], scores[i, j, None], j[:, None].astype(np.float32)], axis=1
+        )
+    else:
+        j = scores.argmax(1) if len(scores) else np.zeros(0, dtype=int)
+        confidence = scores[np.arange(len(scores)), j]
+        detections = np.concatenate(
+            [boxes, confidence[:, None], j[:, None].astype(np.float32)], axis=1
+        )
+        detections = detections[confidence > conf_threshold]
+    detections = detections[detections[:, 4].argsort()[::-1][:max_nms]]
+
+    offsets = 0 if agnostic else detections[:, 5:6] * max_wh
+    keep = _nms(detections[:, :4] + offsets, iou_threshold)
+    return detections[keep[:max_det]].astype(np.float64)
+
+
+def _nms(boxes, iou_threshold):
+    """
+    Greedy NMS, boxes sorted by descending confidence.
+    Returns the indexes of the kept boxes.
+    """
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.arange(len(boxes))
+    keep = []
+    while len(order) > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        width = np.clip(
+            np.minimum(boxes[i, 2], boxes[rest, 2])
+            - np.maximum(boxes[i, 0], boxes[rest, 0]),
+            0,
+            None,
+        )
+        height = np.clip(
+            np.minimum(boxes[i, 3], boxes[rest, 3])
+            - np.maximum(boxes[i, 1], boxes[rest, 1]),
+            0,
+            None,
+        )
+        intersection = width * height
+        iou = intersection / (areas[i] + areas[rest] - intersection + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=int)
@@ -0,0 +1,187 @@
+"""
+Micro-benchmark and equivalence check for the multi_label grouping.
+
+Compares yolomodelhelper.group_overlapping_boxes with the previous
+pairwise IoU + recursive grouping implementation (copied below).
+
+    python -m benchmark.bench_grouping
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from yolomodelhelper import compute_iou_matrix, group_overlapping_boxes
+
+
+# previous implementation, kept as reference, also by tests/test_grouping.py
+def legacy_compute_iou(bb1, bb2):
+    assert bb1[0] < bb1[2]
+    assert bb1[1] < bb1[3]
+    assert bb2[0] < bb2[2]
+    assert bb2[1] < bb2[3]
+    x_left = max(bb1[0], bb2[0])
+    y_top = max(bb1[1], bb2[1])
+    x_right = min(bb1[2], bb2[2])
+    y_bottom = min(bb1[3], bb2[3])
+    if x_right < x_left or y_bottom < y_top:
+        return 0.0
+    intersection_area = (x_right - x_left) * (y_bottom - y_top)
+    bb1_area = (bb1[2] - bb1[0]) * (bb1[3] - bb1[1])
+    bb2_area = (bb2[2] - bb2[0]) * (bb2[3] - bb2[1])
+    iou = intersection_area / float(bb1_area + bb2_area - intersection_area)
+    assert iou >= 0.0
+    assert iou <= 1.0
+    return iou
+
+
+def legacy_get_related_elements(list, index, known_elements=[]):
+    elements = known_elements
+    for item in list[index]:
+        if item not in elements:
+            elements.append(item)
+            additional_elements = legacy_get_related_elements(list, item, elements)
+            for element in additional_elements:
+                if element not in elements:
+                    elements.append(element)
+    for i in range(len(list)):
+        for item in list[i]:
+            if item in elements:
+                if i not in elements:
+                    elements.append(i)
+    return sorted(elements)
+
+
+def legacy_group_overlapping_boxes(boxes, iou_threshold):
+    overlapping = []
+    for bb1 in range(len(boxes)):
+        overlapping_bb1 = []
+        for bb2 in range(bb1 + 1, len(boxes)):
+            if legacy_compute_iou(boxes[bb1], boxes[bb2]) > iou_threshold:
+                overlapping_bb1.append(bb2)
+        overlapping.append(overlapping_bb1)
+    indexes = []
+    known_ids = []
+    new_indexes = [0 for i in range(len(overlapping))]
+    for i in range(len(overlapping)):
+        if i not in known_ids:
+            idx = legacy_get_related_elements(overlapping, i, [i])
+            known_ids += idx
+            indexes.append(idx)
+    for i in range(len(indexes)):
+        for j in range(len(indexes[i])):
+            new_indexes[indexes[i][j]] = i
+    return new_indexes
+
+
+def random_boxes(rng, num_boxes, image_size=640, cluster_size=3, jitter=4.0):
+    """
+    Boxes in clusters of about cluster_size nearly identical boxes, like the
+    multi_label output of the model.
+    """
+    num_clusters = max(1, num_boxes // cluster_size)
+    centers = rng.uniform(50, image_size - 50, size=(num_clusters, 2))
+    sizes = rng.uniform(20, 80, size=(num_clusters, 2))
+    cluster = rng.integers(0, num_clusters, size=num_boxes)
+    center = centers[cluster] + rng.normal(0, jitter, size=(num_boxes, 2))
+    size = sizes[cluster] + rng.normal(0, jitter, size=(num_boxes, 2))
+    return np.concatenate([center - size / 2, center + size / 2], axis=1)
+
+
+def connected_components(boxes, iou_threshold):
+    """
+    Plain depth-first search over the overlap graph, used as ground truth.
+    """
+    overlapping = compute_iou_matrix(boxes) > iou_threshold
+    groups = [-1] * len(boxes)
+    num_groups = 0
+    for start in range(len(boxes)):
+        if groups[start] >= 0:
+            continue
+        groups[start] = num_groups
+        stack = [start]
+        while stack:
+            i = stack.pop()
+            for j in np.nonzero(overlapping[i])[0].tolist():
+                if groups[j] < 0:
+                    groups[j] = num_groups
+                    stack.append(j)
+        num_groups += 1
+    return groups
+
+
+def check_equivalence(rng, trials, iou_threshold):
+    """
+    Checks the IoU matrix against the legacy pairwise IoU and the grouping
+    against the connected components of the overlap graph.
+    Returns the number of trials in which the legacy grouping differs. This
+    only happens when it is not a connected components labeling: boxes added
+    in its final scan are not expanded, so it can miss members of a chain of
+    overlapping boxes.
+    """
+    mismatches = 0
+    for _ in range(trials):
+        boxes = random_boxes(rng, int(rng.integers(1, 60)))
+        groups = group_overlapping_boxes(boxes, iou_threshold).tolist()
+        assert groups == connected_components(boxes, iou_threshold)
+        legacy_groups = legacy_group_overlapping_boxes(boxes.tolist(), iou_threshold)
+        if groups != legacy_groups:
+            mismatches += 1
+        iou = compute_iou_matrix(boxes)
+        for i in range(len(boxes)):
+            for j in range(len(boxes)):
+                assert abs(iou[i, j] - legacy_compute_iou(boxes[i], boxes[j])) < 1e-9
+    return mismatches
+
+
+def timeit(function, repeats):
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - t0) / repeats
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="multi_label grouping benchmark")
+    argparser.add_argument("--sizes", type=int, nargs="+", default=[10, 30, 100, 300])
+    argparser.add_argument("--iou-threshold", type=float, default=0.7)
+    argparser.add_argument("--trials", type=int, default=500)
+    argparser.add_argument("--seed", type=int, default=0)
+    args = argparser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    sys.setrecursionlimit(10000)
+
+    report = {
+        "equivalence_trials": args.trials,
+        "legacy_mismatches": check_equivalence(rng, args.trials, args.iou_threshold),
+        "timings": [],
+    }
+    for num_boxes in args.sizes:
+        boxes = random_boxes(rng, num_boxes)
+        box_list = boxes.tolist()
+        repeats = max(1, 3000 // num_boxes)
+        report["timings"].append(
+            {
+                "num_boxes": num_boxes,
+                "legacy_ms": 1000
+                * timeit(
+                    lambda: legacy_group_overlapping_boxes(
+                        box_list, args.iou_threshold
+                    ),
+                    max(1, repeats // 10),
+                ),
+                "vectorized_ms": 1000
+                * timeit(
+                    lambda: group_overlapping_boxes(boxes, args.iou_threshold),
+                    repeats,
+                ),
+            }
+        )
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
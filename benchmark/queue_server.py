@@ -0,0 +1,76 @@
+"""
+Local stand-in for the ZMQMessageQueue server.
+
+Answers the request codes of zmqhelper on a REP socket:
+    GET_FIRST (0):     the first record, NO_DATA if the queue is empty
+    POP_FIRST (1):     the first record, removed from the queue
+    REMOVE_FIRST (2):  removes the first record, answers REMOVED or NO_DATA
+"""
+
+import collections
+import json
+import threading
+
+import zmq
+
+from zmqhelper import GET_FIRST, NO_DATA, POP_FIRST, REMOVE_FIRST, REMOVED
+
+
+class QueueServer:
+    def __init__(self, records=(), host="127.0.0.1", port=None):
+        """
+        port: None binds to a random free port, see self.port
+        """
+        self.records = collections.deque(records)
+        self.lock = threading.Lock()
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.REP)
+        if port is None:
+            self.port = self.socket.bind_to_random_port("tcp://{}".format(host))
+        else:
+            self.socket.bind("tcp://{}:{}".format(host, port))
+            self.port = port
+        self.host = host
+        self.served = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name="queue-server", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def put(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def __len__(self):
+        return len(self.records)
+
+    def _handle(self, code):
+        with self.lock:
+            if len(self.records) == 0:
+                return NO_DATA
+            if code == GET_FIRST:
+                return self.records[0]
+            if code == POP_FIRST:
+                self.served += 1
+                return self.records.popleft()
+            if code == REMOVE_FIRST:
+                self.records.popleft()
+                return REMOVED
+        return NO_DATA
+
+    def _run(self):
+        while not self.stopped.is_set():
+            if (self.socket.poll(100) & zmq.POLLIN) == 0:
+                continue
+            code = json.loads(self.socket.recv())
+            self.socket.send(json.dumps(self._handle(code)).encode("utf-8"))
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.close()
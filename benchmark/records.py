@@ -0,0 +1,116 @@
+"""
+Synthetic input records in the schema read by MessageParser.
+
+The flower crops are smooth random images (upscaled noise with a few
+blobs), so their JPEG size and decode time are closer to camera crops than
+pure noise. A pool of encoded crops is created once and reused, records
+differ in node, timestamp and the selection of crops.
+"""
+
+import base64
+import datetime
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+FLOWER_CLASSES = ["flockenblume", "margerite", "wilde_moehre", "sonnenblume"]
+
+
+def synthetic_crop(rng, width, height):
+    """
+    Returns a smooth random RGB image of the given size.
+    """
+    small = rng.integers(0, 256, size=(8, 8, 3), dtype=np.uint8)
+    image = Image.fromarray(small).resize((width, height), Image.BICUBIC)
+    draw = ImageDraw.Draw(image)
+    for _ in range(int(rng.integers(2, 6))):
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        radius = rng.uniform(0.03, 0.15) * min(width, height)
+        color = tuple(int(c) for c in rng.integers(0, 256, size=3))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color)
+    return image
+
+
+def encode_crop(image, quality=90):
+    bio = io.BytesIO()
+    image.save(bio, format="JPEG", quality=quality)
+    return base64.b64encode(bio.getvalue()).decode("utf-8")
+
+
+class RecordGenerator:
+    """
+    Generates records for the input queue.
+
+    num_flowers: (min, max) flowers per record
+    crop_size: (min, max) width and height of the flower crops in pixels
+    nodes: number of distinct node ids
+    pool_size: number of distinct encoded crops
+    """
+
+    def __init__(
+        self,
+        num_flowers=(1, 4),
+        crop_size=(150, 600),
+        nodes=4,
+        pool_size=32,
+        seed=0,
+        start_time=datetime.datetime(2022, 7, 7, 8, 0, 0),
+    ):
+        self.num_flowers = num_flowers
+        self.nodes = ["bench-{:02d}".format(i) for i in range(nodes)]
+        self.start_time = start_time
+        self.rng = np.random.default_rng(seed)
+        self.pool = []
+        for _ in range(pool_size):
+            width, height = self.rng.integers(crop_size[0], crop_size[1] + 1, size=2)
+            self.pool.append(
+                encode_crop(synthetic_crop(self.rng, int(width), int(height)))
+            )
+
+    def record(self, index):
+        """
+        Returns the record with the given index. Records of the same node are
+        one second apart, so their timestamps (and result filenames) differ.
+        """
+        node_id = self.nodes[index % len(self.nodes)]
+        timestamp = self.start_time + datetime.timedelta(
+            seconds=index // len(self.nodes)
+        )
+        num_flowers = int(
+            self.rng.integers(self.num_flowers[0], self.num_flowers[1] + 1)
+        )
+        flowers = []
+        for _ in range(num_flowers):
+            flowers.append(
+                {
+                    "class_name": FLOWER_CLASSES[
+                        int(self.rng.integers(len(FLOWER_CLASSES)))
+                    ],
+                    "score": round(float(self.rng.uniform(0.3, 1.0)), 2),
+                    "crop": self.pool[int(self.rng.integers(len(self.pool)))],
+                }
+            )
+        return {
+            "detections": {"flowers": flowers},
+            "metadata": {
+                "node_id": node_id,
+                "capture_timestamp": timestamp.isoformat(),
+                "original_image": {
+                    "size": [4656, 3496],
+                    "capture_duration": 1.2,
+                    "source": "benchmark",
+                },
+                "flower_inference": {
+                    "confidence_threshold": 0.25,
+                    "iou_threshold": 0.5,
+                    "margin": 20,
+                    "model_name": "flowers_benchmark.tflite",
+                    "max_det": 25,
+                    "inference_times": [0.5, 0.5],
+                },
+            },
+        }
+
+    def records(self, count):
+        return [self.record(i) for i in range(count)]
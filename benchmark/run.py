@@ -0,0 +1,326 @@
+"""
+End-to-end throughput benchmark.
+
+Serves synthetic records from a local queue server, processes them with a
+tiny randomly initialized YOLOv5 model (benchmark/tinyyolo) in the
+selected modes and delivers the results to local MQTT / HTTP sinks and / or
+files. Reports records/s, flowers/s and per-stage latency percentiles as
+JSON. Runs offline, requires the yolov5 pip package or a yolov5 checkout
+(YOLOV5_PATH) for the model classes.
+
+    python -m benchmark.run --records 200 --modes serial pipeline workers
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from benchmark.queue_server import QueueServer
+from benchmark.records import RecordGenerator
+from benchmark.sinks import HTTPSink, MQTTSink
+from messagehelper import HTTPClient, MQTTClient
+from pipelinehelper import Pipeline, Record, RecordProcessor, WorkerPool
+from yolomodelhelper import YoloModel
+from zmqhelper import ZMQInputClient
+
+TINY_MODEL_PATH = os.path.join(os.path.dirname(__file__), "tinyyolo")
+STAGES = ("decode", "infer", "encode", "output")
+PERCENTILES = (50, 95, 99)
+
+
+class StageTimer:
+    """
+    Wraps the stages of a RecordProcessor to record their duration on the
+    record (so it travels back from worker processes) and collects them
+    when the record is output.
+    """
+
+    def __init__(self, processor, expected):
+        self.expected = expected
+        self.durations = {stage: [] for stage in STAGES + ("total",)}
+        self.records = 0
+        self.flowers = 0
+        self.pollinators = 0
+        self.done = threading.Event()
+        for stage in STAGES:
+            setattr(processor, stage, self._wrap(stage, getattr(processor, stage)))
+
+    def _wrap(self, name, stage):
+        def timed_stage(record):
+            t0 = time.monotonic()
+            if not hasattr(record, "timings"):
+                record.timings = {}
+                record.started = t0
+            flowers = record.raw["detections"]["flowers"] if name == "decode" else None
+            record = stage(record)
+            record.timings[name] = time.monotonic() - t0
+            if flowers is not None:
+                record.flowers = len(flowers)
+            if name == "output":
+                self._collect(record)
+            return record
+
+        return timed_stage
+
+    def _collect(self, record):
+        for stage, duration in record.timings.items():
+            self.durations[stage].append(duration)
+        self.durations["total"].append(time.monotonic() - record.started)
+        self.records += 1
+        self.flowers += record.flowers
+        self.pollinators += len(record.generator.pollinators)
+        if self.records >= self.expected:
+            self.done.set()
+
+    def latencies(self):
+        report = {}
+        for stage, durations in self.durations.items():
+            if len(durations) == 0:
+                continue
+            values = np.array(durations) * 1000
+            report[stage] = {
+                "p{}_ms".format(p): round(float(np.percentile(values, p)), 3)
+                for p in PERCENTILES
+            }
+            report[stage]["mean_ms"] = round(float(values.mean()), 3)
+        return report
+
+
+def run_mode(mode, model, records, args):
+    """
+    Processes the records in the given mode (serial, pipeline or workers),
+    returns the report of the run.
+    """
+    server = QueueServer(records).start()
+    mqtt_sink = http_sink = mqtt_client = http_client = None
+    if "mqtt" in args.sinks:
+        mqtt_sink = MQTTSink().start()
+        mqtt_client = MQTTClient(
+            mqtt_sink.host,
+            mqtt_sink.port,
+            "results/${node_id}",
+            None,
+            None,
+            False,
+            format=args.format,
+        )
+    if "http" in args.sinks:
+        http_sink = HTTPSink().start()
+        http_client = HTTPClient(
+            "http://{}:{}/results/${{node_id}}".format(http_sink.host, http_sink.port),
+            None,
+            None,
+            batch_size=args.http_batch_size,
+            format=args.format,
+        )
+    base_dir = tempfile.mkdtemp(prefix="benchmark-")
+    processor = RecordProcessor(
+        model,
+        image_size=args.image_size,
+        input_sizes=args.input_sizes,
+        reduced_decode=args.reduced_decode,
+        hostname="benchmark",
+        store_file="file" in args.sinks,
+        base_dir=base_dir,
+        file_format=args.format,
+        mqtt_client=mqtt_client,
+        http_client=http_client,
+        crop_encode_threads=args.crop_encode_threads,
+    )
+    timer = StageTimer(processor, len(records))
+
+    input_client = ZMQInputClient(server.host, server.port, prefetch=4)
+    pool = None
+    if mode == "workers":
+        # forked before the client threads start
+        pool = WorkerPool(
+            processor,
+            input_client.get,
+            workers=args.workers,
+            threads_per_worker=args.worker_threads,
+        ).start_workers()
+    for client in (mqtt_client, http_client, input_client):
+        if client is not None:
+            client.start()
+
+    t0 = time.monotonic()
+    if mode == "serial":
+
+        def serial_loop():
+            seq = 0
+            while True:
+                processor.process(Record(seq=seq, raw=input_client.get()))
+                seq += 1
+
+        threading.Thread(target=serial_loop, daemon=True).start()
+    elif mode == "pipeline":
+        Pipeline(
+            processor,
+            input_client.get,
+            decode_threads=args.decode_threads,
+            encode_threads=args.encode_threads,
+        ).start()
+    elif mode == "workers":
+        threading.Thread(target=pool.run, daemon=True).start()
+    else:
+        raise ValueError("Unknown mode: {}".format(mode))
+
+    completed = timer.done.wait(args.timeout)
+    elapsed = time.monotonic() - t0
+    sinks = {}
+    for name, sink in (("mqtt", mqtt_sink), ("http", http_sink)):
+        if sink is None:
+            continue
+        deadline = time.monotonic() + 10
+        while sink.stats.messages < timer.records and time.monotonic() < deadline:
+            time.sleep(0.05)
+        sinks[name] = sink.stats.to_dict()
+    if "file" in args.sinks:
+        sinks["file"] = {
+            "messages": sum(len(files) for _, _, files in os.walk(base_dir))
+        }
+
+    input_client.close()
+    server.close()
+    if mqtt_client is not None:
+        mqtt_client.close()
+    for sink in (mqtt_sink, http_sink):
+        if sink is not None:
+            sink.close()
+    shutil.rmtree(base_dir, ignore_errors=True)
+
+    report = {
+        "mode": mode,
+        "completed": completed,
+        "records": timer.records,
+        "flowers": timer.flowers,
+        "pollinators": timer.pollinators,
+        "elapsed_s": round(elapsed, 3),
+        "records_per_s": round(timer.records / elapsed, 3),
+        "flowers_per_s": round(timer.flowers / elapsed, 3),
+        "latency": timer.latencies(),
+        "sinks": sinks,
+    }
+    if mode == "pipeline":
+        report["decode_threads"] = args.decode_threads
+        report["encode_threads"] = args.encode_threads
+    elif mode == "workers":
+        report["workers"] = args.workers
+        report["worker_threads"] = args.worker_threads
+    return report
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="end-to-end benchmark")
+    argparser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["serial", "pipeline"],
+        choices=["serial", "pipeline", "workers"],
+    )
+    argparser.add_argument("--records", type=int, default=100)
+    argparser.add_argument("--flowers", type=int, nargs=2, default=[1, 4])
+    argparser.add_argument("--crop-size", type=int, nargs=2, default=[150, 600])
+    argparser.add_argument("--nodes", type=int, default=4)
+    argparser.add_argument("--seed", type=int, default=0)
+    argparser.add_argument(
+        "--sinks", nargs="*", default=["mqtt", "http"], choices=["mqtt", "http", "file"]
+    )
+    argparser.add_argument("--format", default="json")
+    argparser.add_argument("--http-batch-size", type=int, default=1)
+    argparser.add_argument("--backend", default="torch", choices=["torch", "onnx"])
+    argparser.add_argument(
+        "--weights", help="exported .onnx model, required for the onnx backend"
+    )
+    argparser.add_argument("--image-size", type=int, default=640)
+    argparser.add_argument(
+        "--input-sizes",
+        type=int,
+        nargs="*",
+        help="ladder of adaptive inference sizes, e.g. 256 320 416 640",
+    )
+    argparser.add_argument("--max-batch-size", type=int, default=8)
+    argparser.add_argument("--max-batch-padding", type=int, default=64)
+    argparser.add_argument("--confidence-threshold", type=float, default=0.001)
+    argparser.add_argument("--max-det", type=int, default=10)
+    argparser.add_argument("--reduced-decode", action="store_true")
+    argparser.add_argument(
+        "--mosaic", action="store_true", help="pack small crops into mosaic canvases"
+    )
+    argparser.add_argument("--crop-encode-threads", type=int, default=2)
+    argparser.add_argument("--decode-threads", type=int, default=2)
+    argparser.add_argument("--encode-threads", type=int, default=2)
+    argparser.add_argument("--workers", type=int, default=2)
+    argparser.add_argument("--worker-threads", type=int, default=None)
+    argparser.add_argument(
+        "--timeout", type=float, default=600, help="max seconds per mode"
+    )
+    argparser.add_argument("--output", help="also write the report to this file")
+    args = argparser.parse_args()
+
+    # keep the per-record logging of the service out of the measurement
+    for name in ("pipelinehelper", "messagehelper", "zmqhelper", "backendhelper"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    t0 = time.monotonic()
+    model = YoloModel(
+        args.weights or "tiny",
+        TINY_MODEL_PATH,
+        confidence_threshold=args.confidence_threshold,
+        multi_label=True,
+        max_det=args.max_det,
+        max_batch_size=args.max_batch_size,
+        max_batch_padding=args.max_batch_padding,
+        backend=args.backend,
+        mosaic=args.mosaic,
+    )
+    model.warmup(
+        sorted(
+            {
+                model.align_input_size(size)
+                for size in args.input_sizes or [args.image_size]
+            }
+        )
+    )
+    startup_time = time.monotonic() - t0
+    generator = RecordGenerator(
+        num_flowers=args.flowers,
+        crop_size=args.crop_size,
+        nodes=args.nodes,
+        seed=args.seed,
+    )
+    records = generator.records(args.records)
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "cpu_count": os.cpu_count(),
+        "startup_s": round(startup_time, 3),
+        "runs": [],
+    }
+    for mode in args.modes:
+        report["runs"].append(run_mode(mode, model, records, args))
+        print(
+            "{}: {} records/s, {} flowers/s".format(
+                mode,
+                report["runs"][-1]["records_per_s"],
+                report["runs"][-1]["flowers_per_s"],
+            ),
+            file=sys.stderr,
+        )
+    output = json.dumps(report, indent=4)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Local MQTT and HTTP sinks that accept and count results.
+
+MQTTSink implements just enough of MQTT 3.1.1 for a publishing client:
+CONNECT, PUBLISH with QoS 0, 1 and 2, PINGREQ and DISCONNECT.
+HTTPSink accepts POST and PUT requests, batched results (JSON, msgpack or
+CBOR arrays) are counted per result.
+"""
+
+import gzip
+import http.server
+import socketserver
+import struct
+import threading
+
+from formathelper import CONTENT_TYPES, decode_result
+
+# MQTT control packet types
+CONNECT, PUBLISH, PUBREL, PINGREQ, DISCONNECT = 1, 3, 6, 12, 14
+
+
+class SinkStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.requests = 0
+        self.bytes = 0
+
+    def add(self, messages, size):
+        with self.lock:
+            self.messages += messages
+            self.requests += 1
+            self.bytes += size
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "messages": self.messages,
+                "requests": self.requests,
+                "bytes": self.bytes,
+            }
+
+
+class _Server:
+    def __init__(self, server):
+        self.server = server
+        self.host, self.port = server.server_address[:2]
+        self.thread = threading.Thread(
+            target=server.serve_forever, name=type(self).__name__, daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _MQTTHandler(socketserver.BaseRequestHandler):
+    def _read(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _read_packet(self):
+        header = self._read(1)[0]
+        multiplier, length = 1, 0
+        while True:
+            digit = self._read(1)[0]
+            length += (digit & 127) * multiplier
+            multiplier *= 128
+            if not digit & 128:
+                break
+        return header, self._read(length)
+
+    def handle(self):
+        stats = self.server.stats
+        try:
+            while True:
+                header, body = self._read_packet()
+                packet_type = header >> 4
+                if packet_type == CONNECT:
+                    self.request.sendall(b"\x20\x02\x00\x00")
+                elif packet_type == PUBLISH:
+                    qos = (header >> 1) & 3
+                    (topic_length,) = struct.unpack(">H", body[:2])
+                    offset = 2 + topic_length
+                    if qos > 0:
+                        packet_id = body[offset : offset + 2]
+                        offset += 2
+                        # PUBACK for QoS 1, PUBREC for QoS 2
+                        self.request.sendall(
+                            (b"\x40\x02" if qos == 1 else b"\x50\x02") + packet_id
+                        )
+                    stats.add(1, len(body) - offset)
+                elif packet_type == PUBREL:
+                    self.request.sendall(b"\x70\x02" + body[:2])
+                elif packet_type == PINGREQ:
+                    self.request.sendall(b"\xd0\x00")
+                elif packet_type == DISCONNECT:
+                    return
+        except (EOFError, ConnectionError):
+            return
+
+
+class MQTTSink(_Server):
+    def __init__(self, host="127.0.0.1", port=0):
+        """
+        port: 0 binds to a random free port, see self.port
+        """
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer((host, port), _MQTTHandler)
+        server.daemon_threads = True
+        server.stats = SinkStats()
+        self.stats = server.stats
+        super().__init__(server)
+
+
+class _HTTPHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    formats = {content_type: format for format, content_type in CONTENT_TYPES.items()}
+
+    def _receive(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        size = len(body)
+        encoding = self.headers.get("Content-Encoding")
+        if encoding == "gzip":
+            body = gzip.decompress(body)
+        elif encoding == "zstd":
+            import zstandard
+
+            body = zstandard.ZstdDecompressor().decompress(body)
+        messages = 1
+        format = self.formats.get(self.headers.get("Content-Type"))
+        if format is not None and format != "multipart":
+            message = decode_result(body, format)
+            if isinstance(message, list):
+                messages = len(message)
+        self.server.stats.add(messages, size)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_POST = _receive
+    do_PUT = _receive
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPSink(_Server):
+    def __init__(self, host="127.0.0.1", port=0):
+        """
+        port: 0 binds to a random free port, see self.port
+        """
+        server = http.server.ThreadingHTTPServer((host, port), _HTTPHandler)
+        server.stats = SinkStats()
+        self.stats = server.stats
+        super().__init__(server)
@@ -0,0 +1,76 @@
+"""
+torch.hub entry point for a tiny randomly initialized YOLOv5 model, used by
+the benchmark as local_yolov5_path so no weights or network are needed.
+
+The model classes are taken from a yolov5 checkout given by the YOLOV5_PATH
+environment variable, or from the yolov5 pip package.
+"""
+
+import os
+import sys
+
+dependencies = ["torch"]
+
+CLASS_NAMES = ["honigbiene", "wildbiene", "hummel", "schwebfliege", "fliege"]
+
+# yolov5n.yaml
+YOLOV5N = {
+    "nc": len(CLASS_NAMES),
+    "depth_multiple": 0.33,
+    "width_multiple": 0.25,
+    "anchors": [
+        [10, 13, 16, 30, 33, 23],
+        [30, 61, 62, 45, 59, 119],
+        [116, 90, 156, 198, 373, 326],
+    ],
+    "backbone": [
+        [-1, 1, "Conv", [64, 6, 2, 2]],
+        [-1, 1, "Conv", [128, 3, 2]],
+        [-1, 3, "C3", [128]],
+        [-1, 1, "Conv", [256, 3, 2]],
+        [-1, 6, "C3", [256]],
+        [-1, 1, "Conv", [512, 3, 2]],
+        [-1, 9, "C3", [512]],
+        [-1, 1, "Conv", [1024, 3, 2]],
+        [-1, 3, "C3", [1024]],
+        [-1, 1, "SPPF", [1024, 5]],
+    ],
+    "head": [
+        [-1, 1, "Conv", [512, 1, 1]],
+        [-1, 1, "nn.Upsample", [None, 2, "nearest"]],
+        [[-1, 6], 1, "Concat", [1]],
+        [-1, 3, "C3", [512, False]],
+        [-1, 1, "Conv", [256, 1, 1]],
+        [-1, 1, "nn.Upsample", [None, 2, "nearest"]],
+        [[-1, 4], 1, "Concat", [1]],
+        [-1, 3, "C3", [256, False]],
+        [-1, 1, "Conv", [256, 3, 2]],
+        [[-1, 14], 1, "Concat", [1]],
+        [-1, 3, "C3", [512, False]],
+        [-1, 1, "Conv", [512, 3, 2]],
+        [[-1, 10], 1, "Concat", [1]],
+        [-1, 3, "C3", [1024, False]],
+        [[17, 20, 23], 1, "Detect", ["nc", "anchors"]],
+    ],
+}
+
+
+def custom(path=None, autoshape=True, seed=0, **kwargs):
+    """
+    path is ignored, the weights are random (seeded, so runs are comparable)
+    """
+    import torch
+
+    if os.environ.get("YOLOV5_PATH"):
+        sys.path.insert(0, os.environ["YOLOV5_PATH"])
+        from models.common import AutoShape
+        from models.yolo import Model
+    else:
+        from yolov5.models.common import AutoShape
+        from yolov5.models.yolo import Model
+
+    torch.manual_seed(seed)
+    model = Model(dict(YOLOV5N), ch=3, nc=len(CLASS_NAMES))
+    model.names = list(CLASS_NAMES)
+    model.eval()
+    return AutoShape(model) if autoshape else model
@@ -0,0 +1,95 @@
+"""
+Cache of recent flower crops without detections, per node.
+
+Static cameras capture the same flower patch every few seconds, so many
+flower crops are nearly identical to one that was already run through the
+model. The crops are compared by a difference hash (dHash) of a small
+grayscale thumbnail; a crop within max_distance bits of a cached empty crop
+of the same node (and of similar size) reuses its empty result.
+"""
+
+import collections
+import threading
+import time
+
+from PIL import Image
+
+HASH_SIZE = 8
+
+
+def fingerprint(image, hash_size=HASH_SIZE):
+    """
+    Returns the difference hash of a PIL image as an int of hash_size**2
+    bits: whether each pixel of a (hash_size + 1) x hash_size grayscale
+    thumbnail is brighter than its right neighbour.
+    """
+    thumbnail = image.convert("L").resize((hash_size + 1, hash_size), Image.BOX)
+    pixels = thumbnail.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class EmptyCropCache:
+    """
+    max_distance: max number of differing hash bits (of 64) to reuse a result
+    ttl: seconds a crop stays cached after it was run through the model, hits
+    do not extend it, so an unchanged scene is checked by the model again
+    max_entries: crops cached per node, the least recently matched are evicted
+    size_tolerance: max relative difference of width and height
+    """
+
+    def __init__(self, max_distance=4, ttl=300, max_entries=32, size_tolerance=0.1):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.size_tolerance = size_tolerance
+        # node_id -> OrderedDict of fingerprint -> (width, height, expires)
+        self.nodes = {}
+        self.lock = threading.Lock()
+
+    def _similar_size(self, size, cached_size):
+        return all(
+            abs(a - b) <= self.size_tolerance * max(a, b)
+            for a, b in zip(size, cached_size)
+        )
+
+    def match(self, node_id, value, size, now=None):
+        """
+        Returns True if a cached empty crop of the node matches the
+        fingerprint value of a crop of size (width, height).
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entries = self.nodes.get(node_id)
+            if entries is None:
+                return False
+            for cached, (width, height, expires) in list(entries.items()):
+                if expires <= now:
+                    del entries[cached]
+                    continue
+                if hamming_distance(
+                    value, cached
+                ) <= self.max_distance and self._similar_size(size, (width, height)):
+                    entries.move_to_end(cached)
+                    return True
+            return False
+
+    def add(self, node_id, value, size, now=None):
+        """
+        Caches the fingerprint of a crop that had no detections.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entries = self.nodes.setdefault(node_id, collections.OrderedDict())
+            entries[value] = (size[0], size[1], now + self.ttl)
+            entries.move_to_end(value)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
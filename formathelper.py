@@ -0,0 +1,186 @@
+"""
+Serialization of result messages.
+
+Formats:
+    json:       the message as JSON, crops base64-encoded
+    msgpack:    the message as MessagePack, crops as raw JPEG bytes (requires msgpack)
+    cbor:       the message as CBOR, crops as raw JPEG bytes (requires cbor2)
+    multipart:  a JSON header followed by the raw JPEG crops:
+                    4 bytes header length (big endian) | header | crop data
+                in the header, each crop is replaced by [offset, length] of
+                its bytes in the crop data
+
+JSON is serialized and parsed with orjson if it is installed, with the
+standard library otherwise.
+
+Decode a stored result to JSON with:
+
+    python formathelper.py <file> [format]
+"""
+
+import base64
+import json
+import struct
+import sys
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FORMATS = ("json", "msgpack", "cbor", "multipart")
+CONTENT_TYPES = {
+    "json": "application/json",
+    "msgpack": "application/msgpack",
+    "cbor": "application/cbor",
+    "multipart": "application/vnd.pollinator.multipart",
+}
+FILE_EXTENSIONS = {
+    "json": ".json",
+    "msgpack": ".msgpack",
+    "cbor": ".cbor",
+    "multipart": ".multipart",
+}
+
+
+def dumps_json(obj):
+    """
+    Serializes obj to JSON bytes.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj).encode("utf-8")
+
+
+def loads_json(data):
+    """
+    Deserializes JSON from bytes, str or a buffer such as a memoryview of a
+    received frame, without copying it first if orjson is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def check_format(format):
+    if format not in FORMATS:
+        raise ValueError(
+            "Unknown format: {}, expected one of {}".format(format, FORMATS)
+        )
+    return format
+
+
+def encode_result(generator, format="json", save_crop=True):
+    """
+    Serializes the message of a MessageGenerator in the given format.
+    """
+    if format == "json":
+        message = generator.generate_message(save_crop=save_crop)
+        return dumps_json(message)
+    message = generator.generate_message(save_crop=save_crop, raw_crops=True)
+    if format == "msgpack":
+        import msgpack
+
+        return msgpack.packb(message)
+    if format == "cbor":
+        import cbor2
+
+        return cbor2.dumps(message)
+    if format == "multipart":
+        crop_data = []
+        offset = 0
+        for pollinator in message["detections"]["pollinators"]:
+            crop = pollinator["crop"]
+            if crop is not None:
+                pollinator["crop"] = [offset, len(crop)]
+                crop_data.append(crop)
+                offset += len(crop)
+        header = dumps_json(message)
+        return struct.pack(">I", len(header)) + header + b"".join(crop_data)
+    raise ValueError("Unknown format: {}".format(format))
+
+
+def decode_result(data, format="json"):
+    """
+    Deserializes a result. For the binary formats, crops are returned as
+    raw JPEG bytes, for json as base64 strings.
+    """
+    if format == "json":
+        return loads_json(data)
+    if format == "msgpack":
+        import msgpack
+
+        return msgpack.unpackb(data)
+    if format == "cbor":
+        import cbor2
+
+        return cbor2.loads(data)
+    if format == "multipart":
+        (header_length,) = struct.unpack(">I", data[:4])
+        message = loads_json(memoryview(data)[4 : 4 + header_length])
+        crop_data = memoryview(data)[4 + header_length :]
+        for pollinator in message["detections"]["pollinators"]:
+            if pollinator["crop"] is not None:
+                offset, length = pollinator["crop"]
+                pollinator["crop"] = bytes(crop_data[offset : offset + length])
+        return message
+    raise ValueError("Unknown format: {}".format(format))
+
+
+def join_payloads(payloads, format="json"):
+    """
+    Joins serialized results into a serialized array of results.
+    Returns None for formats without array support (multipart).
+    """
+    if format == "json":
+        return b"[" + b",".join(payloads) + b"]"
+    if format == "msgpack":
+        count = len(payloads)
+        if count < 16:
+            header = struct.pack(">B", 0x90 | count)
+        elif count < 2**16:
+            header = struct.pack(">BH", 0xDC, count)
+        else:
+            header = struct.pack(">BI", 0xDD, count)
+        return header + b"".join(payloads)
+    if format == "cbor":
+        count = len(payloads)
+        if count < 24:
+            header = struct.pack(">B", 0x80 | count)
+        elif count < 2**8:
+            header = struct.pack(">BB", 0x98, count)
+        elif count < 2**16:
+            header = struct.pack(">BH", 0x99, count)
+        else:
+            header = struct.pack(">BI", 0x9A, count)
+        return header + b"".join(payloads)
+    return None
+
+
+def to_json_message(message):
+    """
+    Converts a decoded result with raw crops to the JSON message layout.
+    """
+    for pollinator in message["detections"]["pollinators"]:
+        if isinstance(pollinator["crop"], (bytes, bytearray)):
+            pollinator["crop"] = base64.b64encode(pollinator["crop"]).decode("utf-8")
+    return message
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(1)
+    path = sys.argv[1]
+    if len(sys.argv) > 2:
+        format = check_format(sys.argv[2])
+    else:
+        format = "json"
+        for name, extension in FILE_EXTENSIONS.items():
+            if path.endswith(extension):
+                format = name
+    with open(path, "rb") as f:
+        message = decode_result(f.read(), format)
+    print(json.dumps(to_json_message(message), indent=4))
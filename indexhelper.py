@@ -0,0 +1,386 @@
+"""
+SQLite index of the stored results.
+
+Walks the output tree of the file output (one file per result, in any of
+the formats, or hourly segments) and records node, timestamp, flower and
+pollinator counts and the class and score of each detection. Queries by
+node, time range, class and score are answered from the index without
+reading the results. Re-indexing only reads files that are new or whose
+size or modification time changed; segments are append-only, so only the
+lines added since the last run are read.
+
+    python indexhelper.py update output
+    python indexhelper.py query output --node 3200-5030 --class hummel \\
+        --since 2022-07-01 --until 2022-07-08 --min-score 0.5
+
+The index is stored in <base_dir>/index.sqlite unless --index is given.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+from formathelper import FILE_EXTENSIONS, decode_result
+from storehelper import SEGMENT_EXTENSION
+
+log = logging.getLogger(__name__)
+log.propagate = False
+log.setLevel(logging.INFO)
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(
+    logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+)
+log.addHandler(handler)
+
+INDEX_FILENAME = "index.sqlite"
+FORMATS_BY_EXTENSION = {
+    extension: format for format, extension in FILE_EXTENSIONS.items()
+}
+COMMIT_INTERVAL = 500  # files
+
+
+def parse_timestamp(value):
+    """
+    Returns the UTC epoch seconds of an ISO 8601 timestamp, timestamps
+    without offset are UTC.
+    """
+    timestamp = datetime.datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp.timestamp()
+
+
+def format_timestamp(value):
+    return (
+        datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+        .replace(tzinfo=None)
+        .isoformat()
+    )
+
+
+def parse_filename(filename):
+    """
+    Returns the node id and UTC epoch seconds of a result filename
+    (<node_id>_<%Y-%m-%dT%H-%M-%SZ>.<extension>).
+    """
+    name = os.path.splitext(filename)[0]
+    node_id, timestamp = name.rsplit("_", 1)
+    timestamp = datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H-%M-%SZ")
+    return node_id, timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class ResultIndex:
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, "
+            "mtime_ns INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "indexed_size INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS results ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "path TEXT NOT NULL REFERENCES files (path) ON DELETE CASCADE, "
+            "offset INTEGER, "
+            "node_id TEXT NOT NULL, "
+            "timestamp REAL NOT NULL, "
+            "flowers INTEGER NOT NULL, "
+            "pollinators INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS detections ("
+            "result_id INTEGER NOT NULL REFERENCES results (id) ON DELETE CASCADE, "
+            "kind TEXT NOT NULL, "
+            "class_name TEXT NOT NULL, "
+            "score REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS results_path ON results (path);"
+            "CREATE INDEX IF NOT EXISTS results_node ON results (node_id, timestamp);"
+            "CREATE INDEX IF NOT EXISTS results_timestamp ON results (timestamp);"
+            "CREATE INDEX IF NOT EXISTS detections_result ON detections (result_id);"
+            "CREATE INDEX IF NOT EXISTS detections_class "
+            "ON detections (class_name, score);"
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, base_dir):
+        """
+        Indexes the new and changed result files under base_dir and removes
+        the files that no longer exist. Returns the number of files read.
+        """
+        known = {
+            path: (mtime_ns, size, indexed_size)
+            for path, mtime_ns, size, indexed_size in self.connection.execute(
+                "SELECT path, mtime_ns, size, indexed_size FROM files"
+            )
+        }
+        seen = set()
+        read = 0
+        for directory, dirnames, filenames in os.walk(base_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                extension = os.path.splitext(filename)[1]
+                if (
+                    extension != SEGMENT_EXTENSION
+                    and extension not in FORMATS_BY_EXTENSION
+                ):
+                    continue
+                path = os.path.relpath(os.path.join(directory, filename), base_dir)
+                seen.add(path)
+                stat = os.stat(os.path.join(base_dir, path))
+                previous = known.get(path)
+                if previous is not None and previous[:2] == (
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                ):
+                    continue
+                # a file that fails to index leaves no partial rows
+                self.connection.execute("SAVEPOINT file")
+                try:
+                    if extension == SEGMENT_EXTENSION:
+                        self._index_segment(base_dir, path, stat, previous)
+                    else:
+                        self._index_file(base_dir, path, stat)
+                except Exception as e:
+                    self.connection.execute("ROLLBACK TO file")
+                    self.connection.execute("RELEASE file")
+                    log.error("Indexing {} failed: {}".format(path, e))
+                    continue
+                self.connection.execute("RELEASE file")
+                read += 1
+                if read % COMMIT_INTERVAL == 0:
+                    self.connection.commit()
+        removed = [(path,) for path in known if path not in seen]
+        self.connection.executemany("DELETE FROM files WHERE path = ?", removed)
+        self.connection.commit()
+        log.info(
+            "Indexed {} new or changed files, removed {} files".format(
+                read, len(removed)
+            )
+        )
+        return read
+
+    def _set_file(self, path, stat, indexed_size):
+        self.connection.execute(
+            "INSERT INTO files (path, mtime_ns, size, indexed_size) "
+            "VALUES (?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET "
+            "mtime_ns = excluded.mtime_ns, size = excluded.size, "
+            "indexed_size = excluded.indexed_size",
+            (path, stat.st_mtime_ns, stat.st_size, indexed_size),
+        )
+
+    def _index_file(self, base_dir, path, stat):
+        format = FORMATS_BY_EXTENSION[os.path.splitext(path)[1]]
+        with open(os.path.join(base_dir, path), "rb") as f:
+            message = decode_result(f.read(), format)
+        node_id, timestamp = parse_filename(os.path.basename(path))
+        self.connection.execute("DELETE FROM results WHERE path = ?", (path,))
+        self._set_file(path, stat, stat.st_size)
+        self._add_result(path, None, node_id, timestamp, message)
+
+    def _index_segment(self, base_dir, path, stat, previous):
+        """
+        Indexes the lines appended since the last run, or the whole segment
+        if it shrank. A partial last line is indexed on the next run.
+        """
+        start = 0
+        if previous is not None and previous[2] <= stat.st_size:
+            start = previous[2]
+        else:
+            self.connection.execute("DELETE FROM results WHERE path = ?", (path,))
+        offset = start
+        self._set_file(path, stat, start)
+        with open(os.path.join(base_dir, path), "rb") as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                self._add_result(
+                    path,
+                    offset,
+                    record["node_id"],
+                    parse_timestamp(record["timestamp"]),
+                    record,
+                )
+                offset += len(line)
+        self._set_file(path, stat, offset)
+
+    def _add_result(self, path, offset, node_id, timestamp, message):
+        flowers = message["detections"]["flowers"]
+        pollinators = message["detections"]["pollinators"]
+        result_id = self.connection.execute(
+            "INSERT INTO results "
+            "(path, offset, node_id, timestamp, flowers, pollinators) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (path, offset, node_id, timestamp, len(flowers), len(pollinators)),
+        ).lastrowid
+        self.connection.executemany(
+            "INSERT INTO detections (result_id, kind, class_name, score) "
+            "VALUES (?, ?, ?, ?)",
+            [(result_id, "flower", d["class_name"], d["score"]) for d in flowers]
+            + [
+                (result_id, "pollinator", d["class_name"], d["score"])
+                for d in pollinators
+            ],
+        )
+
+    def query(
+        self,
+        node_id=None,
+        since=None,
+        until=None,
+        class_name=None,
+        min_score=None,
+        kind=None,
+        limit=None,
+    ):
+        """
+        Returns the results matching all given conditions, ordered by
+        timestamp, as dicts with path, offset (of the line in a segment),
+        node_id, timestamp (UTC epoch seconds), flowers, pollinators and
+        classes (class name -> number of detections of the result).
+        since, until: UTC epoch seconds, until is exclusive
+        class_name, min_score, kind: the result has a detection of the
+        class, with at least the score, of the kind (flower or pollinator)
+        """
+        conditions = []
+        params = []
+        if node_id is not None:
+            conditions.append("r.node_id = ?")
+            params.append(node_id)
+        if since is not None:
+            conditions.append("r.timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("r.timestamp < ?")
+            params.append(until)
+        detection_conditions = []
+        if class_name is not None:
+            detection_conditions.append("d.class_name = ?")
+            params.append(class_name)
+        if min_score is not None:
+            detection_conditions.append("d.score >= ?")
+            params.append(min_score)
+        if kind is not None:
+            detection_conditions.append("d.kind = ?")
+            params.append(kind)
+        if detection_conditions:
+            conditions.append(
+                "EXISTS (SELECT 1 FROM detections d WHERE d.result_id = r.id AND "
+                + " AND ".join(detection_conditions)
+                + ")"
+            )
+        sql = (
+            "SELECT r.id, r.path, r.offset, r.node_id, r.timestamp, r.flowers, "
+            "r.pollinators FROM results r"
+        )
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY r.timestamp, r.id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        results = []
+        for row in self.connection.execute(sql, params).fetchall():
+            classes = dict(
+                self.connection.execute(
+                    "SELECT class_name, COUNT(*) FROM detections WHERE result_id = ? "
+                    "GROUP BY class_name ORDER BY class_name",
+                    (row[0],),
+                ).fetchall()
+            )
+            results.append(
+                {
+                    "path": row[1],
+                    "offset": row[2],
+                    "node_id": row[3],
+                    "timestamp": row[4],
+                    "flowers": row[5],
+                    "pollinators": row[6],
+                    "classes": classes,
+                }
+            )
+        return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index and query stored results")
+    parser.add_argument("command", choices=("update", "query"))
+    parser.add_argument("base_dir", help="base_dir of the file output")
+    parser.add_argument(
+        "--index", help="index database, default: <base_dir>/" + INDEX_FILENAME
+    )
+    parser.add_argument(
+        "--no-update",
+        action="store_true",
+        help="query without indexing new files first",
+    )
+    parser.add_argument("--node", help="node id")
+    parser.add_argument("--since", help="start of the time range (ISO 8601, UTC)")
+    parser.add_argument("--until", help="end of the time range, exclusive")
+    parser.add_argument(
+        "--class", dest="class_name", help="with a detection of this class"
+    )
+    parser.add_argument(
+        "--min-score", type=float, help="with a detection of at least this score"
+    )
+    parser.add_argument("--kind", choices=("flower", "pollinator"))
+    parser.add_argument("--limit", type=int)
+    parser.add_argument(
+        "--json", action="store_true", help="print the results as JSON lines"
+    )
+    args = parser.parse_args(argv)
+    if args.command == "query":
+        # keep the output parseable
+        log.setLevel(logging.WARNING)
+
+    index = ResultIndex(args.index or os.path.join(args.base_dir, INDEX_FILENAME))
+    try:
+        if args.command == "update" or not args.no_update:
+            index.update(args.base_dir)
+        if args.command == "update":
+            return
+        results = index.query(
+            node_id=args.node,
+            since=parse_timestamp(args.since) if args.since else None,
+            until=parse_timestamp(args.until) if args.until else None,
+            class_name=args.class_name,
+            min_score=args.min_score,
+            kind=args.kind,
+            limit=args.limit,
+        )
+    finally:
+        index.close()
+    for result in results:
+        result["timestamp"] = format_timestamp(result["timestamp"])
+        if args.json:
+            print(json.dumps(result))
+            continue
+        location = result["path"]
+        if result["offset"] is not None:
+            location += ":{}".format(result["offset"])
+        print(
+            "{} {} flowers: {} pollinators: {} {} {}".format(
+                result["timestamp"],
+                result["node_id"],
+                result["flowers"],
+                result["pollinators"],
+                ",".join(
+                    "{}={}".format(name, count)
+                    for name, count in result["classes"].items()
+                ),
+                location,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,7 @@
+import time
+
+START_TIME = time.time()
+
 import logging
 import sys
 
@@ -13,27 +17,44 @@ log.addHandler(handler)
 logging.basicConfig(level=logging.INFO)
 
 
-import zmq
-import time
 import os
-from PIL import Image
-import base64
 import yaml
 import argparse
 from yolomodelhelper import YoloModel
-from messagehelper import (
-    MessageParser,
-    Flower,
-    Pollinator,
-    MessageGenerator,
-    MQTTClient,
-    HTTPClient,
-)
+from messagehelper import MQTTClient, HTTPClient
+from zmqhelper import ZMQInputClient
+from outboxhelper import Outbox, OutboxSender
+from pipelinehelper import RecordProcessor, Record, Pipeline, WorkerPool
+from metricshelper import BACKLOG, MetricsLogger, MetricsServer
+from profilerhelper import Profiler
+from cropcachehelper import EmptyCropCache
+from storehelper import SegmentStore, check_layout
+from reprocesshelper import Reprocessor
+import atexit
+import signal
 import socket
-from tqdm import tqdm
 
 argparser = argparse.ArgumentParser(description="ZMQ Message Queue")
 argparser.add_argument("--config", type=str, default="config.yaml", help="config file")
+argparser.add_argument(
+    "--workers",
+    type=int,
+    default=None,
+    help="number of inference processes (overrides pipeline.workers)",
+)
+argparser.add_argument(
+    "--reprocess",
+    type=str,
+    default=None,
+    help="process the stored input messages of a directory, tar or zip archive "
+    "instead of the queue, with at least 2 workers unless --workers is given",
+)
+argparser.add_argument(
+    "--checkpoint",
+    type=str,
+    default=None,
+    help="checkpoint file of --reprocess, default: <path>.checkpoint.json",
+)
 args = argparser.parse_args()
 # parse yaml configuration file
 with open(args.config, "r") as stream:
@@ -59,31 +80,124 @@ MAX_DETECTIONS = model_config.get("max_detections", 10)
 CLASS_NAMES = model_config.get("class_names")
 AUGMENT = model_config.get("augment", False)
 IMAGE_SIZE = model_config.get("image_size", 640)
+INPUT_SIZES = model_config.get("input_sizes")
+mosaic_config = model_config.get("mosaic") or {}
+MOSAIC_ENABLED = mosaic_config.get("enabled", False)
+MOSAIC_MAX_CROP_SIZE = mosaic_config.get("max_crop_size")
+MOSAIC_GAP = mosaic_config.get("gap", 16)
+MOSAIC_SIZE = mosaic_config.get("size", max(INPUT_SIZES or [IMAGE_SIZE]))
+crop_cache_config = model_config.get("crop_cache") or {}
+CROP_CACHE_ENABLED = crop_cache_config.get("enabled", False)
+CROP_CACHE_MAX_DISTANCE = crop_cache_config.get("max_distance", 4)
+CROP_CACHE_TTL = crop_cache_config.get("ttl", 300)
+CROP_CACHE_MAX_ENTRIES = crop_cache_config.get("max_entries", 32)
+MAX_BATCH_SIZE = model_config.get("max_batch_size", 8)
+MAX_BATCH_PADDING = model_config.get("max_batch_padding", 64)
+REDUCED_DECODE = model_config.get("reduced_decode", False)
+STREAMING_DECODE = model_config.get("streaming_decode", False)
+BACKEND = model_config.get("backend", "torch")
+ONNX_QUANTIZE = model_config.get("onnx_quantize", False)
+NUM_THREADS = model_config.get("num_threads")
+CACHE_DIR = model_config.get("cache_dir")
+WARMUP = model_config.get("warmup", True)
 
 # Input configuration (zmq)
 zmq_config = config.get("zmq")
 ZMQ_HOST = zmq_config.get("host")
 ZMQ_PORT = zmq_config.get("port")
 ZMQ_REQ_TIMEOUT = zmq_config.get("request_timeout", 3000)
-ZMQ_REQ_RETRIES = zmq_config.get("request_retries", 10)
-
-
+ZMQ_PREFETCH = zmq_config.get("prefetch", 2)
+ZMQ_BACKOFF_MIN = zmq_config.get("backoff_min", 0.1)
+ZMQ_BACKOFF_MAX = zmq_config.get("backoff_max", 5.0)
+
+# Pipeline configuration
+pipeline_config = config.get("pipeline") or {}
+PIPELINE_ENABLED = pipeline_config.get("enabled", False)
+PIPELINE_DECODE_THREADS = pipeline_config.get("decode_threads", 2)
+PIPELINE_ENCODE_THREADS = pipeline_config.get("encode_threads", 2)
+PIPELINE_QUEUE_SIZE = pipeline_config.get("queue_size", 4)
+PIPELINE_WORKERS = pipeline_config.get("workers", 1)
+if args.workers is not None:
+    PIPELINE_WORKERS = args.workers
+elif args.reprocess is not None:
+    PIPELINE_WORKERS = max(PIPELINE_WORKERS, 2)
+PIPELINE_WORKER_THREADS = pipeline_config.get("worker_threads")
+
+# Metrics configuration
+metrics_config = config.get("metrics") or {}
+METRICS_ENABLED = metrics_config.get("enabled", False)
+METRICS_HOST = metrics_config.get("host", "127.0.0.1")
+METRICS_PORT = metrics_config.get("port", 9100)
+METRICS_LOG_INTERVAL = metrics_config.get("log_interval", 60)
+
+# Profiling configuration
+profiling_config = config.get("profiling") or {}
+PROFILING_DIR = profiling_config.get("directory", "profiles")
+PROFILING_ENGINE = profiling_config.get("engine", "cprofile")
+PROFILING_RECORDS = profiling_config.get("records", 10)
+PROFILING_EVERY = profiling_config.get("every", 0)
+PROFILING_AT_START = profiling_config.get("at_start", False)
 
 # Output configuration
 output_config = config.get("output")
 IGNORE_EMPTY_RESULTS = output_config.get("ignore_empty_results", False)
+CROP_ENCODE_THREADS = output_config.get("crop_encode_threads", 2)
+CROP_RESOLUTION = output_config.get("crop_resolution", "full")
+
+# Output configuration (Outbox)
+OUTBOX_ENABLED = False
+outbox = None
+if output_config.get("outbox") is not None:
+    output_config_outbox = output_config.get("outbox")
+    if output_config_outbox.get("enabled", False):
+        OUTBOX_ENABLED = True
+        OUTBOX_PATH = output_config_outbox.get("path", "outbox.sqlite")
+        OUTBOX_MAX_SIZE = output_config_outbox.get("max_size", 500)
+        OUTBOX_MAX_AGE = output_config_outbox.get("max_age", 72)
+        OUTBOX_BATCH_SIZE = output_config_outbox.get("batch_size", 20)
+        OUTBOX_MAX_ATTEMPTS = output_config_outbox.get("max_attempts", 10)
+        OUTBOX_DRAIN_TIMEOUT = output_config_outbox.get("drain_timeout", 600)
+        log.info(
+            "Outbox is enabled, path: {}, max_size: {}MB, max_age: {}h".format(
+                OUTBOX_PATH, OUTBOX_MAX_SIZE, OUTBOX_MAX_AGE
+            )
+        )
+        outbox = Outbox(
+            OUTBOX_PATH,
+            max_size=OUTBOX_MAX_SIZE,
+            max_age=OUTBOX_MAX_AGE,
+            max_attempts=OUTBOX_MAX_ATTEMPTS,
+        )
 
 # Output configuration (File)
 STORE_FILE = False
 BASE_DIR = "output"
 SAVE_CROPS = True
+FILE_FORMAT = "json"
+FILE_LAYOUT = "files"
+FILE_FSYNC_RECORDS = 100
+FILE_FSYNC_INTERVAL = 5
 if output_config.get("file") is not None:
     output_config_file = output_config.get("file")
     if output_config_file.get("store_file", False):
         STORE_FILE = True
         BASE_DIR = output_config_file.get("base_dir", "output")
         SAVE_CROPS = output_config_file.get("save_crops", True)
-        log.info("store_file is enabled, base_dir: {}".format(BASE_DIR))
+        FILE_FORMAT = output_config_file.get("format", "json")
+        FILE_LAYOUT = check_layout(output_config_file.get("layout", "files"))
+        FILE_FSYNC_RECORDS = output_config_file.get("fsync_records", 100)
+        FILE_FSYNC_INTERVAL = output_config_file.get("fsync_interval", 5)
+        log.info(
+            "store_file is enabled, base_dir: {}, layout: {}".format(
+                BASE_DIR, FILE_LAYOUT
+            )
+        )
+        if FILE_LAYOUT == "segments" and FILE_FORMAT != "json":
+            log.warning(
+                "Segments are always stored as JSON lines, ignoring format: {}".format(
+                    FILE_FORMAT
+                )
+            )
 
 # Output configuration (MQTT)
 TRANSMIT_MQTT = False
@@ -100,13 +214,26 @@ if output_config.get("mqtt") is not None:
         mqtt_username = output_config_mqtt.get("username")
         mqtt_password = output_config_mqtt.get("password")
         mqtt_use_tls = output_config_mqtt.get("use_tls", mqtt_port == 8883)
+        mqtt_qos = output_config_mqtt.get("qos", 1)
+        mqtt_max_inflight = output_config_mqtt.get("max_inflight", 20)
+        mqtt_max_queued = output_config_mqtt.get("max_queued", 100)
+        mqtt_format = output_config_mqtt.get("format", "json")
         log.info(
             "MQTT host: {}, port: {}, topic: {}, username {} use_tls: {}".format(
                 mqtt_host, mqtt_port, mqtt_topic, mqtt_username, mqtt_use_tls
             )
         )
         mclient = MQTTClient(
-            mqtt_host, mqtt_port, mqtt_topic, mqtt_username, mqtt_password, mqtt_use_tls
+            mqtt_host,
+            mqtt_port,
+            mqtt_topic,
+            mqtt_username,
+            mqtt_password,
+            mqtt_use_tls,
+            qos=mqtt_qos,
+            max_inflight=mqtt_max_inflight,
+            max_queued=mqtt_max_queued,
+            format=mqtt_format,
         )
 
 # Output configuration (HTTP)
@@ -122,59 +249,55 @@ if output_config.get("http") is not None:
         http_username = output_config_http.get("username")
         http_password = output_config_http.get("password")
         http_method = output_config_http.get("method", "POST")
+        http_compression = output_config_http.get("compression")
+        http_connect_timeout = output_config_http.get("connect_timeout", 5)
+        http_read_timeout = output_config_http.get("read_timeout", 30)
+        http_retries = output_config_http.get("retries", 3)
+        http_batch_size = output_config_http.get("batch_size", 1)
+        http_batch_interval = output_config_http.get("batch_interval", 1000)
+        http_format = output_config_http.get("format", "json")
         log.info(
             "HTTP url: {}, method: {}, username: {}".format(
                 http_url, http_method, http_username
             )
         )
-        hclient = HTTPClient(http_url, http_username, http_password, http_method)
-
-context = zmq.Context().instance()
-log.info("Connecting to ZMQ server on tcp://{}:{}".format(ZMQ_HOST, ZMQ_PORT))
-client = context.socket(zmq.REQ)
-client.connect("tcp://{}:{}".format(ZMQ_HOST, ZMQ_PORT))
-
-
-def request_message(code, client):
-    """
-    request codes:
-        0: get first message
-        1: get first message and remove it from queue
-        2: remove first message from queue
-    response:
-        dict with message or
-        response codes:
-            0: no data available
-            1: first message removed from queue
-    """
-    log.info("Sending request with code 1".format(code))
-    client.send_json(code)
-    retries_left = ZMQ_REQ_RETRIES
-    while True:
-        if (client.poll(ZMQ_REQ_TIMEOUT) & zmq.POLLIN) != 0:
-            reply = client.recv_json()
-
-            # print("Server replied (%s)", type(reply))
-            return reply
-        retries_left -= 1
-        log.warning("No response from server")
-        client.setsockopt(zmq.LINGER, 0)
-        client.close()
-
-        if retries_left == 0:
-            log.error("Server seems to be offline, abandoning")
-            exit(1)
-        log.info("Reconnecting to server…")
-        # Create new connection
-        client = context.socket(zmq.REQ)
-        client.connect("tcp://{}:{}".format(ZMQ_HOST, ZMQ_PORT))
-
-        log.info("Resending code {}".format(code))
-        client.send_json(code)
-
-
-parser = MessageParser()
-
+        hclient = HTTPClient(
+            http_url,
+            http_username,
+            http_password,
+            http_method,
+            compression=http_compression,
+            timeout=(http_connect_timeout, http_read_timeout),
+            retries=http_retries,
+            batch_size=http_batch_size,
+            batch_interval=http_batch_interval,
+            format=http_format,
+        )
+        if http_batch_size > 1 and not OUTBOX_ENABLED:
+            log.warning(
+                "HTTP batches are sent without the outbox, results of failed "
+                "batches are not retried"
+            )
+        # results collected for the next batch are sent before exiting
+        atexit.register(hclient.flush)
+
+outbox_senders = []
+if OUTBOX_ENABLED:
+    if mclient is not None:
+        outbox_senders.append(
+            OutboxSender(
+                outbox,
+                "mqtt",
+                mclient.send_entries,
+                batch_size=min(OUTBOX_BATCH_SIZE, mqtt_max_inflight),
+            )
+        )
+    if hclient is not None:
+        outbox_senders.append(
+            OutboxSender(
+                outbox, "http", hclient.send_entries, batch_size=OUTBOX_BATCH_SIZE
+            )
+        )
 
 model = YoloModel(
     WEIGHTS_PATH,
@@ -187,86 +310,200 @@ model = YoloModel(
     class_names=CLASS_NAMES,
     augment=AUGMENT,
     max_det=MAX_DETECTIONS,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_batch_padding=MAX_BATCH_PADDING,
+    backend=BACKEND,
+    onnx_quantize=ONNX_QUANTIZE,
+    num_threads=NUM_THREADS,
+    cache_dir=CACHE_DIR,
+    mosaic=MOSAIC_ENABLED,
+    mosaic_max_crop_size=MOSAIC_MAX_CROP_SIZE,
+    mosaic_gap=MOSAIC_GAP,
+    mosaic_size=MOSAIC_SIZE,
+)
+if INPUT_SIZES and model.fixed_input_shape is not None:
+    log.warning(
+        "The model has a fixed input shape {}, ignoring input_sizes".format(
+            model.fixed_input_shape
+        )
+    )
+    INPUT_SIZES = None
+if WARMUP:
+    model.warmup(
+        sorted({model.align_input_size(size) for size in INPUT_SIZES or [IMAGE_SIZE]})
+    )
+model.startup_time = round(time.time() - START_TIME, 3)
+log.info(
+    "Model ready {:.2f}s after start (load: {:.2f}s, warm-up: {:.2f}s)".format(
+        model.startup_time, model.load_time, model.warmup_time or 0
+    )
 )
 
+profiler = Profiler(
+    PROFILING_DIR,
+    engine=PROFILING_ENGINE,
+    records=PROFILING_RECORDS,
+    every=PROFILING_EVERY,
+)
+if PROFILING_AT_START:
+    profiler.request()
+if hasattr(signal, "SIGUSR1"):
+    # kill -USR1 <pid> profiles the next records
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.request())
+
+
+def exit_on_sigterm(signum, frame):
+    # exit on SIGTERM (systemctl stop) through the atexit handlers, a second
+    # SIGTERM (e.g. sent to the process group) must not interrupt them
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
+
+signal.signal(signal.SIGTERM, exit_on_sigterm)
+
+crop_cache = None
+if CROP_CACHE_ENABLED:
+    crop_cache = EmptyCropCache(
+        max_distance=CROP_CACHE_MAX_DISTANCE,
+        ttl=CROP_CACHE_TTL,
+        max_entries=CROP_CACHE_MAX_ENTRIES,
+    )
+
+file_store = None
+if STORE_FILE and FILE_LAYOUT == "segments":
+    file_store = SegmentStore(
+        BASE_DIR,
+        save_crops=SAVE_CROPS,
+        fsync_records=FILE_FSYNC_RECORDS,
+        fsync_interval=FILE_FSYNC_INTERVAL,
+    )
+    atexit.register(file_store.close)
+
+processor = RecordProcessor(
+    model,
+    image_size=IMAGE_SIZE,
+    input_sizes=INPUT_SIZES,
+    crop_cache=crop_cache,
+    reduced_decode=REDUCED_DECODE,
+    streaming_decode=STREAMING_DECODE,
+    full_resolution_crops=CROP_RESOLUTION == "full",
+    hostname=HOSTNAME,
+    ignore_empty_results=IGNORE_EMPTY_RESULTS,
+    store_file=STORE_FILE,
+    base_dir=BASE_DIR,
+    save_crops=SAVE_CROPS,
+    file_format=FILE_FORMAT,
+    file_store=file_store,
+    mqtt_client=mclient,
+    http_client=hclient,
+    outbox=outbox,
+    crop_encode_threads=CROP_ENCODE_THREADS,
+    profiler=profiler,
+)
 
-while True:
-    msg = request_message(1, client)  # get first message, remove it from queue
-    if type(msg) == dict:
-        message_ok = parser.parse_message(msg)
-        if message_ok:
-            generator = MessageGenerator()
-            generator.set_timestamp(parser.timestamp)
-            generator.set_node_id(parser.node_id)
-            # parser.print_detections()
-            log.info(
-                "Got data from {}, recorded at {}, contains {} flowers".format(
-                    parser.node_id, parser.timestamp, parser.num_detections
-                )
+
+reprocessor = None
+input_client = None
+if args.reprocess is not None:
+    reprocessor = Reprocessor(args.reprocess, checkpoint_path=args.checkpoint)
+    fetch = reprocessor.fetch
+    done = reprocessor.done
+else:
+    input_client = ZMQInputClient(
+        ZMQ_HOST,
+        ZMQ_PORT,
+        prefetch=ZMQ_PREFETCH,
+        request_timeout=ZMQ_REQ_TIMEOUT,
+        backoff_min=ZMQ_BACKOFF_MIN,
+        backoff_max=ZMQ_BACKOFF_MAX,
+        decode_records=not STREAMING_DECODE,
+    )
+    BACKLOG.labels("input").set_function(input_client.buffer.qsize)
+    fetch = input_client.get
+    done = None
+
+pool = None
+if PIPELINE_WORKERS > 1:
+    log.info(
+        "Worker pool enabled, workers: {}, threads per worker: {}".format(
+            PIPELINE_WORKERS, PIPELINE_WORKER_THREADS or "auto"
+        )
+    )
+    # forked before any of the threads below are started
+    pool = WorkerPool(
+        processor,
+        fetch,
+        workers=PIPELINE_WORKERS,
+        threads_per_worker=PIPELINE_WORKER_THREADS,
+        queue_size=PIPELINE_QUEUE_SIZE,
+        done=done,
+    ).start_workers()
+
+for client in (mclient, hclient, file_store, input_client):
+    if client is not None:
+        client.start()
+for sender in outbox_senders:
+    sender.start()
+if outbox is not None:
+    for sink, client in (("mqtt", mclient), ("http", hclient)):
+        if client is not None:
+            BACKLOG.labels("outbox_" + sink).set_function(
+                lambda sink=sink: outbox.count(sink)
             )
-            model.reset_inference_times()
-
-            if parser.num_detections > 0:
-                pollinator_index = 0
-
-                for flower_index in tqdm(range(len(parser.images))):
-                    image = parser.images[flower_index]
-                    width, height = image.size
-                    flower_obj = Flower(
-                        index=flower_index,
-                        class_name=parser.classes[flower_index],
-                        score=parser.scores[flower_index],
-                        width=width,
-                        height=height,
-                    )
-                    generator.add_flower(flower_obj)
-                    res = model.predict(image, IMAGE_SIZE)
-                    crops = model.get_crops()
-                    boxes = model.get_boxes()
-                    classes = model.get_classes()
-                    scores = model.get_scores()
-                    names = model.get_names()
-
-                    pollinator_indexes = model.get_indexes()
-                    # log.info("pollinator_indexes: {}".format(pollinator_indexes))
-                    for detection in range(len(crops)):
-                        idx = pollinator_index + pollinator_indexes[detection]
-                        crop_image = Image.fromarray(crops[detection])
-                        width, height = crop_image.size
-
-                        pollinator_obj = Pollinator(
-                            index=idx,
-                            flower_index=flower_index,
-                            class_name=names[detection],
-                            score=scores[detection],
-                            width=width,
-                            height=height,
-                            crop=crop_image,
-                        )
-                        generator.add_pollinator(pollinator_obj)
-                    if len(pollinator_indexes) > 0:
-                        pollinator_index += max(pollinator_indexes) + 1
-                log.info(
-                    "Inference times [total, avg]: {}".format(model.get_inference_times())
+if METRICS_ENABLED:
+    MetricsServer(METRICS_HOST, METRICS_PORT).start()
+if METRICS_LOG_INTERVAL:
+    MetricsLogger(METRICS_LOG_INTERVAL).start()
+
+if pool is not None:
+    pool.run()
+elif PIPELINE_ENABLED:
+    log.info(
+        "Pipeline enabled, decode_threads: {}, encode_threads: {}, queue_size: {}".format(
+            PIPELINE_DECODE_THREADS, PIPELINE_ENCODE_THREADS, PIPELINE_QUEUE_SIZE
+        )
+    )
+    Pipeline(
+        processor,
+        fetch,
+        decode_threads=PIPELINE_DECODE_THREADS,
+        encode_threads=PIPELINE_ENCODE_THREADS,
+        queue_size=PIPELINE_QUEUE_SIZE,
+        done=done,
+    ).run()
+else:
+    seq = 0
+    while True:
+        raw = fetch()
+        if raw is None:
+            break
+        record = Record(seq=seq, raw=raw)
+        try:
+            processor.process(record)
+        except Exception as e:
+            if reprocessor is None:
+                raise
+            log.error("Record {} failed: {}".format(seq, e))
+        if done is not None:
+            done(record)
+        seq += 1
+
+# the input of --reprocess ended
+reprocessor.close()
+if hclient is not None:
+    # before waiting for the outbox, not only at exit
+    hclient.flush()
+if outbox is not None:
+    drain_deadline = time.monotonic() + OUTBOX_DRAIN_TIMEOUT
+    while outbox.count() > 0:
+        if time.monotonic() >= drain_deadline:
+            log.warning(
+                "{} outbox entries not delivered within {}s, they are kept in {}".format(
+                    outbox.count(), OUTBOX_DRAIN_TIMEOUT, OUTBOX_PATH
                 )
-            pollinator_inference_meta = model.get_metadata()
-            metadata = parser.get_metadata()
-            metadata["pollinator_inference"] = pollinator_inference_meta
-            generator.set_metadata(metadata)
-
-
-            if IGNORE_EMPTY_RESULTS and len(generator.pollinators) == 0:
-                log.info("No pollinators detected, skipping")
-                continue
-            res_msg = generator.generate_message()
-            if STORE_FILE:
-                generator.store_message(BASE_DIR, SAVE_CROPS)
-            if TRANSMIT_MQTT:
-                mclient.publish(res_msg, filename=generator.generate_filename(), node_id = parser.node_id, hostname=HOSTNAME)
-            if TRANSMIT_HTTP:
-                hclient.send_message(res_msg, filename=generator.generate_filename(), node_id = parser.node_id, hostname=HOSTNAME)
-
-    elif type(msg) == int:
-        if msg == 0:  # no data available
-            log.info("No data available")
-            time.sleep(5)
+            )
+            break
+        log.info("Waiting for the delivery of {} outbox entries".format(outbox.count()))
+        time.sleep(min(10, max(drain_deadline - time.monotonic(), 0)))
+if mclient is not None:
+    mclient.close()
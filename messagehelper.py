@@ -3,13 +3,27 @@ import datetime
 from PIL import Image
 from io import BytesIO
 import base64
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import os
 import sys
+import math
+import re
 
 import logging
 import ssl
-import requests
+import gzip
+import threading
+import time
+from formathelper import (
+    FILE_EXTENSIONS,
+    CONTENT_TYPES,
+    check_format,
+    dumps_json,
+    encode_result,
+    join_payloads,
+    loads_json,
+)
+from metricshelper import SINK_ERRORS
 
 log = logging.getLogger(__name__)
 log.propagate = False
@@ -21,6 +35,120 @@ handler.setFormatter(
 log.addHandler(handler)
 
 DECIMALS_TO_ROUND = 3
+# the streaming parser works on the UTF-8 bytes of a message (bytes or a
+# memoryview of a received frame), JSON structure characters are ASCII
+JSON_WHITESPACE = re.compile(rb"[ \t\n\r]*")
+JSON_STRUCTURE = re.compile(rb'["\[\]{}]')
+JSON_QUOTE = re.compile(rb'"')
+JSON_SCALAR_END = re.compile(rb"[ \t\n\r,\]}]")
+JSON_ESCAPE = re.compile(rb"\\")
+BACKSLASH = ord("\\")
+
+
+def _skip_whitespace(data, index):
+    return JSON_WHITESPACE.match(data, index).end()
+
+
+def _expect(data, index, char):
+    index = _skip_whitespace(data, index)
+    if data[index : index + 1] != char:
+        raise ValueError("Expected {!r} at position {}".format(char, index))
+    return index + 1
+
+
+def _string_end(data, index):
+    """
+    Returns the index of the quote closing the JSON string whose content
+    starts at index.
+    """
+    while True:
+        match = JSON_QUOTE.search(data, index)
+        if match is None:
+            raise ValueError("Unterminated JSON string")
+        end = match.start()
+        backslashes = 0
+        while data[end - 1 - backslashes] == BACKSLASH:
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return end
+        index = end + 1
+
+
+def _skip_value(data, index):
+    """
+    Returns the index after the JSON value starting at index, without
+    decoding it.
+    """
+    index = _skip_whitespace(data, index)
+    if data[index : index + 1] not in (b"[", b"{", b'"'):
+        match = JSON_SCALAR_END.search(data, index)
+        return len(data) if match is None else match.start()
+    depth = 0
+    while True:
+        match = JSON_STRUCTURE.search(data, index)
+        if match is None:
+            raise ValueError("Unterminated JSON value")
+        char = data[match.start()]
+        index = match.end()
+        if char == ord('"'):
+            index = _string_end(data, index) + 1
+        elif char in b"[{":
+            depth += 1
+        else:
+            depth -= 1
+        if depth == 0:
+            return index
+
+
+def _decode_value(data, index):
+    """
+    Decodes the JSON value starting at index as loads_json does, only its
+    bytes are copied.
+    """
+    index = _skip_whitespace(data, index)
+    return loads_json(data[index : _skip_value(data, index)])
+
+
+def _check_members(data, members, skipped):
+    """
+    Decodes the members of an object that are not read otherwise, except
+    those in skipped, so that a malformed value fails as with loads_json.
+    """
+    for key, index in members.items():
+        if key not in skipped:
+            _decode_value(data, index)
+
+
+def _string_bytes(data, index):
+    """
+    Returns the content of the JSON string starting at index as a slice of
+    data (no copy for a memoryview), decoded only if it contains escapes.
+    """
+    start = _expect(data, index, b'"')
+    end = _string_end(data, start)
+    if JSON_ESCAPE.search(data, start, end) is not None:
+        return _decode_value(data, index)
+    return data[start:end]
+
+
+def _object_members(data, index):
+    """
+    Returns {key: index of the value} of the JSON object starting at index,
+    without decoding the values, and the index after the object.
+    """
+    members = {}
+    index = _skip_whitespace(data, _expect(data, index, b"{"))
+    if data[index : index + 1] == b"}":
+        return members, index + 1
+    while True:
+        key = _decode_value(data, index)
+        index = _skip_value(data, index)
+        index = _skip_whitespace(data, _expect(data, index, b":"))
+        members[key] = index
+        index = _skip_whitespace(data, _skip_value(data, index))
+        if data[index : index + 1] == b"}":
+            return members, index + 1
+        index = _expect(data, index, b",")
 
 
 @dataclass
@@ -49,9 +177,26 @@ class Pollinator:
     width: int
     height: int
     crop: Image
-
-    def to_dict(self, save_crop=True):
-
+    # inference size of the flower crop, set with adaptive input sizes
+    input_size: int = None
+    crop_jpeg: bytes = field(default=None, repr=False)
+    crop_b64: str = field(default=None, repr=False)
+
+    def encode_crop(self):
+        """
+        Encodes the crop to JPEG and base64, only on the first call.
+        """
+        if self.crop_jpeg is None:
+            bio = BytesIO()
+            self.crop.save(bio, format="JPEG")
+            self.crop_jpeg = bio.getvalue()
+            self.crop_b64 = base64.b64encode(self.crop_jpeg).decode("utf-8")
+        return self.crop_jpeg
+
+    def to_dict(self, save_crop=True, raw_crop=False):
+        """
+        raw_crop: add the crop as JPEG bytes instead of a base64 string
+        """
         pollintor_dict = {
             "index": self.index,
             "flower_index": self.flower_index,
@@ -59,20 +204,39 @@ class Pollinator:
             "score": round(self.score, DECIMALS_TO_ROUND),
             "crop": None,
         }
+        if self.input_size is not None:
+            pollintor_dict["input_size"] = self.input_size
         if save_crop:
-            bio = BytesIO()
-            self.crop.save(bio, format="JPEG")
-            bio.seek(0)
-            encoded_image = base64.b64encode(bio.read()).decode("utf-8")
-            pollintor_dict["crop"] = encoded_image
+            self.encode_crop()
+            if raw_crop:
+                pollintor_dict["crop"] = self.crop_jpeg
+            else:
+                pollintor_dict["crop"] = self.crop_b64
         return pollintor_dict
 
 
 class MessageParser:
-    def __init__(self):
+    def __init__(self, decode_size=None, keep_encoded=False, streaming=False):
+        """
+        decode_size: if set, JPEG crops are decoded at the smallest scale
+        (1/1, 1/2, 1/4 or 1/8) at which the longer side is still at least
+        decode_size, see Image.draft
+        keep_encoded: keep the encoded crops to decode them at full resolution
+        later, see load_full_image
+        streaming: parse_message only reads the metadata of a serialized
+        message, the flowers are read and decoded one at a time by
+        iter_images
+        """
+        self.decode_size = decode_size
+        self.keep_encoded = keep_encoded
+        self.streaming = streaming
+        self.data = None
+        self.flowers_index = None
         self.node_id = None
         self.timestamp = None
         self.images = []
+        self.image_sizes = []
+        self.encoded_images = []
         self.classes = []
         self.scores = []
         self.inference_times = None
@@ -91,7 +255,10 @@ class MessageParser:
         self._clear()
         try:
             if not type(msg) is dict:
-                msg = json.loads(msg)
+                if self.streaming:
+                    msg = self._parse_streaming(msg)
+                else:
+                    msg = loads_json(msg)
             self.msg = msg
             meta = msg["metadata"]
             self.node_id = meta["node_id"]
@@ -108,6 +275,8 @@ class MessageParser:
             self.model_name = flower_inference_meta["model_name"]
             self.max_det = flower_inference_meta["max_det"]
             self.inference_times = flower_inference_meta["inference_times"]
+            if self.data is not None:
+                return True
             detections = msg["detections"]
             for i in range(len(detections["flowers"])):
                 self.classes.append(detections["flowers"][i]["class_name"])
@@ -119,10 +288,73 @@ class MessageParser:
             print(e)
             return False
 
+    def _parse_streaming(self, msg):
+        """
+        Decodes the metadata of a serialized message and finds its flowers
+        without decoding them. The message is kept as is, a memoryview of a
+        received frame is not copied. Everything but the flowers is checked
+        here, the flowers as iter_images reads them: malformed JSON fails
+        as with loads_json, except for invalid characters within a crop,
+        which base64 decoding skips.
+        """
+        if isinstance(msg, str):
+            msg = msg.encode("utf-8")
+        msg = memoryview(msg)
+        members, end = _object_members(msg, 0)
+        if _skip_whitespace(msg, end) != len(msg):
+            raise ValueError("Extra data after the message at position {}".format(end))
+        metadata = _decode_value(msg, members["metadata"])
+        detections = _object_members(msg, members["detections"])[0]
+        self.flowers_index = detections["flowers"]
+        # the flowers are checked as they are read by iter_images
+        _check_members(msg, members, ("metadata", "detections"))
+        _check_members(msg, detections, ("flowers",))
+        self.data = msg
+        return {"metadata": metadata}
+
+    def iter_images(self):
+        """
+        Streaming mode: yields (index, image) of the flower crops, read and
+        decoded one at a time. A crop is base64-decoded straight from the
+        message, the image (and encoded crop) is released when the next one
+        is requested. The message is released once the last crop was read
+        from it, before that crop is decoded. Classes, scores and sizes are
+        collected as in parse_message, num_detections is final after the
+        last crop.
+        """
+        data = self.data
+        try:
+            index = _skip_whitespace(data, _expect(data, self.flowers_index, b"["))
+            last = data[index : index + 1] == b"]"
+            while not last:
+                flower, index = _object_members(data, index)
+                flower_index = self.num_detections
+                self.classes.append(_decode_value(data, flower["class_name"]))
+                self.scores.append(_decode_value(data, flower["score"]))
+                _check_members(data, flower, ("class_name", "score", "crop"))
+                encoded = base64.b64decode(_string_bytes(data, flower["crop"]))
+                index = _skip_whitespace(data, index)
+                last = data[index : index + 1] == b"]"
+                if last:
+                    self.data = data = None
+                else:
+                    index = _skip_whitespace(data, _expect(data, index, b","))
+                self.images.append(self._open_image(encoded))
+                del encoded
+                self.num_detections += 1
+                yield flower_index, self.images[flower_index]
+                self.images[flower_index] = None
+                if self.keep_encoded:
+                    self.encoded_images[flower_index] = None
+        finally:
+            self.data = data = None
+
     def _clear(self):
         self.node_id = None
         self.timestamp = None
         self.images = []
+        self.image_sizes = []
+        self.encoded_images = []
         self.classes = []
         self.scores = []
         self.inference_times = None
@@ -133,9 +365,39 @@ class MessageParser:
         self.num_detections = 0
         self.margin = None
         self.model_name = None
+        self.data = None
+        self.flowers_index = None
 
     def _load_image(self, img_b64):
-        im = Image.open(BytesIO(base64.b64decode(img_b64)))
+        return self._open_image(base64.b64decode(img_b64))
+
+    def _open_image(self, data):
+        im = Image.open(BytesIO(data))
+        self.image_sizes.append(im.size)
+        if self.keep_encoded:
+            self.encoded_images.append(data)
+        if self.decode_size is not None:
+            scale = max(im.size) / self.decode_size
+            if scale > 1:
+                im.draft(
+                    im.mode,
+                    (math.ceil(im.size[0] / scale), math.ceil(im.size[1] / scale)),
+                )
+        im.load()
+        return im
+
+    def is_reduced(self, index):
+        """
+        True if the crop at index was decoded at a reduced resolution.
+        """
+        return self.images[index].size != self.image_sizes[index]
+
+    def load_full_image(self, index):
+        """
+        Decodes the crop at index at full resolution, requires keep_encoded.
+        """
+        im = Image.open(BytesIO(self.encoded_images[index]))
+        im.load()
         return im
 
     def get_metadata(self):
@@ -168,12 +430,17 @@ class MessageParser:
             print(
                 "#{}: Class: {}".format(i, self.classes[i])
                 + " Score: {}".format(self.scores[i])
-                + " Crop size: {}".format(self.images[i].size)
+                + " Crop size: {}".format(self.image_sizes[i])
             )
 
     def store_message(self, path):
-        with open(path, "w") as f:
-            json.dump(self.msg, f)
+        if self.data is not None:
+            # streaming mode, before the flowers were read
+            with open(path, "wb") as f:
+                f.write(self.data)
+        else:
+            with open(path, "w") as f:
+                json.dump(self.msg, f)
         return True
 
 
@@ -203,13 +470,26 @@ class MessageGenerator:
     def add_pollinator(self, pollinator: Pollinator):
         self.pollinators.append(pollinator)
 
-    def generate_message(self, save_crop=True):
+    def encode_crops(self, executor=None):
+        """
+        Encodes the crops of all pollinators, in parallel if an executor
+        (e.g. a ThreadPoolExecutor) is given.
+        """
+        if executor is None:
+            for pollinator in self.pollinators:
+                pollinator.encode_crop()
+        else:
+            list(executor.map(Pollinator.encode_crop, self.pollinators))
+
+    def generate_message(self, save_crop=True, raw_crops=False):
         flowers = []
         pollinators = []
         for flower in self.flowers:
             flowers.append(flower.to_dict())
         for pollinator in self.pollinators:
-            pollinators.append(pollinator.to_dict())
+            pollinators.append(
+                pollinator.to_dict(save_crop=save_crop, raw_crop=raw_crops)
+            )
         flowers.sort(key=lambda x: x["index"])
         pollinators.sort(key=lambda x: x["index"])
 
@@ -230,7 +510,10 @@ class MessageGenerator:
         time_dir = self.timestamp.strftime("%H")
         return self.node_id + "/" + date_dir + "/" + time_dir + "/"
 
-    def store_message(self, base_dir, save_crop=True):
+    def store_message(self, base_dir, save_crop=True, format="json", payload=None):
+        """
+        payload: the message already serialized in format, generated if None
+        """
         if not os.path.exists(base_dir):
             os.makedirs(base_dir)
         if not base_dir.endswith("/"):
@@ -239,101 +522,375 @@ class MessageGenerator:
         if not os.path.exists(filepath):
             os.makedirs(filepath)
             log.info("Created directory: {}".format(filepath))
-        with open(filepath + self.generate_filename(), "w") as f:
-            json.dump(self.generate_message(save_crop=save_crop), f)
-        log.info("Saved message to: {}".format(filepath + self.generate_filename()))
+        filename = self.generate_filename(FILE_EXTENSIONS[format])
+        if payload is None:
+            payload = encode_result(self, format, save_crop=save_crop)
+        with open(filepath + filename, "wb") as f:
+            f.write(payload)
+        log.info("Saved message to: {}".format(filepath + filename))
         return True
 
 
+def replace_placeholders(template, filename=None, node_id=None, hostname=None):
+    if filename is not None:
+        template = template.replace("${filename}", filename)
+    if node_id is not None:
+        template = template.replace("${node_id}", node_id)
+    if hostname is not None:
+        template = template.replace("${hostname}", hostname)
+    return template
+
+
 class MQTTClient:
-    def __init__(self, host, port, topic, username, password, use_tls):
+    """
+    Publishes results over a persistent connection to the broker.
+
+    The paho network loop runs in a background thread and reconnects
+    automatically. Up to max_inflight QoS 1 messages are sent without waiting
+    for their acknowledgement. While the broker is unreachable, up to
+    max_queued messages are kept in memory and sent after reconnecting,
+    further messages are dropped.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        topic,
+        username,
+        password,
+        use_tls,
+        qos=1,
+        max_inflight=20,
+        max_queued=100,
+        keepalive=60,
+        format="json",
+    ):
+        import paho.mqtt.client as mqtt
+
         self.host = host
         self.port = port
         self.topic = topic
         self.username = username
         self.password = password
         self.use_tls = use_tls
-        if self.username is not None and self.password is not None:
-            self.auth = {
-                "username": self.username,
-                "password": self.password,
-            }
+        self.qos = qos
+        self.keepalive = keepalive
+        self.format = check_format(format)
+        if hasattr(mqtt, "CallbackAPIVersion"):  # paho-mqtt >= 2.0
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         else:
-            self.auth = None
+            self.client = mqtt.Client()
+        if self.username is not None and self.password is not None:
+            self.client.username_pw_set(self.username, self.password)
+        if self.use_tls:
+            self.client.tls_set(
+                cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLSv1_2
+            )
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.max_queued_messages_set(max_queued)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+
+    def start(self):
+        """
+        Connects and starts the network loop thread.
+        """
+        self.client.connect_async(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+        return self
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        log.info("Connected to MQTT broker {}, result: {}".format(self.host, rc))
+
+    def _on_disconnect(self, client, userdata, *args):
+        # paho-mqtt < 2.0 passes (rc), >= 2.0 (flags, reason_code, properties)
+        rc = args[0] if len(args) == 1 else args[1]
+        log.warning(
+            "Disconnected from MQTT broker {}, reason: {}".format(self.host, rc)
+        )
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
 
     def publish(self, message, filename=None, node_id=None, hostname=None):
-        import paho.mqtt.publish as publish
-
-        topic = self.topic
-        if filename is not None:
-            topic = topic.replace("${filename}", filename)
-        if node_id is not None:
-            topic = topic.replace("${node_id}", node_id)
-        if hostname is not None:
-            topic = topic.replace("${hostname}", hostname)
+        """
+        message: the result, either as dict or already serialized in format
+        """
+        import paho.mqtt.client as mqtt
+
+        topic = replace_placeholders(self.topic, filename, node_id, hostname)
         log.info("Publishing to {} on topic: {}".format(self.host, topic))
-        tls_config = None
-        if self.use_tls:
-            tls_config = {
-                "certfile": None,
-                "keyfile": None,
-                "cert_reqs": ssl.CERT_REQUIRED,
-                "tls_version": ssl.PROTOCOL_TLSv1_2,
-                "ciphers": None,
-            }
-
-        publish.single(
-            topic,
-            json.dumps(message),
-            1,
-            auth=self.auth,
-            hostname=self.host,
-            port=self.port,
-            tls=tls_config,
+        if not isinstance(message, bytes):
+            message = dumps_json(message)
+        info = self.client.publish(topic, message, self.qos)
+        if info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+            SINK_ERRORS.labels("mqtt").inc()
+            log.error(
+                "MQTT queue is full, dropping message for topic: {}".format(topic)
+            )
+        elif info.rc == mqtt.MQTT_ERR_NO_CONN:
+            log.warning("Not connected to {}, message is queued".format(self.host))
+        return info
+
+    def send_entries(self, entries, timeout=30):
+        """
+        Publishes outbox entries and waits for their acknowledgement.
+        Returns the ids of the acknowledged entries.
+        """
+        if not self.client.is_connected():
+            return []
+        published = []
+        for entry in entries:
+            topic = replace_placeholders(
+                self.topic, entry.filename, entry.node_id, entry.hostname
+            )
+            published.append(
+                (entry.id, self.client.publish(topic, entry.payload, self.qos))
+            )
+        deadline = time.monotonic() + timeout
+        delivered = []
+        for entry_id, info in published:
+            try:
+                info.wait_for_publish(max(deadline - time.monotonic(), 0))
+            except (RuntimeError, ValueError) as e:
+                log.warning("Publishing to {} failed: {}".format(self.host, e))
+                continue
+            if info.is_published():
+                delivered.append(entry_id)
+        log.info(
+            "Published {} of {} results to {}".format(
+                len(delivered), len(entries), self.host
+            )
         )
+        return delivered
 
 
 class HTTPClient:
-    def __init__(self, url, username, password, method="POST"):
+    """
+    Sends results to a HTTP endpoint over a pooled keep-alive session.
+
+    The request body can be compressed (gzip or zstd, the latter requires the
+    zstandard package). Failed requests are retried with backoff.
+    With batch_size > 1, results are collected and sent as a JSON array of up
+    to batch_size results, or whatever was collected within batch_interval
+    milliseconds, per URL.
+    """
+
+    def __init__(
+        self,
+        url,
+        username,
+        password,
+        method="POST",
+        compression=None,
+        timeout=(5, 30),
+        retries=3,
+        batch_size=1,
+        batch_interval=1000,
+        format="json",
+    ):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
         self.url = url
         self.username = username
         self.password = password
         self.method = method
+        self.compression = compression
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.format = check_format(format)
         if self.username is not None and self.password is not None:
             self.auth = (self.username, self.password)
         else:
             self.auth = None
+        if self.compression not in (None, "gzip", "zstd"):
+            raise ValueError("Unknown compression: {}".format(self.compression))
+        # a ZstdCompressor must not be shared between threads, the results
+        # are sent from the caller's and the batch thread
+        self.local = threading.local()
+        if self.compression == "zstd":
+            # fails early if zstandard is missing
+            self._zstd_compressor()
+
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.headers["Content-type"] = CONTENT_TYPES[self.format]
+        if self.compression is not None:
+            self.session.headers["Content-Encoding"] = self.compression
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=None,  # retry POST as well
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.batch = []
+        self.batch_started = None
+        self.batch_condition = threading.Condition()
+
+    def start(self):
+        """
+        Starts the thread sending the batches, if batching.
+        """
+        if self.batch_size > 1:
+            threading.Thread(
+                target=self._batch_loop, name="http-batch", daemon=True
+            ).start()
+        return self
 
     def send_message(self, message, filename=None, node_id=None, hostname=None):
-        headers = {"Content-type": "application/json"}
-        url = self.url
-        if filename is not None:
-            url = url.replace("${filename}", filename)
-        if node_id is not None:
-            url = url.replace("${node_id}", node_id)
-        if hostname is not None:
-            url = url.replace("${hostname}", hostname)
+        """
+        message: the result, either as dict or already serialized in format
+        Returns whether the result was delivered. With batch_size > 1 the
+        result is only added to the batch and True is returned, a failed
+        batch is logged and counted as sink errors but not retried: use the
+        outbox (send_entries) to retry batches.
+        """
+        url = replace_placeholders(self.url, filename, node_id, hostname)
+        if isinstance(message, bytes):
+            payload = message
+        else:
+            payload = dumps_json(message)
+        if self.batch_size > 1:
+            with self.batch_condition:
+                if len(self.batch) == 0:
+                    self.batch_started = time.monotonic()
+                self.batch.append((url, payload))
+                self.batch_condition.notify()
+            return True
         log.info("Sending results to {}".format(url))
-
-        if self.auth is not None:
-            headers["Authorization"] = "Basic " + base64.b64encode(
-                bytes(self.auth[0] + ":" + self.auth[1], "utf-8")
-            ).decode("utf-8")
+        success = self._send(url, payload) == 200
+        if not success:
+            SINK_ERRORS.labels("http").inc()
+        return success
+
+    def send_entries(self, entries):
+        """
+        Sends outbox entries, as batches of up to batch_size entries if
+        batch_size > 1. Returns the ids of the delivered entries.
+        """
+        entries_per_url = {}
+        for entry in entries:
+            url = replace_placeholders(
+                self.url, entry.filename, entry.node_id, entry.hostname
+            )
+            entries_per_url.setdefault(url, []).append(entry)
+        delivered = []
+        for url, url_entries in entries_per_url.items():
+            indexes = self._send_payloads(url, [entry.payload for entry in url_entries])
+            delivered += [url_entries[i].id for i in indexes]
+        return delivered
+
+    def flush(self):
+        """
+        Sends the collected results now, returns whether all were delivered.
+        """
+        with self.batch_condition:
+            batch = self.batch
+            self.batch = []
+        payloads_per_url = {}
+        for url, payload in batch:
+            payloads_per_url.setdefault(url, []).append(payload)
+        success = True
+        for url, payloads in payloads_per_url.items():
+            delivered = self._send_payloads(url, payloads)
+            if len(delivered) < len(payloads):
+                SINK_ERRORS.labels("http").inc(len(payloads) - len(delivered))
+            success = len(delivered) == len(payloads) and success
+        return success
+
+    def _send_payloads(self, url, payloads):
+        """
+        Sends serialized results, in batches of up to batch_size results if
+        the format supports arrays. A batch the server rejects with a client
+        error (4xx, e.g. 413 or a result it can't read) is sent again one
+        result at a time, so that a single result can't hold back the others.
+        Returns the indexes of the delivered ones.
+        """
+        batch_size = self.batch_size
+        if join_payloads([], self.format) is None:
+            batch_size = 1
+        delivered = []
+        for start in range(0, len(payloads), batch_size):
+            chunk = payloads[start : start + batch_size]
+            if batch_size > 1:
+                log.info("Sending {} results to {}".format(len(chunk), url))
+                data = join_payloads(chunk, self.format)
+            else:
+                log.info("Sending results to {}".format(url))
+                data = chunk[0]
+            status = self._send(url, data)
+            if status == 200:
+                delivered += range(start, start + len(chunk))
+            elif len(chunk) > 1 and status is not None and 400 <= status < 500:
+                log.warning(
+                    "Batch rejected by {}, sending its results one at a time".format(
+                        url
+                    )
+                )
+                for i, payload in enumerate(chunk):
+                    if self._send(url, payload) == 200:
+                        delivered.append(start + i)
+        return delivered
+
+    def _batch_loop(self):
+        while True:
+            with self.batch_condition:
+                while True:
+                    if len(self.batch) >= self.batch_size:
+                        break
+                    if len(self.batch) > 0:
+                        remaining = (
+                            self.batch_started
+                            + self.batch_interval / 1000
+                            - time.monotonic()
+                        )
+                        if remaining <= 0:
+                            break
+                        self.batch_condition.wait(timeout=remaining)
+                    else:
+                        self.batch_condition.wait()
+            self.flush()
+
+    def _zstd_compressor(self):
+        compressor = getattr(self.local, "zstd_compressor", None)
+        if compressor is None:
+            import zstandard
+
+            compressor = self.local.zstd_compressor = zstandard.ZstdCompressor()
+        return compressor
+
+    def _send(self, url, data):
+        """
+        Returns the status code of the response, None if there was none.
+        """
+        if self.compression == "gzip":
+            data = gzip.compress(data)
+        elif self.compression == "zstd":
+            data = self._zstd_compressor().compress(data)
         try:
-            response = requests.request(
-                self.method, url, headers=headers, data=json.dumps(message)
+            response = self.session.request(
+                self.method, url, data=data, timeout=self.timeout
             )
             if response.status_code == 200:
                 log.info("Successfully sent results to {}".format(url))
-                return True
             else:
                 log.error(
                     "Failed to send results to {}, status code is {}".format(
                         url, response.status_code
                     )
                 )
-                return False
+            return response.status_code
         except Exception as e:
             log.error(e)
-            return False
-
+            return None
@@ -0,0 +1,529 @@
+"""
+Counters, gauges and histograms of the processing stages, exposed in the
+Prometheus text format on an optional HTTP endpoint and summarized
+periodically in the log.
+
+Worker processes (see pipelinehelper.WorkerPool) capture their observations
+instead of applying them. The captured observations are sent back with the
+record and replayed in the main process, which serves the endpoint.
+"""
+
+import bisect
+import http.server
+import logging
+import math
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+log.propagate = False
+log.setLevel(logging.INFO)
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(
+    logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+)
+log.addHandler(handler)
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+LATENCY_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 3 * 3600, 24 * 3600)
+
+
+def _escape_label_value(value):
+    """
+    Escapes a label value for the text exposition format.
+    """
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _escape_help(text):
+    """
+    Escapes the text of a HELP line, quotes are kept as is.
+    """
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _format_value(value):
+    """
+    Formats a sample value, with the spelling of the exposition format for
+    NaN and infinities.
+    """
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.captured = None
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def start_capture(self):
+        """
+        Buffers observations instead of applying them, see drain().
+        Called in forked worker processes, the lock is replaced in case
+        another thread held it at the time of the fork.
+        """
+        self.lock = threading.Lock()
+        self.captured = []
+
+    def drain(self):
+        """
+        Returns and clears the captured observations.
+        """
+        with self.lock:
+            captured, self.captured = self.captured, []
+        return captured
+
+    def replay(self, captured):
+        """
+        Applies observations captured in another process.
+        """
+        for name, labels, operation, value in captured or ():
+            getattr(self.metrics[name].labels(*labels), operation)(value)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry
+        self.children = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._child(values))
+        return child
+
+    def _child(self, labelvalues):
+        raise NotImplementedError
+
+    def _format_labels(self, labelvalues, extra=()):
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if len(pairs) == 0:
+            return ""
+        return (
+            "{"
+            + ",".join(
+                '{}="{}"'.format(name, _escape_label_value(value))
+                for name, value in pairs
+            )
+            + "}"
+        )
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, _escape_help(self.documentation)),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        for labelvalues, child in sorted(self.children.items()):
+            lines += child.render(self, labelvalues)
+        return lines
+
+    # shortcuts for metrics without labels
+    def __getattr__(self, attribute):
+        if attribute in ("inc", "dec", "set", "set_function", "observe", "time"):
+            return getattr(self.labels(), attribute)
+        raise AttributeError(attribute)
+
+
+class _Child:
+    def __init__(self, metric, labelvalues):
+        self.metric = metric
+        self.labelvalues = labelvalues
+        self.lock = threading.Lock()
+
+    def _record(self, operation, value):
+        """
+        Returns True if the observation was captured instead of applied.
+        """
+        registry = self.metric.registry
+        if registry.captured is None:
+            return False
+        with registry.lock:
+            registry.captured.append(
+                (self.metric.name, self.labelvalues, operation, value)
+            )
+        return True
+
+
+class _CounterChild(_Child):
+    def __init__(self, metric, labelvalues):
+        super().__init__(metric, labelvalues)
+        self.value = 0
+
+    def inc(self, amount=1):
+        if self._record("inc", amount):
+            return
+        with self.lock:
+            self.value += amount
+
+    def render(self, metric, labelvalues):
+        return [
+            "{}{} {}".format(
+                metric.name,
+                metric._format_labels(labelvalues),
+                _format_value(self.value),
+            )
+        ]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _child(self, labelvalues):
+        return _CounterChild(self, labelvalues)
+
+
+class _GaugeChild(_Child):
+    def __init__(self, metric, labelvalues):
+        super().__init__(metric, labelvalues)
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        if self._record("set", value):
+            return
+        self.value = value
+
+    def inc(self, amount=1):
+        if self._record("inc", amount):
+            return
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """
+        The value is taken from function when the gauge is read.
+        """
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return math.nan
+        return self.value
+
+    def render(self, metric, labelvalues):
+        return [
+            "{}{} {}".format(
+                metric.name,
+                metric._format_labels(labelvalues),
+                _format_value(self.get()),
+            )
+        ]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def _child(self, labelvalues):
+        return _GaugeChild(self, labelvalues)
+
+
+class _Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self.child.observe(time.monotonic() - self.start)
+
+
+class _HistogramChild(_Child):
+    def __init__(self, metric, labelvalues):
+        super().__init__(metric, labelvalues)
+        self.buckets = metric.buckets
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        if self._record("observe", value):
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """
+        Context manager observing the duration of its block.
+        """
+        return _Timer(self)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+    def render(self, metric, labelvalues):
+        counts, total = self.snapshot()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + [math.inf], counts):
+            cumulative += count
+            le = _format_value(float(bound))
+            lines.append(
+                "{}_bucket{} {}".format(
+                    metric.name,
+                    metric._format_labels(labelvalues, [("le", le)]),
+                    cumulative,
+                )
+            )
+        labels = metric._format_labels(labelvalues)
+        lines.append("{}_sum{} {}".format(metric.name, labels, _format_value(total)))
+        lines.append("{}_count{} {}".format(metric.name, labels, cumulative))
+        return lines
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name,
+        documentation,
+        labelnames=(),
+        buckets=DEFAULT_BUCKETS,
+        registry=REGISTRY,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _child(self, labelvalues):
+        return _HistogramChild(self, labelvalues)
+
+
+def bucket_quantile(buckets, counts, quantile):
+    """
+    Upper bound of the bucket containing the quantile.
+    """
+    total = sum(counts)
+    if total == 0:
+        return None
+    rank = quantile * total
+    cumulative = 0
+    for bound, count in zip(list(buckets) + [math.inf], counts):
+        cumulative += count
+        if cumulative >= rank:
+            return bound
+    return math.inf
+
+
+# the metrics of the service
+RECORDS = Counter(
+    "pollinator_records_total",
+    "Records by result (processed, skipped, failed)",
+    ["result"],
+)
+FLOWERS = Counter("pollinator_flowers_total", "Flower crops processed")
+POLLINATORS = Counter("pollinator_pollinators_total", "Pollinators detected")
+SKIPPED_FLOWERS = Counter(
+    "pollinator_skipped_flowers_total",
+    "Flower crops not run through the model, unchanged from a recent empty crop",
+)
+QUEUE_WAIT = Histogram(
+    "pollinator_queue_wait_seconds",
+    "Time records wait in the input buffer (input) and until processing starts (pipeline)",
+    ["queue"],
+)
+STAGE_SECONDS = Histogram(
+    "pollinator_stage_seconds",
+    "Duration of the processing stages: decode, preprocess, forward and nms "
+    "(per model batch), crops, encode",
+    ["stage"],
+)
+SINK_SECONDS = Histogram(
+    "pollinator_sink_seconds",
+    "Time to hand a result to a sink (file, mqtt, http, outbox), or to deliver "
+    "a batch from the outbox (outbox_mqtt, outbox_http)",
+    ["sink"],
+)
+SINK_ERRORS = Counter("pollinator_sink_errors_total", "Failed sends by sink", ["sink"])
+END_TO_END_SECONDS = Histogram(
+    "pollinator_end_to_end_seconds",
+    "Time from capture_timestamp until the result is handed to the sink",
+    ["sink"],
+    buckets=LATENCY_BUCKETS,
+)
+IN_FLIGHT = Gauge("pollinator_in_flight_records", "Records fetched but not yet output")
+BACKLOG = Gauge(
+    "pollinator_backlog",
+    "Records waiting in the input buffer (input) and results waiting in the "
+    "outbox (outbox_mqtt, outbox_http)",
+    ["queue"],
+)
+
+
+class MetricsServer:
+    """
+    Serves the registry on http://host:port/metrics in a background thread.
+    """
+
+    def __init__(self, host="127.0.0.1", port=9100, registry=REGISTRY):
+        registry_ = registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry_.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="metrics-server", daemon=True
+        )
+
+    def start(self):
+        host, port = self.server.server_address[:2]
+        log.info("Serving metrics on http://{}:{}/metrics".format(host, port))
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsLogger:
+    """
+    Logs a summary of the metrics every interval seconds: record rate,
+    in-flight and backlog counts, and per stage and sink the mean and p95
+    (bucket upper bound) of the observations since the last summary.
+    """
+
+    def __init__(self, interval=60, registry=REGISTRY):
+        self.interval = interval
+        self.registry = registry
+        self.last = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name="metrics-logger", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _delta(self, key, counts, total):
+        last_counts, last_total = self.last.get(key, ([0] * len(counts), 0.0))
+        self.last[key] = (counts, total)
+        return [c - l for c, l in zip(counts, last_counts)], total - last_total
+
+    def _histogram_summary(self, histogram):
+        parts = []
+        for labelvalues, child in sorted(histogram.children.items()):
+            counts, total = self._delta(
+                (histogram.name, labelvalues), *child.snapshot()
+            )
+            count = sum(counts)
+            if count == 0:
+                continue
+            p95 = bucket_quantile(histogram.buckets, counts, 0.95)
+            parts.append(
+                "{}={:.1f}ms/<{}ms".format(
+                    "/".join(labelvalues), total / count * 1000, _format_ms(p95)
+                )
+            )
+        return " ".join(parts)
+
+    def summary(self):
+        processed = RECORDS.labels("processed").value
+        last_processed = self.last.get("processed", processed)
+        self.last["processed"] = processed
+        backlog = " ".join(
+            "{}={}".format("/".join(labelvalues), child.get())
+            for labelvalues, child in sorted(BACKLOG.children.items())
+        )
+        lines = [
+            "{:.2f} records/s, in flight: {}, backlog: {}".format(
+                (processed - last_processed) / self.interval,
+                IN_FLIGHT.labels().get(),
+                backlog or "-",
+            )
+        ]
+        for title, histogram in (
+            ("queue wait", QUEUE_WAIT),
+            ("stages", STAGE_SECONDS),
+            ("sinks", SINK_SECONDS),
+        ):
+            text = self._histogram_summary(histogram)
+            if text:
+                lines.append("{} (mean/p95): {}".format(title, text))
+        return lines
+
+    def _run(self):
+        # the first summary only sets the baseline for the record rate
+        self.last["processed"] = RECORDS.labels("processed").value
+        while not self.stopped.wait(self.interval):
+            for line in self.summary():
+                log.info(line)
+
+
+def _format_ms(seconds):
+    if seconds == math.inf:
+        return "inf"
+    return "{:g}".format(seconds * 1000)
@@ -0,0 +1,95 @@
+"""
+Packing of small flower crops into mosaic canvases.
+
+Small crops letterboxed to the inference size are mostly padding. Instead,
+several crops are laid out at their own resolution on one square canvas,
+separated by a gap of padding, and the model runs once on the canvas. The
+detections are mapped back to the crop they fall into; detections that
+cross the border of their crop are dropped.
+"""
+
+import numpy as np
+
+PADDING_COLOR = 114  # the letterbox color of YOLOv5
+BORDER_TOLERANCE = 2  # pixels a box may extend past its crop
+
+
+def pack_rectangles(sizes, canvas_size, gap=0):
+    """
+    Packs rectangles (width, height) into square canvases of canvas_size
+    with a shelf algorithm: first fit, by decreasing height. Each rectangle
+    must fit into an empty canvas.
+    Returns a list of canvases, each a list of (index, x, y).
+    """
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    canvases = []
+    for index in order:
+        width, height = sizes[index]
+        for canvas in canvases:
+            if _place(canvas, index, width, height, canvas_size, gap):
+                break
+        else:
+            canvas = {"shelves": [], "bottom": 0, "items": []}
+            _place(canvas, index, width, height, canvas_size, gap)
+            canvases.append(canvas)
+    return [canvas["items"] for canvas in canvases]
+
+
+def _place(canvas, index, width, height, canvas_size, gap):
+    # shelves are [y, height, next free x]
+    for shelf in canvas["shelves"]:
+        y, shelf_height, x = shelf
+        if height <= shelf_height and x + width <= canvas_size:
+            canvas["items"].append((index, x, y))
+            shelf[2] = x + width + gap
+            return True
+    y = canvas["bottom"]
+    if y + height <= canvas_size and width <= canvas_size:
+        canvas["shelves"].append([y, height, width + gap])
+        canvas["bottom"] = y + height + gap
+        canvas["items"].append((index, 0, y))
+        return True
+    return False
+
+
+def build_canvas(arrays, items, canvas_size):
+    """
+    arrays: the crops as RGB arrays, items: (index, x, y) of one canvas
+    """
+    canvas = np.full((canvas_size, canvas_size, 3), PADDING_COLOR, dtype=np.uint8)
+    for index, x, y in items:
+        height, width = arrays[index].shape[:2]
+        canvas[y : y + height, x : x + width] = arrays[index]
+    return canvas
+
+
+def split_detections(xyxy, arrays, items, max_det=None):
+    """
+    Maps the detections on a canvas to the crops on it.
+    Returns {index: detections of the crop, in crop coordinates}, with at
+    most max_det detections per crop.
+    """
+    centers_x = (xyxy[:, 0] + xyxy[:, 2]) / 2
+    centers_y = (xyxy[:, 1] + xyxy[:, 3]) / 2
+    detections = {}
+    for index, x, y in items:
+        height, width = arrays[index].shape[:2]
+        inside = (
+            (centers_x >= x)
+            & (centers_x < x + width)
+            & (centers_y >= y)
+            & (centers_y < y + height)
+        )
+        # drop boxes crossing the border of the crop
+        inside &= (
+            (xyxy[:, 0] >= x - BORDER_TOLERANCE)
+            & (xyxy[:, 1] >= y - BORDER_TOLERANCE)
+            & (xyxy[:, 2] <= x + width + BORDER_TOLERANCE)
+            & (xyxy[:, 3] <= y + height + BORDER_TOLERANCE)
+        )
+        crop_detections = xyxy[inside].copy()
+        crop_detections[:, [0, 2]] = np.clip(crop_detections[:, [0, 2]] - x, 0, width)
+        crop_detections[:, [1, 3]] = np.clip(crop_detections[:, [1, 3]] - y, 0, height)
+        order = np.argsort(-crop_detections[:, 4], kind="stable")
+        detections[index] = crop_detections[order[:max_det]]
+    return detections
@@ -0,0 +1,263 @@
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from dataclasses import dataclass
+
+from metricshelper import SINK_ERRORS, SINK_SECONDS
+
+log = logging.getLogger(__name__)
+log.propagate = False
+log.setLevel(logging.INFO)
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(
+    logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+)
+log.addHandler(handler)
+
+
+@dataclass
+class OutboxEntry:
+    id: int
+    payload: bytes
+    filename: str
+    node_id: str
+    hostname: str
+
+
+class Outbox:
+    """
+    Durable queue of serialized results, stored in a SQLite database.
+
+    Results are stored per sink (e.g. "mqtt", "http") and removed when the
+    sink acknowledged them, so they survive restarts and uplink outages.
+    Entries older than max_age (hours) are dropped, and the oldest entries
+    are dropped while the payloads exceed max_size (MB). Entries the sink
+    rejected are fetched after the others and dropped after max_attempts
+    rejections.
+    """
+
+    def __init__(
+        self, path, max_size=500, max_age=72, max_attempts=10, limit_check_interval=60
+    ):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_attempts = max_attempts
+        self.limit_check_interval = limit_check_interval
+        self.last_limit_check = 0
+        self.lock = threading.Lock()
+        self.new_entries = threading.Condition(self.lock)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "sink TEXT NOT NULL, "
+            "created REAL NOT NULL, "
+            "filename TEXT, "
+            "node_id TEXT, "
+            "hostname TEXT, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "payload BLOB NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_sink ON outbox (sink, attempts, id)"
+        )
+        self.connection.commit()
+        for sink, count in self.connection.execute(
+            "SELECT sink, COUNT(*) FROM outbox GROUP BY sink"
+        ):
+            log.info("Outbox contains {} entries for {}".format(count, sink))
+
+    def put(self, sinks, payload, filename=None, node_id=None, hostname=None):
+        """
+        Stores a serialized result for each of the sinks.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT INTO outbox (sink, created, filename, node_id, hostname, payload) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(sink, now, filename, node_id, hostname, payload) for sink in sinks],
+            )
+            self.connection.commit()
+            if now - self.last_limit_check > self.limit_check_interval:
+                self.last_limit_check = now
+                self._enforce_limits()
+            self.new_entries.notify_all()
+
+    def fetch(self, sink, limit, timeout=None):
+        """
+        Returns up to limit of the oldest entries of sink, the entries
+        rejected fewer times first.
+        Waits up to timeout seconds for new entries if there are none.
+        """
+        with self.lock:
+            entries = self._fetch(sink, limit)
+            if len(entries) == 0 and timeout is not None:
+                self.new_entries.wait(timeout)
+                entries = self._fetch(sink, limit)
+        return entries
+
+    def ack(self, ids):
+        """
+        Removes delivered entries.
+        """
+        if len(ids) == 0:
+            return
+        with self.lock:
+            self.connection.executemany(
+                "DELETE FROM outbox WHERE id = ?", [(i,) for i in ids]
+            )
+            self.connection.commit()
+
+    def reject(self, ids):
+        """
+        Counts a rejection of entries the sink did not accept while it
+        accepted others, drops those rejected max_attempts times.
+        """
+        if len(ids) == 0:
+            return
+        with self.lock:
+            self.connection.executemany(
+                "UPDATE outbox SET attempts = attempts + 1 WHERE id = ?",
+                [(i,) for i in ids],
+            )
+            if self.max_attempts is not None:
+                dropped = self.connection.execute(
+                    "SELECT id, sink, filename FROM outbox WHERE attempts >= ?",
+                    (self.max_attempts,),
+                ).fetchall()
+                for entry_id, sink, filename in dropped:
+                    log.error(
+                        "Dropped outbox entry {} for {}, rejected {} times".format(
+                            filename or entry_id, sink, self.max_attempts
+                        )
+                    )
+                self.connection.executemany(
+                    "DELETE FROM outbox WHERE id = ?", [(row[0],) for row in dropped]
+                )
+            self.connection.commit()
+
+    def count(self, sink=None):
+        with self.lock:
+            if sink is None:
+                row = self.connection.execute("SELECT COUNT(*) FROM outbox").fetchone()
+            else:
+                row = self.connection.execute(
+                    "SELECT COUNT(*) FROM outbox WHERE sink = ?", (sink,)
+                ).fetchone()
+        return row[0]
+
+    def _fetch(self, sink, limit):
+        rows = self.connection.execute(
+            "SELECT id, payload, filename, node_id, hostname FROM outbox "
+            "WHERE sink = ? ORDER BY attempts, id LIMIT ?",
+            (sink, limit),
+        ).fetchall()
+        return [OutboxEntry(*row) for row in rows]
+
+    def _enforce_limits(self):
+        if self.max_age is not None:
+            removed = self.connection.execute(
+                "DELETE FROM outbox WHERE created < ?",
+                (time.time() - self.max_age * 3600,),
+            ).rowcount
+            if removed > 0:
+                log.warning(
+                    "Dropped {} outbox entries older than {}h".format(
+                        removed, self.max_age
+                    )
+                )
+        if self.max_size is not None:
+            max_bytes = self.max_size * 1024 * 1024
+            size = self.connection.execute(
+                "SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM outbox"
+            ).fetchone()[0]
+            removed = 0
+            for entry_id, entry_size in self.connection.execute(
+                "SELECT id, LENGTH(payload) FROM outbox ORDER BY id"
+            ).fetchall():
+                if size <= max_bytes:
+                    break
+                self.connection.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+                size -= entry_size
+                removed += 1
+            if removed > 0:
+                log.warning(
+                    "Dropped {} outbox entries, size limit of {}MB reached".format(
+                        removed, self.max_size
+                    )
+                )
+        self.connection.commit()
+
+
+class OutboxSender:
+    """
+    Delivers the outbox entries of one sink in a background thread.
+
+    send: callable taking a list of OutboxEntry and returning the ids of the
+    delivered entries. If none of the entries were delivered, e.g. while the
+    uplink is down, the next attempt is delayed with exponential backoff. The
+    entries not delivered while others were count as rejected by the sink,
+    see Outbox.reject().
+    """
+
+    def __init__(self, outbox, sink, send, batch_size=20, backoff_max=60):
+        self.outbox = outbox
+        self.sink = sink
+        self.send = send
+        self.batch_size = batch_size
+        self.backoff_max = backoff_max
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name="outbox-{}".format(sink), daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        backoff = 0
+        while not self.stopped.is_set():
+            entries = self.outbox.fetch(self.sink, self.batch_size, timeout=1)
+            if len(entries) == 0:
+                continue
+            t0 = time.monotonic()
+            try:
+                delivered = self.send(entries)
+            except Exception as e:
+                log.error("Sending to {} failed: {}".format(self.sink, e))
+                delivered = []
+            SINK_SECONDS.labels("outbox_" + self.sink).observe(time.monotonic() - t0)
+            self.outbox.ack(delivered)
+            if len(delivered) == len(entries):
+                backoff = 0
+                continue
+            SINK_ERRORS.labels("outbox_" + self.sink).inc(len(entries) - len(delivered))
+            if len(delivered) > 0:
+                delivered = set(delivered)
+                rejected = [entry.id for entry in entries if entry.id not in delivered]
+                log.warning(
+                    "{} of {} entries rejected by {}".format(
+                        len(rejected), len(entries), self.sink
+                    )
+                )
+                self.outbox.reject(rejected)
+                backoff = 0
+                continue
+            backoff = min(max(backoff * 2, 1), self.backoff_max)
+            log.warning(
+                "{} entries not delivered to {}, retrying in {}s".format(
+                    len(entries), self.sink, backoff
+                )
+            )
+            self.stopped.wait(backoff)
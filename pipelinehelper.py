@@ -0,0 +1,919 @@
+import atexit
+import collections
+import contextlib
+import datetime
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import numpy as np
+from PIL import Image
+
+from messagehelper import MessageParser, MessageGenerator, Flower, Pollinator
+from formathelper import FILE_EXTENSIONS, check_format, encode_result
+from yolomodelhelper import choose_input_size
+from cropcachehelper import fingerprint
+from metricshelper import (
+    END_TO_END_SECONDS,
+    FLOWERS,
+    IN_FLIGHT,
+    POLLINATORS,
+    QUEUE_WAIT,
+    RECORDS,
+    REGISTRY,
+    SINK_ERRORS,
+    SINK_SECONDS,
+    SKIPPED_FLOWERS,
+    STAGE_SECONDS,
+)
+
+log = logging.getLogger(__name__)
+log.propagate = False
+log.setLevel(logging.INFO)
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(
+    logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+)
+log.addHandler(handler)
+
+
+@dataclass
+class Record:
+    seq: int
+    raw: dict
+    parser: MessageParser = None
+    generator: MessageGenerator = None
+    payloads: dict = None
+    skip: bool = False
+    failed: bool = False
+    # time.monotonic() when the record was fetched
+    fetched: float = field(default_factory=time.monotonic)
+    # metrics captured in a worker process
+    metrics: list = None
+    # profilerhelper.ProfileSession if the record is profiled
+    profile: object = None
+
+
+STAGES = ("decode", "infer", "encode", "output")
+
+
+class RecordProcessor:
+    """
+    The processing steps for a single record: decode, infer, encode and output.
+    Used directly by the serial loop and as stages by the Pipeline.
+    """
+
+    def __init__(
+        self,
+        model,
+        image_size=640,
+        reduced_decode=False,
+        full_resolution_crops=True,
+        streaming_decode=False,
+        hostname=None,
+        ignore_empty_results=False,
+        store_file=False,
+        base_dir="output",
+        save_crops=True,
+        file_format="json",
+        file_store=None,
+        mqtt_client=None,
+        http_client=None,
+        outbox=None,
+        crop_encode_threads=2,
+        profiler=None,
+        input_sizes=None,
+        crop_cache=None,
+    ):
+        """
+        input_sizes: ladder of inference sizes, if set each flower crop runs at
+        the smallest size that fits its longer side instead of image_size
+        reduced_decode: decode the flower crops at a reduced resolution that
+        is still at least image_size (the largest of input_sizes)
+        full_resolution_crops: with reduced_decode, cut the pollinator crops
+        from a full resolution decode of the flower crop
+        streaming_decode: decode the flower crops one at a time during
+        inference and encode their pollinator crops right away, so that only
+        one flower crop is held in memory instead of all crops of a record
+        file_store: storehelper.SegmentStore, if set the results are appended
+        to its hourly segments instead of being stored as one file each
+        crop_encode_threads: number of threads encoding the pollinator crops
+        outbox: if set, results for the MQTT and HTTP clients are stored in
+        the outbox and delivered by its senders instead of being sent directly
+        profiler: profilerhelper.Profiler selecting the records to profile
+        crop_cache: cropcachehelper.EmptyCropCache, flower crops matching a
+        recent crop without detections are not run through the model
+        """
+        self.model = model
+        self.image_size = image_size
+        self.input_sizes = None
+        if input_sizes:
+            # the model runs at multiples of its stride
+            self.input_sizes = sorted(
+                {model.align_input_size(size) for size in input_sizes}
+            )
+        self.reduced_decode = reduced_decode
+        self.full_resolution_crops = full_resolution_crops
+        self.streaming_decode = streaming_decode
+        self.hostname = hostname
+        self.ignore_empty_results = ignore_empty_results
+        self.store_file = store_file
+        self.base_dir = base_dir
+        self.save_crops = save_crops
+        self.file_format = check_format(file_format)
+        self.file_store = file_store
+        self.mqtt_client = mqtt_client
+        self.http_client = http_client
+        self.outbox = outbox
+        self.crop_encode_threads = crop_encode_threads
+        self.crop_encoder = self._create_crop_encoder()
+        self.profiler = profiler
+        self.crop_cache = crop_cache
+
+    def _create_crop_encoder(self):
+        if self.crop_encode_threads > 1:
+            return ThreadPoolExecutor(
+                max_workers=self.crop_encode_threads, thread_name_prefix="crop-encode"
+            )
+        return None
+
+    def after_fork(self):
+        """
+        Recreates the crop encoder in a forked process, the threads of the
+        parent's pool do not exist there.
+        """
+        self.crop_encoder = self._create_crop_encoder()
+
+    def decode(self, record):
+        t0 = time.monotonic()
+        QUEUE_WAIT.labels("pipeline").observe(t0 - record.fetched)
+        if self.reduced_decode:
+            decode_size = self.image_size
+            if self.input_sizes is not None:
+                decode_size = self.input_sizes[-1]
+            parser = MessageParser(
+                decode_size=decode_size,
+                keep_encoded=self.full_resolution_crops,
+                streaming=self.streaming_decode,
+            )
+        else:
+            parser = MessageParser(streaming=self.streaming_decode)
+        if not parser.parse_message(record.raw):
+            log.error("Record {} could not be parsed".format(record.seq))
+            record.skip = True
+            record.failed = True
+            return record
+        record.raw = None
+        record.parser = parser
+        if parser.data is not None:
+            # the flowers are decoded during inference
+            STAGE_SECONDS.labels("decode").observe(time.monotonic() - t0)
+            log.info(
+                "Got data from {}, recorded at {}".format(
+                    parser.node_id, parser.timestamp
+                )
+            )
+            return record
+        if record.profile is not None:
+            record.profile.info.update(
+                node_id=parser.node_id,
+                capture_timestamp=parser.timestamp.isoformat(),
+                flowers=parser.num_detections,
+                crop_sizes=[list(size) for size in parser.image_sizes],
+            )
+        STAGE_SECONDS.labels("decode").observe(time.monotonic() - t0)
+        log.info(
+            "Got data from {}, recorded at {}, contains {} flowers".format(
+                parser.node_id, parser.timestamp, parser.num_detections
+            )
+        )
+        return record
+
+    def infer(self, record):
+        parser = record.parser
+        model = self.model
+        generator = MessageGenerator()
+        generator.set_timestamp(parser.timestamp)
+        generator.set_node_id(parser.node_id)
+        model.reset_inference_times()
+
+        if parser.data is not None:
+            input_sizes, skipped, packed = self._infer_streaming(parser, generator)
+            if record.profile is not None:
+                record.profile.info.update(
+                    node_id=parser.node_id,
+                    capture_timestamp=parser.timestamp.isoformat(),
+                    flowers=parser.num_detections,
+                    crop_sizes=[list(size) for size in parser.image_sizes],
+                )
+        else:
+            input_sizes, skipped, packed = self._infer_batch(parser, generator)
+        if parser.num_detections > 0:
+            FLOWERS.inc(parser.num_detections)
+            POLLINATORS.inc(len(generator.pollinators))
+            log.info(
+                "Inference times [total, avg]: {}".format(model.get_inference_times())
+            )
+        pollinator_inference_meta = model.get_metadata()
+        if input_sizes is not None:
+            pollinator_inference_meta["input_sizes"] = input_sizes
+        if self.crop_cache is not None:
+            pollinator_inference_meta["skipped_flowers"] = skipped
+        if model.mosaic:
+            pollinator_inference_meta["mosaic_flowers"] = packed
+        metadata = parser.get_metadata()
+        metadata["pollinator_inference"] = pollinator_inference_meta
+        generator.set_metadata(metadata)
+        record.generator = generator
+        record.parser = None
+        return record
+
+    def _infer_batch(self, parser, generator):
+        """
+        Runs the model on all flower crops of the record at once.
+        Returns the input size of each crop, the indexes of the skipped crops
+        and the indexes of the crops packed into mosaics.
+        """
+        input_sizes = None
+        if self.input_sizes is not None:
+            input_sizes = [
+                choose_input_size(width, height, self.input_sizes)
+                for width, height in parser.image_sizes
+            ]
+        if parser.num_detections == 0:
+            return input_sizes, [], []
+        results, skipped, packed = self._predict(
+            parser.images, parser.image_sizes, parser.node_id, input_sizes
+        )
+        if input_sizes is not None:
+            # packed crops run at their own resolution in a mosaic
+            for i in packed:
+                input_sizes[i] = None
+
+        t0 = time.monotonic()
+        pollinator_index = 0
+        for flower_index in range(len(parser.images)):
+            pollinator_index = self._add_flower(
+                generator,
+                parser,
+                flower_index,
+                results[flower_index],
+                input_sizes[flower_index] if input_sizes else None,
+                pollinator_index,
+            )
+        STAGE_SECONDS.labels("crops").observe(time.monotonic() - t0)
+        return input_sizes, skipped, packed
+
+    def _infer_streaming(self, parser, generator):
+        """
+        Runs the model on one flower crop at a time, as the parser decodes
+        them. The pollinator crops are encoded right away, so that only one
+        flower crop and its pollinator crops are held at a time.
+        Returns the same as _infer_batch.
+        """
+        encode_crops = len(self._payload_formats()) > 0 or (
+            self.store_file and self.save_crops
+        )
+        input_sizes = [] if self.input_sizes is not None else None
+        skipped = []
+        packed = []
+        pollinator_index = 0
+        crops_seconds = 0
+        for flower_index, image in parser.iter_images():
+            image_size = parser.image_sizes[flower_index]
+            sizes = None
+            if input_sizes is not None:
+                sizes = [choose_input_size(*image_size, self.input_sizes)]
+            results, flower_skipped, flower_packed = self._predict(
+                [image], [image_size], parser.node_id, sizes
+            )
+            del image
+            if len(flower_skipped) > 0:
+                skipped.append(flower_index)
+            if len(flower_packed) > 0:
+                packed.append(flower_index)
+                sizes = [None]
+            if input_sizes is not None:
+                input_sizes.append(sizes[0])
+
+            t0 = time.monotonic()
+            first = len(generator.pollinators)
+            pollinator_index = self._add_flower(
+                generator,
+                parser,
+                flower_index,
+                results[0],
+                sizes[0] if sizes else None,
+                pollinator_index,
+            )
+            for pollinator in generator.pollinators[first:]:
+                if encode_crops:
+                    pollinator.encode_crop()
+                pollinator.crop = None
+            crops_seconds += time.monotonic() - t0
+        if parser.num_detections > 0:
+            STAGE_SECONDS.labels("crops").observe(crops_seconds)
+        return input_sizes, skipped, packed
+
+    def _add_flower(
+        self, generator, parser, flower_index, result, input_size, pollinator_index
+    ):
+        """
+        Adds a flower and the pollinators detected on it to the generator.
+        Returns the index of the next pollinator.
+        """
+        width, height = parser.image_sizes[flower_index]
+        flower_obj = Flower(
+            index=flower_index,
+            class_name=parser.classes[flower_index],
+            score=parser.scores[flower_index],
+            width=width,
+            height=height,
+        )
+        generator.add_flower(flower_obj)
+        if (
+            len(result) > 0
+            and self.full_resolution_crops
+            and parser.is_reduced(flower_index)
+        ):
+            full_image = parser.load_full_image(flower_index)
+            if full_image.mode != "RGB":
+                full_image = full_image.convert("RGB")
+            crops = result.crops(np.asarray(full_image))
+        else:
+            crops = result.crops()
+        scores = result.scores.tolist()
+        names = result.names
+
+        pollinator_indexes = result.groups.tolist()
+        for detection in range(len(crops)):
+            idx = pollinator_index + pollinator_indexes[detection]
+            crop_image = Image.fromarray(crops[detection])
+            width, height = crop_image.size
+
+            pollinator_obj = Pollinator(
+                index=idx,
+                flower_index=flower_index,
+                class_name=names[detection],
+                score=scores[detection],
+                width=width,
+                height=height,
+                crop=crop_image,
+                input_size=input_size,
+            )
+            generator.add_pollinator(pollinator_obj)
+        if len(pollinator_indexes) > 0:
+            pollinator_index += max(pollinator_indexes) + 1
+        return pollinator_index
+
+    def _predict(self, images, image_sizes, node_id, input_sizes):
+        """
+        Runs the model on the flower crops that do not match a cached empty
+        crop. Returns a result per crop, the indexes of the skipped crops and
+        the indexes of the crops packed into mosaics.
+        """
+        model = self.model
+        if self.crop_cache is None:
+            results = model.predict_batch(images, input_sizes or self.image_size)
+            return results, [], model.packed
+        fingerprints = [fingerprint(image) for image in images]
+        skipped = [
+            i
+            for i, value in enumerate(fingerprints)
+            if self.crop_cache.match(node_id, value, image_sizes[i])
+        ]
+        indexes = [i for i in range(len(images)) if i not in skipped]
+        results = [None] * len(images)
+        packed = []
+        if len(indexes) > 0:
+            sizes = self.image_size
+            if input_sizes is not None:
+                sizes = [input_sizes[i] for i in indexes]
+            inferred = model.predict_batch([images[i] for i in indexes], sizes)
+            for i, result in zip(indexes, inferred):
+                results[i] = result
+                if len(result) == 0:
+                    self.crop_cache.add(node_id, fingerprints[i], image_sizes[i])
+            packed = [indexes[i] for i in model.packed]
+        for i in skipped:
+            results[i] = model.empty_result(images[i])
+        if len(skipped) > 0:
+            SKIPPED_FLOWERS.inc(len(skipped))
+            log.info(
+                "Skipped {} of {} flower crops, unchanged and without detections".format(
+                    len(skipped), len(images)
+                )
+            )
+        return results, skipped, packed
+
+    def encode(self, record):
+        with STAGE_SECONDS.labels("encode").time():
+            return self._encode(record)
+
+    def _encode(self, record):
+        generator = record.generator
+        if self.ignore_empty_results and len(generator.pollinators) == 0:
+            log.info("No pollinators detected, skipping")
+            record.skip = True
+            return record
+        formats = self._payload_formats()
+        store_crops = self.store_file and self.save_crops
+        if len(formats) > 0 or store_crops:
+            generator.encode_crops(self.crop_encoder)
+        record.payloads = {
+            format: encode_result(generator, format) for format in formats
+        }
+        return record
+
+    def _payload_formats(self):
+        """
+        Returns the formats the results are serialized in for the outputs.
+        """
+        formats = set()
+        if self.mqtt_client is not None:
+            formats.add(self.mqtt_client.format)
+        if self.http_client is not None:
+            formats.add(self.http_client.format)
+        if self.store_file and self.save_crops and self.file_store is None:
+            formats.add(self.file_format)
+        return formats
+
+    def output(self, record):
+        generator = record.generator
+        if self.store_file and self.file_store is not None:
+            with self._sink("file", generator):
+                self.file_store.append(generator)
+        elif self.store_file:
+            with self._sink("file", generator):
+                generator.store_message(
+                    self.base_dir,
+                    self.save_crops,
+                    format=self.file_format,
+                    payload=record.payloads.get(self.file_format),
+                )
+        clients = []
+        if self.mqtt_client is not None:
+            clients.append(("mqtt", self.mqtt_client))
+        if self.http_client is not None:
+            clients.append(("http", self.http_client))
+        for sink, client in clients:
+            filename = generator.generate_filename(FILE_EXTENSIONS[client.format])
+            payload = record.payloads[client.format]
+            if self.outbox is not None:
+                with self._sink("outbox", generator):
+                    self.outbox.put(
+                        [sink],
+                        payload,
+                        filename=filename,
+                        node_id=generator.node_id,
+                        hostname=self.hostname,
+                    )
+            elif sink == "mqtt":
+                with self._sink(sink, generator):
+                    client.publish(
+                        payload,
+                        filename=filename,
+                        node_id=generator.node_id,
+                        hostname=self.hostname,
+                    )
+            else:
+                with self._sink(sink, generator):
+                    client.send_message(
+                        payload,
+                        filename=filename,
+                        node_id=generator.node_id,
+                        hostname=self.hostname,
+                    )
+        RECORDS.labels("processed").inc()
+        return record
+
+    @contextlib.contextmanager
+    def _sink(self, sink, generator):
+        """
+        Observes the time to hand the result to the sink and the end-to-end
+        latency since the capture, counts exceptions as sink errors.
+        """
+        t0 = time.monotonic()
+        try:
+            yield
+        except Exception:
+            SINK_ERRORS.labels(sink).inc()
+            raise
+        SINK_SECONDS.labels(sink).observe(time.monotonic() - t0)
+        timestamp = generator.timestamp
+        if timestamp.tzinfo is None:
+            # capture timestamps without offset are UTC
+            timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+        END_TO_END_SECONDS.labels(sink).observe(
+            (datetime.datetime.now(datetime.timezone.utc) - timestamp).total_seconds()
+        )
+
+    def attach_profile(self, record, selected=None):
+        """
+        Attaches a profiling session to the record if the profiler selects
+        it, or if selected is True when the selection was made elsewhere.
+        """
+        if self.profiler is None:
+            return
+        if selected is None:
+            selected = self.profiler.select()
+        if selected:
+            record.profile = self.profiler.session(record.seq)
+
+    def run_stage(self, name, record):
+        """
+        Runs the stage with the given name, under the profiler if the record
+        is profiled.
+        """
+        stage = getattr(self, name)
+        if record.profile is None:
+            return stage(record)
+        return record.profile.run(name, stage, record)
+
+    def write_profile(self, record):
+        profile = record.profile
+        if profile is None:
+            return
+        record.profile = None
+        if record.generator is not None:
+            profile.info["pollinators"] = len(record.generator.pollinators)
+        profile.info["result"] = (
+            "failed" if record.failed else "skipped" if record.skip else "processed"
+        )
+        try:
+            profile.write()
+        except Exception as e:
+            log.error(
+                "Writing the profile of record {} failed: {}".format(record.seq, e)
+            )
+
+    def process(self, record):
+        IN_FLIGHT.inc()
+        self.attach_profile(record)
+        try:
+            for stage in STAGES:
+                record = self.run_stage(stage, record)
+                if record.skip:
+                    RECORDS.labels("failed" if record.failed else "skipped").inc()
+                    break
+        except Exception:
+            RECORDS.labels("failed").inc()
+            record.failed = True
+            raise
+        finally:
+            IN_FLIGHT.dec()
+            self.write_profile(record)
+        return record
+
+
+class Pipeline:
+    """
+    Runs the RecordProcessor stages in threads connected by bounded queues:
+
+        fetch -> decode (n threads) -> infer (1 thread) -> encode (n threads) -> output
+
+    so that fetching, decoding and encoding overlap with inference.
+    Records are output in the order they were fetched.
+    """
+
+    def __init__(
+        self,
+        processor,
+        fetch,
+        decode_threads=2,
+        encode_threads=2,
+        queue_size=4,
+        done=None,
+    ):
+        """
+        fetch: callable returning the next raw record, blocks until one is
+        available, None ends the input and run() returns after the last
+        record was output
+        done: callable called with each record after its output, in order
+        """
+        self.processor = processor
+        self.fetch = fetch
+        self.done = done
+        self.decode_threads = decode_threads
+        self.encode_threads = encode_threads
+        self.decode_queue = queue.Queue(maxsize=queue_size)
+        self.infer_queue = queue.Queue(maxsize=queue_size)
+        self.encode_queue = queue.Queue(maxsize=queue_size)
+        self.output_queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
+
+    def start(self):
+        self._start_thread(self._fetch_loop, "fetch")
+        for i in range(self.decode_threads):
+            self._start_thread(
+                self._stage_loop,
+                "decode-{}".format(i),
+                ("decode", self.decode_queue, self.infer_queue),
+            )
+        self._start_thread(
+            self._stage_loop,
+            "infer",
+            ("infer", self.infer_queue, self.encode_queue),
+        )
+        for i in range(self.encode_threads):
+            self._start_thread(
+                self._stage_loop,
+                "encode-{}".format(i),
+                ("encode", self.encode_queue, self.output_queue),
+            )
+        self._start_thread(self._output_loop, "output")
+
+    def run(self):
+        self.start()
+        # the output thread ends with the input
+        self.threads[-1].join()
+
+    def _start_thread(self, target, name, args=()):
+        thread = threading.Thread(target=target, name=name, args=args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _fetch_loop(self):
+        seq = 0
+        while True:
+            raw = self.fetch()
+            if raw is None:
+                # tells the output loop the number of records
+                self.output_queue.put(seq)
+                return
+            record = Record(seq=seq, raw=raw)
+            IN_FLIGHT.inc()
+            self.processor.attach_profile(record)
+            self.decode_queue.put(record)
+            seq += 1
+
+    def _stage_loop(self, stage, input_queue, output_queue):
+        while True:
+            record = input_queue.get()
+            if not record.skip:
+                try:
+                    record = self.processor.run_stage(stage, record)
+                except Exception as e:
+                    log.error("Record {} failed: {}".format(record.seq, e))
+                    record.skip = True
+                    record.failed = True
+            output_queue.put(record)
+
+    def _output_loop(self):
+        pending = {}
+        next_seq = 0
+        total = None
+        while total is None or next_seq < total:
+            record = self.output_queue.get()
+            if isinstance(record, int):
+                total = record
+                continue
+            pending[record.seq] = record
+            while next_seq in pending:
+                record = pending.pop(next_seq)
+                next_seq += 1
+                _output_record(self.processor, record)
+                if self.done is not None:
+                    self.done(record)
+
+
+class WorkerPool:
+    """
+    Runs decode, infer and encode of the RecordProcessor in worker processes:
+
+        fetch -> workers (n processes) -> output
+
+    The workers are forked from the process that loaded the model, so they
+    share its weights copy-on-write. Fork them with start_workers() before
+    starting threads (input, sinks, metrics) in this process, a forked
+    worker only keeps the thread that forked it. Records are fetched and
+    output by the coordinator (this process), in the order they were
+    fetched.
+
+    Each worker has its own task queue and result pipe, so a worker that
+    dies can't leave a shared queue locked. It is replaced and the records
+    dispatched to it and not returned are failed.
+    """
+
+    def __init__(
+        self,
+        processor,
+        fetch,
+        workers=2,
+        threads_per_worker=None,
+        queue_size=4,
+        done=None,
+    ):
+        """
+        fetch: callable returning the next raw record, blocks until one is
+        available, None ends the input and run() returns after the last
+        record was output
+        threads_per_worker: inference threads per worker, default: cores / workers
+        queue_size: max number of records dispatched to a worker
+        done: callable called with each record after its output, in order
+        """
+        self.processor = processor
+        self.fetch = fetch
+        self.done = done
+        self.workers = workers
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+        self.threads_per_worker = threads_per_worker
+        self.queue_size = queue_size
+        self.context = multiprocessing.get_context("fork")
+        self.processes = {}
+        self.task_queues = {}
+        self.result_readers = {}
+        # seq -> index of the worker it was dispatched to, until its result
+        # is received
+        self.dispatched = {}
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.total = None
+        self.closed = False
+
+    def start_workers(self):
+        """
+        Forks the workers, called by run() if not called before.
+        """
+        if len(self.processes) == 0:
+            for index in range(self.workers):
+                self._start_worker(index)
+            # before multiprocessing terminates the workers at exit, which
+            # would otherwise restart them
+            atexit.register(self.close)
+        return self
+
+    def run(self):
+        self.start_workers()
+        threading.Thread(target=self._fetch_loop, name="fetch", daemon=True).start()
+        self._output_loop()
+        self.close()
+
+    def close(self):
+        """
+        Terminates the workers.
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+        for process in self.processes.values():
+            process.terminate()
+            process.join()
+
+    def _start_worker(self, index):
+        task_queue = self.context.Queue()
+        reader, writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=self._worker_loop,
+            name="worker-{}".format(index),
+            args=(index, task_queue, writer),
+            daemon=True,
+        )
+        process.start()
+        # the worker holds the only write end, its exit ends the pipe
+        writer.close()
+        self.processes[index] = process
+        self.task_queues[index] = task_queue
+        self.result_readers[index] = reader
+
+    def _fetch_loop(self):
+        seq = 0
+        while True:
+            raw = self.fetch()
+            if raw is None:
+                with self.condition:
+                    # the number of records, ends the output loop
+                    self.total = seq
+                return
+            if isinstance(raw, memoryview):
+                # a received frame (streaming decode), the queue pickles bytes
+                raw = raw.tobytes()
+            IN_FLIGHT.inc()
+            profile = (
+                self.processor.profiler is not None and self.processor.profiler.select()
+            )
+            with self.condition:
+                while True:
+                    counts = collections.Counter(self.dispatched.values())
+                    index = min(self.processes, key=lambda index: counts[index])
+                    if counts[index] < self.queue_size:
+                        break
+                    self.condition.wait()
+                self.dispatched[seq] = index
+                self.task_queues[index].put((seq, raw, time.monotonic(), profile))
+            seq += 1
+
+    def _worker_loop(self, index, task_queue, results):
+        processor = self.processor
+        processor.after_fork()
+        processor.model.set_num_threads(self.threads_per_worker)
+        # the metrics are sent back with the record, see _output_loop
+        REGISTRY.start_capture()
+        log.info(
+            "Worker {} started with {} threads".format(index, self.threads_per_worker)
+        )
+        while True:
+            seq, raw, fetched, profile = task_queue.get()
+            record = Record(seq=seq, raw=raw, fetched=fetched)
+            processor.attach_profile(record, profile)
+            try:
+                for stage in STAGES[:-1]:
+                    record = processor.run_stage(stage, record)
+                    if record.skip:
+                        break
+            except Exception as e:
+                log.error("Record {} failed: {}".format(record.seq, e))
+                record.skip = True
+                record.failed = True
+            # the output stage runs in this process and is not profiled
+            processor.write_profile(record)
+            record.raw = None
+            record.parser = None
+            if record.generator is not None:
+                # the crops are encoded by now, don't send the images back
+                for pollinator in record.generator.pollinators:
+                    pollinator.crop = None
+            record.metrics = REGISTRY.drain()
+            results.send(record)
+
+    def _restart_worker(self, index):
+        """
+        Replaces a worker whose result pipe ended, all results it sent were
+        received before.
+        """
+        if self.closed:
+            return
+        process = self.processes[index]
+        process.join(timeout=5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        log.error(
+            "Worker {} exited with code {}, restarting".format(index, process.exitcode)
+        )
+        with self.condition:
+            if self.closed:
+                return
+            for seq in sorted(self.dispatched):
+                if self.dispatched[seq] != index:
+                    continue
+                del self.dispatched[seq]
+                log.error("Record {} failed, its worker exited".format(seq))
+                self.pending[seq] = Record(seq=seq, raw=None, skip=True, failed=True)
+            self.result_readers.pop(index).close()
+            task_queue = self.task_queues.pop(index)
+            task_queue.cancel_join_thread()
+            task_queue.close()
+            self._start_worker(index)
+            self.condition.notify_all()
+
+    def _output_loop(self):
+        next_seq = 0
+        while self.total is None or next_seq < self.total:
+            readers = {reader: index for index, reader in self.result_readers.items()}
+            for reader in multiprocessing.connection.wait(list(readers), timeout=1):
+                try:
+                    record = reader.recv()
+                except (EOFError, OSError):
+                    self._restart_worker(readers[reader])
+                    continue
+                with self.condition:
+                    del self.dispatched[record.seq]
+                    self.condition.notify_all()
+                REGISTRY.replay(record.metrics)
+                record.metrics = None
+                self.pending[record.seq] = record
+            while next_seq in self.pending:
+                record = self.pending.pop(next_seq)
+                next_seq += 1
+                _output_record(self.processor, record)
+                if self.done is not None:
+                    self.done(record)
+
+
+def _output_record(processor, record):
+    """
+    Outputs a record of the Pipeline or WorkerPool and counts its result.
+    """
+    IN_FLIGHT.dec()
+    if record.failed:
+        RECORDS.labels("failed").inc()
+    elif record.skip:
+        RECORDS.labels("skipped").inc()
+    else:
+        try:
+            processor.run_stage("output", record)
+        except Exception as e:
+            log.error("Output of record {} failed: {}".format(record.seq, e))
+            RECORDS.labels("failed").inc()
+            record.failed = True
+    processor.write_profile(record)
@@ -0,0 +1,174 @@
+"""
+On-demand profiling of the record processing.
+
+The Profiler selects records to profile, either the next N records after
+request() (e.g. on SIGUSR1) or every Mth record. The stages of a selected
+record run under cProfile, or with the torch engine the inference stage
+runs under torch.profiler. The trace is written to the profile directory
+together with a JSON file describing the record: node, flower count, crop
+sizes, number of pollinators and the duration of each stage. The profiled
+stages of concurrent records run one at a time, records that are not
+profiled are not held up.
+"""
+
+import cProfile
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+log.propagate = False
+log.setLevel(logging.INFO)
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(
+    logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+)
+log.addHandler(handler)
+
+ENGINES = ("cprofile", "torch")
+
+
+# a process can run one profiler at a time (Python >= 3.12 raises ValueError
+# when a second one is enabled), the profiled stages of records in different
+# threads take turns
+ACTIVE = threading.Lock()
+
+
+class ProfileSession:
+    """
+    Profile of a single record, its stages may run in different threads
+    but not concurrently.
+    """
+
+    def __init__(self, profiler, seq):
+        self.profiler = profiler
+        self.seq = seq
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.info = {"seq": seq}
+        self.stages = {}
+        self.profile = cProfile.Profile() if profiler.engine == "cprofile" else None
+        self.torch_profile = None
+
+    def run(self, name, stage, record):
+        if self.profile is None and name != "infer":
+            return self._run_timed(name, stage, record)
+        with ACTIVE:
+            if self.profile is not None:
+                return self._run_timed(name, self._run_cprofile, stage, record)
+            return self._run_timed(name, self._run_torch, stage, record)
+
+    def _run_timed(self, name, run, *args):
+        t0 = time.monotonic()
+        try:
+            return run(*args)
+        finally:
+            self.stages[name] = round(time.monotonic() - t0, 6)
+
+    def _run_cprofile(self, stage, record):
+        self.profile.enable()
+        try:
+            return stage(record)
+        finally:
+            self.profile.disable()
+
+    def _run_torch(self, stage, record):
+        import torch.profiler
+
+        with torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True
+        ) as self.torch_profile:
+            return stage(record)
+
+    def _path(self, extension):
+        node_id = self.info.get("node_id") or "unknown"
+        return os.path.join(
+            self.profiler.directory,
+            "{}_{}_{}{}".format(
+                self.started.strftime("%Y-%m-%dT%H-%M-%S.%fZ"),
+                node_id,
+                self.seq,
+                extension,
+            ),
+        )
+
+    def write(self):
+        """
+        Writes the trace and the record description, returns the path of
+        the description.
+        """
+        os.makedirs(self.profiler.directory, exist_ok=True)
+        traces = []
+        if self.profile is not None:
+            path = self._path(".prof")
+            self.profile.dump_stats(path)
+            traces.append(path)
+        if self.torch_profile is not None:
+            path = self._path(".trace.json")
+            self.torch_profile.export_chrome_trace(path)
+            traces.append(path)
+        info = dict(self.info)
+        info["profiled_at"] = self.started.isoformat()
+        info["engine"] = self.profiler.engine
+        info["stage_seconds"] = self.stages
+        info["traces"] = [os.path.basename(path) for path in traces]
+        path = self._path(".json")
+        with open(path, "w") as f:
+            json.dump(info, f, indent=2)
+        log.info(
+            "Profile of record {} written to {}".format(self.seq, ", ".join(traces))
+        )
+        return path
+
+
+class Profiler:
+    """
+    directory: where the traces are written
+    engine: cprofile (all stages) or torch (torch.profiler, inference stage)
+    records: number of records profiled per request()
+    every: also profile every Mth record, 0 disables sampling
+    """
+
+    def __init__(self, directory="profiles", engine="cprofile", records=10, every=0):
+        if engine not in ENGINES:
+            raise ValueError(
+                "Unknown profiling engine: {}, supported: {}".format(
+                    engine, ", ".join(ENGINES)
+                )
+            )
+        self.directory = directory
+        self.engine = engine
+        self.records = records
+        self.every = every
+        self.remaining = 0
+        self.selected = 0
+        self.lock = threading.Lock()
+
+    def request(self, records=None):
+        """
+        Profiles the next records (default: self.records). Safe to call from
+        a signal handler.
+        """
+        self.remaining = records or self.records
+        log.info(
+            "Profiling the next {} records, writing to {}".format(
+                self.remaining, self.directory
+            )
+        )
+
+    def select(self):
+        """
+        Returns True if the next record is to be profiled.
+        """
+        with self.lock:
+            self.selected += 1
+            if self.remaining > 0:
+                self.remaining -= 1
+                return True
+            return self.every > 0 and self.selected % self.every == 0
+
+    def session(self, seq):
+        return ProfileSession(self, seq)
@@ -0,0 +1,221 @@
+"""
+Reprocessing of stored input messages.
+
+Reads the input messages stored by MessageParser.store_message (JSON files)
+from a directory, a tar archive (optionally compressed) or a zip archive,
+and feeds them to the RecordProcessor instead of the ZMQ queue. A directory
+is read in the order of the file paths, an archive in the order of its
+members.
+
+The progress is kept in a checkpoint file: the number of messages whose
+results were handed to the sinks, which are output in input order, and the
+keys of the failed messages. An interrupted run continues after the last
+checkpoint; the results of up to checkpoint_interval seconds of messages
+before the interruption are output again and their failures updated.
+"""
+
+import json
+import logging
+import os
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+
+log = logging.getLogger(__name__)
+log.propagate = False
+log.setLevel(logging.INFO)
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(
+    logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+)
+log.addHandler(handler)
+
+MESSAGE_EXTENSION = ".json"
+
+
+class InputArchive:
+    """
+    The stored input messages of a directory, tar or zip archive.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tar = None
+        self.zip = None
+        if os.path.isdir(path):
+            self.keys = []
+            for directory, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith(MESSAGE_EXTENSION):
+                        self.keys.append(
+                            os.path.relpath(os.path.join(directory, filename), path)
+                        )
+        elif tarfile.is_tarfile(path):
+            self.tar = tarfile.open(path)
+            self.members = [
+                member
+                for member in self.tar.getmembers()
+                if member.isfile() and member.name.endswith(MESSAGE_EXTENSION)
+            ]
+            self.keys = [member.name for member in self.members]
+        elif zipfile.is_zipfile(path):
+            self.zip = zipfile.ZipFile(path)
+            self.keys = [
+                name for name in self.zip.namelist() if name.endswith(MESSAGE_EXTENSION)
+            ]
+        else:
+            raise ValueError("Not a directory, tar or zip archive: {}".format(path))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def read(self, index):
+        """
+        Returns the raw message at index, archives are read fastest in order.
+        """
+        if self.tar is not None:
+            with self.tar.extractfile(self.members[index]) as f:
+                return f.read()
+        if self.zip is not None:
+            return self.zip.read(self.keys[index])
+        with open(os.path.join(self.path, self.keys[index]), "rb") as f:
+            return f.read()
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+        if self.zip is not None:
+            self.zip.close()
+
+
+class Checkpoint:
+    """
+    path: the checkpoint file, written atomically
+    interval: min seconds between writes
+    """
+
+    def __init__(self, path, interval=10):
+        self.path = path
+        self.interval = interval
+        self.state = {"source": None, "done": 0, "last_key": None, "failed": []}
+        self.last_save = time.monotonic()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state.update(json.load(f))
+        self.failed_keys = set(self.state["failed"])
+
+    @property
+    def done(self):
+        return self.state["done"]
+
+    def update(self, done, last_key, failed=False, force=False):
+        self.state["done"] = done
+        self.state["last_key"] = last_key
+        # an interrupted run outputs the last messages again, list each once
+        if failed and last_key not in self.failed_keys:
+            self.failed_keys.add(last_key)
+            self.state["failed"].append(last_key)
+        elif not failed and last_key in self.failed_keys:
+            self.failed_keys.remove(last_key)
+            self.state["failed"].remove(last_key)
+        if force or time.monotonic() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.last_save = time.monotonic()
+
+
+class Reprocessor:
+    """
+    Provides fetch and done for the serial loop, Pipeline or WorkerPool.
+
+    path: directory or archive of stored input messages
+    checkpoint_path: default: <path>.checkpoint.json
+    """
+
+    def __init__(self, path, checkpoint_path=None, checkpoint_interval=10):
+        path = os.path.normpath(path)
+        self.archive = InputArchive(path)
+        if checkpoint_path is None:
+            checkpoint_path = path + ".checkpoint.json"
+        self.checkpoint = Checkpoint(checkpoint_path, interval=checkpoint_interval)
+        state = self.checkpoint.state
+        if state["source"] not in (None, os.path.abspath(path)):
+            raise ValueError(
+                "Checkpoint {} belongs to {}".format(checkpoint_path, state["source"])
+            )
+        state["source"] = os.path.abspath(path)
+        self.start = self.checkpoint.done
+        if self.start > 0 and (
+            self.start > len(self.archive)
+            or self.archive.keys[self.start - 1] != state["last_key"]
+        ):
+            raise ValueError(
+                "{} changed since the checkpoint {}, remove it to start over".format(
+                    path, checkpoint_path
+                )
+            )
+        self.next_index = self.start
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        log.info(
+            "Reprocessing {} messages of {}, {} already done, checkpoint: {}".format(
+                len(self.archive), path, self.start, checkpoint_path
+            )
+        )
+
+    def fetch(self):
+        """
+        Returns the next raw message, None after the last one.
+        """
+        with self.lock:
+            index = self.next_index
+            if index >= len(self.archive):
+                return None
+            self.next_index += 1
+        return self.archive.read(index)
+
+    def done(self, record):
+        """
+        Records the output of a record, the records are numbered from 0 in
+        the order they were fetched.
+        """
+        index = self.start + record.seq
+        key = self.archive.keys[index]
+        if record.failed:
+            log.error("Reprocessing {} failed".format(key))
+        self.checkpoint.update(
+            index + 1,
+            key,
+            failed=record.failed,
+            force=index + 1 == len(self.archive),
+        )
+        if (index + 1) % 100 == 0:
+            done = index + 1 - self.start
+            log.info(
+                "Reprocessed {} of {} messages ({:.1f}/s)".format(
+                    index + 1,
+                    len(self.archive),
+                    done / (time.monotonic() - self.started),
+                )
+            )
+
+    def close(self):
+        self.checkpoint.save()
+        self.archive.close()
+        log.info(
+            "Reprocessed {} of {} messages, {} failed".format(
+                self.checkpoint.done,
+                len(self.archive),
+                len(self.checkpoint.state["failed"]),
+            )
+        )
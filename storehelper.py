@@ -0,0 +1,263 @@
+"""
+Append-only storage of the results in hourly segments.
+
+Instead of one file per record, the results of a node are appended as JSON
+lines to one segment per hour:
+
+    <base_dir>/<node_id>/<date>/<node_id>_<date>T<hour>.jsonl
+
+The pollinator crops are appended as raw JPEG to a companion pack file
+(same name, .pack) and referenced in the line by [offset, length]. A crop is
+written to the pack before the line referencing it, so a crash leaves at
+most a partial last line, which read_segment() ignores. The files are
+flushed after each record and fsynced in batches, after fsync_records
+records or fsync_interval seconds.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+
+from formathelper import dumps_json, loads_json
+
+log = logging.getLogger(__name__)
+log.propagate = False
+log.setLevel(logging.INFO)
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(
+    logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+)
+log.addHandler(handler)
+
+LAYOUTS = ("files", "segments")
+SEGMENT_EXTENSION = ".jsonl"
+PACK_EXTENSION = ".pack"
+
+
+def check_layout(layout):
+    if layout not in LAYOUTS:
+        raise ValueError(
+            "Unknown file layout: {}, expected one of {}".format(layout, LAYOUTS)
+        )
+    return layout
+
+
+def segment_path(base_dir, node_id, timestamp):
+    """
+    Returns the path of the segment of a node and hour, without extension.
+    """
+    return os.path.join(
+        base_dir,
+        node_id,
+        timestamp.strftime("%Y-%m-%d"),
+        "{}_{}".format(node_id, timestamp.strftime("%Y-%m-%dT%H")),
+    )
+
+
+def _truncate_partial_line(path):
+    """
+    Removes a partial last line left by an interrupted write, so that the
+    next line is not appended to it.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            f.seek(max(0, end - 4096))
+            chunk = f.read(end - max(0, end - 4096))
+            newline = chunk.rfind(b"\n")
+            if newline >= 0:
+                end = max(0, end - 4096) + newline + 1
+                break
+            end = max(0, end - 4096)
+        if end < size:
+            log.warning(
+                "Truncating partial line at the end of {} ({} bytes)".format(
+                    path, size - end
+                )
+            )
+            f.truncate(end)
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        _truncate_partial_line(path + SEGMENT_EXTENSION)
+        self.lines = open(path + SEGMENT_EXTENSION, "ab")
+        self.pack = open(path + PACK_EXTENSION, "ab")
+        self.pack_size = self.pack.tell()
+        self.last_write = time.monotonic()
+        self.unsynced = 0
+
+    def append(self, line, crops):
+        """
+        Appends the crops to the pack and the line to the segment.
+        line: callable taking the [offset, length] of the crops and
+        returning the serialized line
+        crops: list of JPEG bytes
+        """
+        refs = []
+        for crop in crops:
+            self.pack.write(crop)
+            refs.append([self.pack_size, len(crop)])
+            self.pack_size += len(crop)
+        if len(crops) > 0:
+            self.pack.flush()
+        self.lines.write(line(refs))
+        self.lines.flush()
+        self.last_write = time.monotonic()
+        self.unsynced += 1
+
+    def sync(self):
+        if self.unsynced > 0:
+            os.fsync(self.pack.fileno())
+            os.fsync(self.lines.fileno())
+            self.unsynced = 0
+
+    def close(self):
+        self.sync()
+        self.pack.close()
+        self.lines.close()
+
+
+class SegmentStore:
+    """
+    base_dir: root of the segments
+    save_crops: store the pollinator crops in the pack files
+    fsync_records: fsync after this many records, 0 fsyncs after each record
+    fsync_interval: fsync pending records after this many seconds
+    idle_timeout: close segments not written for this many seconds
+    """
+
+    def __init__(
+        self,
+        base_dir,
+        save_crops=True,
+        fsync_records=100,
+        fsync_interval=5,
+        idle_timeout=300,
+    ):
+        self.base_dir = base_dir
+        self.save_crops = save_crops
+        self.fsync_records = fsync_records
+        self.fsync_interval = fsync_interval
+        self.idle_timeout = idle_timeout
+        # path without extension -> Segment
+        self.segments = {}
+        self.unsynced = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name="segment-store", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.segments = {}
+            self.unsynced = 0
+
+    def append(self, generator):
+        """
+        Appends the result of a MessageGenerator, its crops must be encoded
+        if save_crops is set (see MessageGenerator.encode_crops).
+        """
+        message = generator.generate_message(save_crop=self.save_crops, raw_crops=True)
+        pollinators = message["detections"]["pollinators"]
+        crops = [p["crop"] for p in pollinators if p["crop"] is not None]
+        timestamp = generator.timestamp
+
+        def line(refs):
+            refs = iter(refs)
+            for pollinator in pollinators:
+                if pollinator["crop"] is not None:
+                    pollinator["crop"] = next(refs)
+            record = {
+                "node_id": generator.node_id,
+                "timestamp": timestamp.isoformat(),
+                "filename": generator.generate_filename(),
+            }
+            record.update(message)
+            return dumps_json(record) + b"\n"
+
+        path = segment_path(self.base_dir, generator.node_id, timestamp)
+        with self.lock:
+            segment = self.segments.get(path)
+            if segment is None:
+                segment = self._open(path)
+            segment.append(line, crops)
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_records:
+                self._sync()
+        return path + SEGMENT_EXTENSION
+
+    def _open(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        segment = Segment(path)
+        self.segments[path] = segment
+        log.info("Opened segment: {}".format(path + SEGMENT_EXTENSION))
+        return segment
+
+    def _sync(self):
+        for segment in self.segments.values():
+            segment.sync()
+        self.unsynced = 0
+
+    def _run(self):
+        while not self.stopped.wait(self.fsync_interval):
+            now = time.monotonic()
+            with self.lock:
+                self._sync()
+                for path, segment in list(self.segments.items()):
+                    if now - segment.last_write > self.idle_timeout:
+                        segment.close()
+                        del self.segments[path]
+                        log.info("Closed segment: {}".format(path + SEGMENT_EXTENSION))
+
+
+def read_segment(path, crops=True):
+    """
+    Yields the results of a segment (path of the .jsonl file) as dicts in
+    the layout of the JSON messages, with node_id, timestamp and filename.
+    crops: load the crops from the pack file as raw JPEG bytes, otherwise
+    they stay [offset, length] references
+    A partial last line of an interrupted write is skipped.
+    """
+    pack = None
+    if crops:
+        pack_path = path[: -len(SEGMENT_EXTENSION)] + PACK_EXTENSION
+        if os.path.exists(pack_path):
+            pack = open(pack_path, "rb")
+    try:
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    log.warning("Skipping partial line at the end of {}".format(path))
+                    break
+                record = loads_json(line)
+                if crops:
+                    for pollinator in record["detections"]["pollinators"]:
+                        if pollinator["crop"] is None:
+                            continue
+                        offset, length = pollinator["crop"]
+                        if pack is None:
+                            pollinator["crop"] = None
+                            continue
+                        pack.seek(offset)
+                        pollinator["crop"] = pack.read(length)
+                yield record
+    finally:
+        if pack is not None:
+            pack.close()
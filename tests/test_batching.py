@@ -0,0 +1,46 @@
+"""
+Tests of grouping flower crops into model batches (yolomodelhelper).
+
+    python -m pytest tests
+"""
+
+import numpy as np
+
+from backendhelper import letterbox_shape
+from yolomodelhelper import group_input_shapes
+
+
+def padding(shapes, batch):
+    high = np.max([shapes[i] for i in batch], 0)
+    return max((high - shapes[i]).max() for i in batch)
+
+
+def test_same_shapes_in_batches_of_max_batch_size():
+    shapes = [(640, 480)] * 5
+    assert group_input_shapes(shapes, 0, 2) == [[0, 1], [2, 3], [4]]
+
+
+def test_without_padding_only_same_shapes():
+    shapes = [(640, 480), (640, 512), (640, 480), (480, 640)]
+    assert group_input_shapes(shapes, 0, 8) == [[3], [0, 2], [1]]
+
+
+def test_padding_within_max_padding():
+    rng = np.random.default_rng(0)
+    shapes = [
+        letterbox_shape(np.zeros((h, w, 3)), 640, 32)
+        for w, h in rng.integers(150, 600, size=(100, 2))
+    ]
+    for max_padding in (0, 32, 64, 128, 640):
+        batches = group_input_shapes(shapes, max_padding, 8)
+        assert sorted(i for batch in batches for i in batch) == list(range(100))
+        assert all(len(batch) <= 8 for batch in batches)
+        assert all(padding(shapes, batch) <= max_padding for batch in batches)
+    assert len(group_input_shapes(shapes, 640, 8)) == 13
+    assert len(group_input_shapes(shapes, 64, 8)) < len(
+        group_input_shapes(shapes, 0, 8)
+    )
+
+
+def test_no_images():
+    assert group_input_shapes([], 64, 8) == []
@@ -0,0 +1,87 @@
+"""
+Tests of the benchmark's synthetic records, queue server and sinks against
+the clients of the service.
+
+    python -m pytest tests
+"""
+
+import time
+
+import pytest
+
+from benchmark.queue_server import QueueServer
+from benchmark.records import RecordGenerator
+from benchmark.sinks import HTTPSink, MQTTSink
+from formathelper import dumps_json, loads_json
+from messagehelper import HTTPClient, MessageParser, MQTTClient
+from zmqhelper import ZMQInputClient
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_records_are_valid_input():
+    generator = RecordGenerator(num_flowers=(1, 3), crop_size=(50, 80), pool_size=4)
+    records = generator.records(8)
+    keys = set()
+    for record in records:
+        parser = MessageParser()
+        assert parser.parse_message(record)
+        assert 1 <= parser.num_detections <= 3
+        assert all(50 <= side <= 80 for size in parser.image_sizes for side in size)
+        keys.add((parser.node_id, parser.timestamp))
+    assert len(keys) == 8
+    again = RecordGenerator(num_flowers=(1, 3), crop_size=(50, 80), pool_size=4)
+    assert again.records(8) == records
+
+
+@pytest.mark.parametrize("decode_records", [True, False])
+def test_queue_server(decode_records):
+    records = [{"metadata": {"index": i}} for i in range(5)]
+    server = QueueServer(records).start()
+    client = ZMQInputClient(
+        "127.0.0.1", server.port, prefetch=2, decode_records=decode_records
+    ).start()
+    try:
+        received = [client.get(timeout=5) for _ in range(5)]
+        if not decode_records:
+            received = [loads_json(record) for record in received]
+        assert received == records
+        wait_for(lambda: len(server) == 0)
+        assert client.get(timeout=0.2) is None
+    finally:
+        client.close()
+        server.close()
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "zstd"])
+def test_http_sink_counts_batched_results(compression):
+    sink = HTTPSink().start()
+    url = "http://{}:{}/results".format(sink.host, sink.port)
+    client = HTTPClient(
+        url, None, None, compression=compression, batch_size=4, batch_interval=50
+    ).start()
+    try:
+        for i in range(10):
+            client.send_message({"result": i})
+        wait_for(lambda: sink.stats.to_dict()["messages"] == 10)
+        assert sink.stats.to_dict()["requests"] >= 3
+    finally:
+        sink.close()
+
+
+def test_mqtt_sink_counts_published_results():
+    sink = MQTTSink().start()
+    client = MQTTClient(sink.host, sink.port, "results/${node_id}", None, None, False)
+    client.start()
+    try:
+        for i in range(5):
+            client.publish(dumps_json({"result": i}), node_id="node")
+        wait_for(lambda: sink.stats.to_dict()["messages"] == 5)
+    finally:
+        client.close()
+        sink.close()
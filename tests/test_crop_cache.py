@@ -0,0 +1,107 @@
+"""
+Tests of skipping unchanged empty flower crops (cropcachehelper,
+pipelinehelper.RecordProcessor).
+
+    python -m pytest tests
+"""
+
+import json
+
+import numpy as np
+import pytest
+from PIL import Image, ImageEnhance
+
+import yolomodelhelper
+from backendhelper import to_rgb_array
+from benchmark.records import RecordGenerator, synthetic_crop
+from cropcachehelper import EmptyCropCache, fingerprint, hamming_distance
+from pipelinehelper import Record, RecordProcessor
+from yolomodelhelper import YoloModel
+
+
+class Backend:
+    """
+    Counts the images it is called with and detects nothing.
+    """
+
+    name = "counting"
+    stride = 32
+    names = {0: "bee"}
+
+    def __init__(self):
+        self.images = 0
+        self.timings = {}
+
+    def predict(self, images, size=640, augment=False, max_det=None):
+        self.images += len(images)
+        return [(np.zeros((0, 6)), to_rgb_array(image)) for image in images]
+
+
+@pytest.fixture
+def model(monkeypatch):
+    monkeypatch.setattr(
+        yolomodelhelper, "create_backend", lambda *args, **kwargs: Backend()
+    )
+    return YoloModel("model.pt")
+
+
+def crop(seed, width=200, height=150):
+    return synthetic_crop(np.random.default_rng(seed), width, height)
+
+
+def test_fingerprint_of_similar_crops():
+    image = crop(0)
+    value = fingerprint(image)
+    assert 0 <= value < 2**64
+    assert fingerprint(image.resize((100, 75))) == value
+    brighter = ImageEnhance.Brightness(image).enhance(1.05)
+    assert hamming_distance(fingerprint(brighter), value) <= 4
+    assert hamming_distance(fingerprint(crop(1)), value) > 4
+    assert (
+        hamming_distance(fingerprint(image.transpose(Image.FLIP_LEFT_RIGHT)), value) > 4
+    )
+
+
+def test_match():
+    cache = EmptyCropCache(max_distance=2)
+    cache.add("a", 0b1011, (200, 150), now=0)
+    assert cache.match("a", 0b1011, (200, 150), now=1)
+    assert cache.match("a", 0b0010, (210, 140), now=1)
+    assert not cache.match("a", 0b0100, (200, 150), now=1)
+    assert not cache.match("a", 0b1011, (240, 150), now=1)
+    assert not cache.match("b", 0b1011, (200, 150), now=1)
+
+
+def test_entries_expire():
+    cache = EmptyCropCache(ttl=10)
+    cache.add("a", 1, (100, 100), now=0)
+    # hits do not extend the ttl
+    assert cache.match("a", 1, (100, 100), now=9)
+    assert not cache.match("a", 1, (100, 100), now=10)
+    assert len(cache.nodes["a"]) == 0
+
+
+def test_least_recently_matched_are_evicted():
+    cache = EmptyCropCache(max_distance=0, max_entries=2)
+    cache.add("a", 1, (100, 100), now=0)
+    cache.add("a", 2, (100, 100), now=0)
+    assert cache.match("a", 1, (100, 100), now=0)
+    cache.add("a", 4, (100, 100), now=0)
+    assert list(cache.nodes["a"]) == [1, 4]
+
+
+def test_unchanged_crops_are_skipped(model):
+    processor = RecordProcessor(
+        model, crop_cache=EmptyCropCache(), crop_encode_threads=1
+    )
+    raw = json.dumps(RecordGenerator(num_flowers=(3, 3), nodes=1).record(0))
+
+    def infer():
+        record = processor.decode(Record(seq=0, raw=raw.encode()))
+        record = processor.infer(record)
+        return record.generator.metadata["pollinator_inference"]
+
+    assert infer()["skipped_flowers"] == []
+    assert model.backend.images == 3
+    assert infer()["skipped_flowers"] == [0, 1, 2]
+    assert model.backend.images == 3
@@ -0,0 +1,122 @@
+"""
+Tests of encoding the pollinator crops once for all outputs (messagehelper,
+pipelinehelper.RecordProcessor).
+
+    python -m pytest tests
+"""
+
+import datetime
+import glob
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from formathelper import decode_result
+from messagehelper import Flower, MessageGenerator, Pollinator
+from pipelinehelper import Record, RecordProcessor
+
+
+class CountingImage:
+    """
+    An image counting how often it was encoded.
+    """
+
+    def __init__(self, color):
+        self.image = Image.new("RGB", (24, 16), color)
+        self.saves = 0
+        self.lock = threading.Lock()
+
+    def save(self, fp, format=None):
+        with self.lock:
+            self.saves += 1
+        self.image.save(fp, format=format)
+
+
+class Client:
+    def __init__(self, format):
+        self.format = format
+        self.payloads = []
+
+    def publish(self, payload, **kwargs):
+        self.payloads.append(payload)
+
+    send_message = publish
+
+
+def make_generator(num_pollinators=3):
+    generator = MessageGenerator()
+    generator.set_node_id("node")
+    generator.set_timestamp(datetime.datetime(2024, 6, 1, 12, 0, 0))
+    generator.set_metadata({"node_id": "node"})
+    generator.add_flower(Flower(0, "flower", 0.9, 100, 80))
+    for i in range(num_pollinators):
+        generator.add_pollinator(
+            Pollinator(i, 0, "bee", 0.8, 24, 16, CountingImage((i * 60, 0, 0)))
+        )
+    return generator
+
+
+def saves(generator):
+    return [pollinator.crop.saves for pollinator in generator.pollinators]
+
+
+def test_crops_encoded_once_for_all_outputs(tmp_path):
+    mqtt_client = Client("msgpack")
+    http_client = Client("json")
+    processor = RecordProcessor(
+        None,
+        store_file=True,
+        base_dir=str(tmp_path),
+        file_format="cbor",
+        mqtt_client=mqtt_client,
+        http_client=http_client,
+        crop_encode_threads=2,
+    )
+    generator = make_generator()
+    record = processor.encode(Record(seq=0, raw=None, generator=generator))
+    processor.output(record)
+    assert saves(generator) == [1, 1, 1]
+    crops = [pollinator.crop_jpeg for pollinator in generator.pollinators]
+    [path] = glob.glob(str(tmp_path / "node" / "*" / "*" / "*.cbor"))
+    for payload, format in (
+        (mqtt_client.payloads[0], "msgpack"),
+        (http_client.payloads[0], "json"),
+        (open(path, "rb").read(), "cbor"),
+    ):
+        message = decode_result(payload, format)
+        if format == "json":
+            assert [p["crop"] for p in message["detections"]["pollinators"]] == [
+                pollinator.crop_b64 for pollinator in generator.pollinators
+            ]
+        else:
+            assert [p["crop"] for p in message["detections"]["pollinators"]] == crops
+
+
+def test_crops_not_encoded_without_an_output_including_them(tmp_path):
+    processor = RecordProcessor(
+        None, store_file=True, base_dir=str(tmp_path), save_crops=False
+    )
+    generator = make_generator()
+    record = processor.encode(Record(seq=0, raw=None, generator=generator))
+    processor.output(record)
+    assert saves(generator) == [0, 0, 0]
+    [path] = glob.glob(str(tmp_path / "node" / "*" / "*" / "*.json"))
+    message = decode_result(open(path, "rb").read())
+    assert [p["crop"] for p in message["detections"]["pollinators"]] == [None] * 3
+
+
+def test_encode_crops_in_parallel():
+    serial = make_generator(8)
+    serial.encode_crops()
+    parallel = make_generator(8)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        parallel.encode_crops(executor)
+    assert saves(parallel) == [1] * 8
+    assert [p.crop_jpeg for p in parallel.pollinators] == [
+        p.crop_jpeg for p in serial.pollinators
+    ]
+    # encoded crops are kept when the image is released, as in streaming decode
+    for pollinator in parallel.pollinators:
+        pollinator.crop = None
+    assert parallel.generate_message() == serial.generate_message()
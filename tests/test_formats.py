@@ -0,0 +1,93 @@
+"""
+Tests of the serialization of result messages (formathelper).
+
+    python -m pytest tests
+"""
+
+import datetime
+import json
+
+import cbor2
+import msgpack
+import pytest
+from PIL import Image
+
+import formathelper
+from formathelper import (
+    FORMATS,
+    check_format,
+    decode_result,
+    encode_result,
+    join_payloads,
+    loads_json,
+    to_json_message,
+)
+from messagehelper import Flower, MessageGenerator, Pollinator
+
+
+def make_generator():
+    generator = MessageGenerator()
+    generator.set_node_id("node")
+    generator.set_timestamp(datetime.datetime(2024, 6, 1, 12, 0, 0))
+    generator.set_metadata(
+        {"node_id": "node", "pollinator_inference": {"model_name": "bees"}}
+    )
+    generator.add_flower(Flower(0, "flower", 0.91234, 100, 80))
+    for i in range(3):
+        crop = Image.new("RGB", (20 + i, 10), (i * 80, 50, 50))
+        generator.add_pollinator(Pollinator(i, 0, "bee", 0.8, 20 + i, 10, crop))
+    return generator
+
+
+@pytest.mark.parametrize("format", FORMATS)
+@pytest.mark.parametrize("save_crop", [True, False])
+def test_round_trip(format, save_crop):
+    generator = make_generator()
+    expected = generator.generate_message(save_crop=save_crop)
+    message = decode_result(encode_result(generator, format, save_crop), format)
+    if format != "json" and save_crop:
+        assert message["detections"]["pollinators"][0]["crop"] == (
+            generator.pollinators[0].crop_jpeg
+        )
+    assert to_json_message(message) == json.loads(json.dumps(expected))
+
+
+def test_json_without_orjson(monkeypatch):
+    generator = make_generator()
+    payload = encode_result(generator)
+    monkeypatch.setattr(formathelper, "orjson", None)
+    assert json.loads(encode_result(generator)) == json.loads(payload)
+    assert decode_result(payload) == json.loads(payload)
+    assert loads_json(memoryview(payload)) == json.loads(payload)
+
+
+def serialize(value, format):
+    if format == "json":
+        return json.dumps(value).encode()
+    if format == "msgpack":
+        return msgpack.packb(value)
+    return cbor2.dumps(value)
+
+
+@pytest.mark.parametrize(
+    "format,loads",
+    [("json", json.loads), ("msgpack", msgpack.unpackb), ("cbor", cbor2.loads)],
+)
+@pytest.mark.parametrize("count", [0, 1, 15, 16, 23, 24, 255, 256, 70000])
+def test_join_payloads(format, loads, count):
+    payloads = [serialize(i, format) for i in range(count)]
+    assert loads(join_payloads(payloads, format)) == list(range(count))
+
+
+def test_multipart_has_no_array():
+    assert join_payloads([b"1", b"2"], "multipart") is None
+
+
+def test_unknown_format():
+    assert check_format("cbor") == "cbor"
+    with pytest.raises(ValueError):
+        check_format("xml")
+    with pytest.raises(ValueError):
+        encode_result(make_generator(), "xml")
+    with pytest.raises(ValueError):
+        decode_result(b"", "xml")
@@ -0,0 +1,100 @@
+"""
+Tests of the multi_label grouping (yolomodelhelper.group_overlapping_boxes).
+
+    python -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+from benchmark.bench_grouping import (
+    legacy_compute_iou,
+    legacy_group_overlapping_boxes,
+)
+from yolomodelhelper import compute_iou_matrix, group_overlapping_boxes
+
+
+def chain_boxes(order):
+    """
+    Boxes of equal size in a row, box order[k] overlaps only its neighbours
+    order[k - 1] and order[k + 1] (IoU 1/3), the others just touch or are apart.
+    """
+    boxes = np.zeros((len(order), 4))
+    for position, index in enumerate(order):
+        boxes[index] = [5 * position, 0, 5 * position + 10, 10]
+    return boxes
+
+
+def transitive_closure(boxes, iou_threshold):
+    """
+    Boolean matrix, True where two boxes are connected by a chain of pairs
+    with IoU > iou_threshold.
+    """
+    reachable = compute_iou_matrix(boxes) > iou_threshold
+    reachable |= np.eye(len(boxes), dtype=bool)
+    while True:
+        extended = (reachable.astype(int) @ reachable.astype(int)) > 0
+        if (extended == reachable).all():
+            return reachable
+        reachable = extended
+
+
+def random_boxes(rng, num_boxes, image_size=640, jitter=20.0):
+    """
+    Boxes in clusters with enough jitter to form chains of overlaps.
+    """
+    num_clusters = max(1, num_boxes // 3)
+    centers = rng.uniform(50, image_size - 50, size=(num_clusters, 2))
+    sizes = rng.uniform(20, 80, size=(num_clusters, 2))
+    cluster = rng.integers(0, num_clusters, size=num_boxes)
+    center = centers[cluster] + rng.normal(0, jitter, size=(num_boxes, 2))
+    size = np.abs(sizes[cluster] + rng.normal(0, jitter, size=(num_boxes, 2))) + 1
+    return np.concatenate([center - size / 2, center + size / 2], axis=1)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_groups_are_transitive_closure(seed):
+    rng = np.random.default_rng(seed)
+    boxes = random_boxes(rng, int(rng.integers(1, 60)))
+    groups = group_overlapping_boxes(boxes, 0.3)
+    same_group = groups[:, None] == groups[None, :]
+    assert (same_group == transitive_closure(boxes, 0.3)).all()
+    # numbered in order of the first box of each group
+    first_seen = list(dict.fromkeys(groups.tolist()))
+    assert first_seen == list(range(len(first_seen)))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_iou_matrix_matches_pairwise(seed):
+    boxes = random_boxes(np.random.default_rng(seed), 30)
+    iou = compute_iou_matrix(boxes)
+    for i in range(len(boxes)):
+        for j in range(len(boxes)):
+            assert iou[i, j] == pytest.approx(legacy_compute_iou(boxes[i], boxes[j]))
+
+
+def test_chain_grouping():
+    # overlapping pairs 0-2, 1-2 and 1-3
+    boxes = chain_boxes([0, 2, 1, 3])
+    overlapping = compute_iou_matrix(boxes) > 0.3
+    assert sorted(zip(*np.nonzero(np.triu(overlapping, k=1)))) == [
+        (0, 2),
+        (1, 2),
+        (1, 3),
+    ]
+    assert group_overlapping_boxes(boxes, 0.3).tolist() == [0, 0, 0, 0]
+    # the legacy grouping adds box 1 to the group of 0 and 2 in its final
+    # scan without following its overlap with 3, 3 starts a second group
+    # that takes box 1 along, so 1 and 2 end up apart although they overlap
+    assert legacy_group_overlapping_boxes(boxes.tolist(), 0.3) == [0, 1, 0, 1]
+
+
+def test_legacy_agrees_without_chains():
+    # overlapping pairs 0-1 and 2-3, two separate groups
+    boxes = np.concatenate([chain_boxes([0, 1]), chain_boxes([0, 1]) + 100])
+    assert group_overlapping_boxes(boxes, 0.3).tolist() == [0, 0, 1, 1]
+    assert legacy_group_overlapping_boxes(boxes.tolist(), 0.3) == [0, 0, 1, 1]
+
+
+def test_no_boxes():
+    assert group_overlapping_boxes(np.zeros((0, 4)), 0.3).tolist() == []
@@ -0,0 +1,73 @@
+"""
+Tests of the request bodies of the HTTPClient (messagehelper).
+
+    python -m pytest tests
+"""
+
+import gzip
+import threading
+
+import zstandard
+
+from messagehelper import HTTPClient
+
+
+class Response:
+    status_code = 200
+
+
+def capture_requests(client):
+    bodies = []
+    lock = threading.Lock()
+
+    def request(method, url, data=None, timeout=None):
+        with lock:
+            bodies.append(data)
+        return Response()
+
+    client.session.request = request
+    return bodies
+
+
+def send_from_threads(client, num_threads=8, per_thread=50):
+    payloads = [
+        (b'{"thread": %d, "result": %d, "pad": "' % (t, i)) + b"x" * (i * 97) + b'"}'
+        for t in range(num_threads)
+        for i in range(per_thread)
+    ]
+
+    def send(thread):
+        for payload in payloads[thread * per_thread : (thread + 1) * per_thread]:
+            assert client._send(client.url, payload) == 200
+
+    threads = [threading.Thread(target=send, args=(t,)) for t in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return payloads
+
+
+def test_zstd_from_concurrent_threads():
+    client = HTTPClient("http://localhost/results", None, None, compression="zstd")
+    bodies = capture_requests(client)
+    payloads = send_from_threads(client)
+    decompressor = zstandard.ZstdDecompressor()
+    assert sorted(decompressor.decompress(body) for body in bodies) == sorted(payloads)
+    assert client.session.headers["Content-Encoding"] == "zstd"
+
+
+def test_gzip():
+    client = HTTPClient("http://localhost/results", None, None, compression="gzip")
+    bodies = capture_requests(client)
+    assert client._send(client.url, b'{"a": 1}') == 200
+    assert gzip.decompress(bodies[0]) == b'{"a": 1}'
+    assert client.session.headers["Content-Encoding"] == "gzip"
+
+
+def test_no_compression():
+    client = HTTPClient("http://localhost/results", None, None)
+    bodies = capture_requests(client)
+    assert client._send(client.url, b'{"a": 1}') == 200
+    assert bodies == [b'{"a": 1}']
+    assert "Content-Encoding" not in client.session.headers
@@ -0,0 +1,152 @@
+"""
+Tests of the index of the stored results (indexhelper).
+
+    python -m pytest tests
+"""
+
+import datetime
+import json
+import os
+
+from PIL import Image
+
+from indexhelper import ResultIndex, main, parse_filename, parse_timestamp
+from messagehelper import Flower, MessageGenerator, Pollinator
+from storehelper import SegmentStore
+
+START = datetime.datetime(2024, 6, 1, 12, 0, 0)
+
+
+def make_generator(node_id, minutes, pollinators=(), flower_class="flower"):
+    """
+    pollinators: (class_name, score) of the pollinators of the result
+    """
+    generator = MessageGenerator()
+    generator.set_node_id(node_id)
+    generator.set_timestamp(START + datetime.timedelta(minutes=minutes))
+    generator.set_metadata({"node_id": node_id})
+    generator.add_flower(Flower(0, flower_class, 0.9, 100, 80))
+    for i, (class_name, score) in enumerate(pollinators):
+        crop = Image.new("RGB", (16, 16), (i * 50, 80, 80))
+        generator.add_pollinator(Pollinator(i, 0, class_name, score, 16, 16, crop))
+    generator.encode_crops()
+    return generator
+
+
+def timestamp(minutes):
+    return parse_timestamp((START + datetime.timedelta(minutes=minutes)).isoformat())
+
+
+def store_results(base_dir):
+    """
+    Stores results as files in each format and in segments, returns the
+    segment store, still open for appending.
+    """
+    for minutes, format in enumerate(["json", "msgpack", "cbor", "multipart"]):
+        generator = make_generator("files", minutes, [("hummel", 0.4 + minutes / 10)])
+        generator.store_message(base_dir, format=format)
+    store = SegmentStore(base_dir)
+    store.append(make_generator("seg", 0, [("honigbiene", 0.8), ("hummel", 0.3)]))
+    store.append(make_generator("seg", 5))
+    store.append(make_generator("seg", 70, [("fliege", 0.6)], "margerite"))
+    return store
+
+
+def test_parse_filename():
+    assert parse_filename("3200-5030_2022-07-07T08-48-00Z.json") == (
+        "3200-5030",
+        parse_timestamp("2022-07-07T08:48:00+00:00"),
+    )
+
+
+def test_query(tmp_path):
+    base_dir = str(tmp_path / "output")
+    store_results(base_dir).close()
+    index = ResultIndex(str(tmp_path / "index.sqlite"))
+    assert index.update(base_dir) == 6
+    results = index.query()
+    assert [(r["node_id"], r["timestamp"]) for r in results] == [
+        ("files", timestamp(0)),
+        ("seg", timestamp(0)),
+        ("files", timestamp(1)),
+        ("files", timestamp(2)),
+        ("files", timestamp(3)),
+        ("seg", timestamp(5)),
+        ("seg", timestamp(70)),
+    ]
+    assert results[1]["classes"] == {"flower": 1, "honigbiene": 1, "hummel": 1}
+    assert (results[1]["flowers"], results[1]["pollinators"]) == (1, 2)
+
+    def query(**kwargs):
+        return [(r["node_id"], r["timestamp"]) for r in index.query(**kwargs)]
+
+    assert query(node_id="seg", since=timestamp(1), until=timestamp(70)) == [
+        ("seg", timestamp(5))
+    ]
+    assert query(class_name="hummel", min_score=0.5) == [
+        ("files", timestamp(1)),
+        ("files", timestamp(2)),
+        ("files", timestamp(3)),
+    ]
+    assert query(class_name="margerite", kind="pollinator") == []
+    assert query(class_name="margerite", kind="flower") == [("seg", timestamp(70))]
+    assert len(query(limit=2)) == 2
+    index.close()
+
+
+def test_segment_offsets_point_to_the_lines(tmp_path):
+    base_dir = str(tmp_path)
+    store_results(base_dir).close()
+    index = ResultIndex(str(tmp_path / "index.sqlite"))
+    index.update(base_dir)
+    for result in index.query(node_id="seg"):
+        with open(os.path.join(base_dir, result["path"]), "rb") as f:
+            f.seek(result["offset"])
+            record = json.loads(f.readline())
+        assert parse_timestamp(record["timestamp"]) == result["timestamp"]
+    index.close()
+
+
+def test_incremental_update(tmp_path):
+    base_dir = str(tmp_path / "output")
+    store = store_results(base_dir)
+    store.close()
+    index = ResultIndex(str(tmp_path / "index.sqlite"))
+    index.update(base_dir)
+    assert index.update(base_dir) == 0
+    # only the appended lines of a segment are read
+    store = SegmentStore(base_dir)
+    store.append(make_generator("seg", 10, [("hummel", 0.9)]))
+    store.close()
+    assert index.update(base_dir) == 1
+    assert len(index.query(node_id="seg")) == 4
+    # a partial last line is indexed once it is complete
+    [segment] = [r["path"] for r in index.query(node_id="seg", limit=1)]
+    with open(os.path.join(base_dir, segment), "rb") as f:
+        line = f.readlines()[-1]
+    with open(os.path.join(base_dir, segment), "ab") as f:
+        f.write(line[:20])
+    assert index.update(base_dir) == 1
+    assert len(index.query(node_id="seg")) == 4
+    with open(os.path.join(base_dir, segment), "ab") as f:
+        f.write(line[20:])
+    index.update(base_dir)
+    assert len(index.query(node_id="seg")) == 5
+    # removed files are removed from the index
+    [json_file] = [r["path"] for r in index.query() if r["path"].endswith(".json")]
+    os.remove(os.path.join(base_dir, json_file))
+    index.update(base_dir)
+    assert json_file not in [r["path"] for r in index.query()]
+    assert len(index.query()) == 8
+    index.close()
+
+
+def test_cli(tmp_path, capsys):
+    base_dir = str(tmp_path)
+    store_results(base_dir).close()
+    main(["query", base_dir, "--class", "honigbiene", "--json"])
+    [line] = capsys.readouterr().out.splitlines()
+    result = json.loads(line)
+    assert result["node_id"] == "seg"
+    assert result["timestamp"] == "2024-06-01T12:00:00"
+    assert os.path.exists(os.path.join(base_dir, "index.sqlite"))
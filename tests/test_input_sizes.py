@@ -0,0 +1,92 @@
+"""
+Tests of the adaptive per-crop input sizes (yolomodelhelper,
+pipelinehelper.RecordProcessor).
+
+    python -m pytest tests
+"""
+
+import json
+
+import numpy as np
+import pytest
+
+import yolomodelhelper
+from backendhelper import to_rgb_array
+from benchmark.records import RecordGenerator
+from pipelinehelper import Record, RecordProcessor
+from yolomodelhelper import YoloModel, choose_input_size
+
+SIZES = [256, 320, 416, 640]
+
+
+class Backend:
+    """
+    Records the batches it is called with and detects nothing.
+    """
+
+    name = "recording"
+    stride = 32
+    names = {0: "bee"}
+
+    def __init__(self):
+        self.calls = []
+        self.timings = {}
+
+    def predict(self, images, size=640, augment=False, max_det=None):
+        self.calls.append((size, len(images)))
+        return [(np.zeros((0, 6)), to_rgb_array(image)) for image in images]
+
+
+@pytest.fixture
+def model(monkeypatch):
+    monkeypatch.setattr(
+        yolomodelhelper, "create_backend", lambda *args, **kwargs: Backend()
+    )
+    return YoloModel("model.pt", max_batch_size=2, max_batch_padding=640)
+
+
+def test_choose_input_size():
+    assert choose_input_size(100, 50, SIZES) == 256
+    assert choose_input_size(200, 300, SIZES) == 320
+    assert choose_input_size(320, 1, SIZES) == 320
+    assert choose_input_size(321, 1, SIZES) == 416
+    assert choose_input_size(1000, 10, SIZES) == 640
+    assert choose_input_size(10, 10, [640, 320]) == 320
+
+
+def test_images_batched_per_input_size(model):
+    images = [np.zeros((h, w, 3), dtype=np.uint8) for w, h in [(100, 80)] * 5]
+    sizes = [256, 640, 256, 256, 640]
+    results = model.predict_batch(images, sizes)
+    assert len(results) == 5 and all(len(result) == 0 for result in results)
+    assert model.backend.calls == [(256, 2), (256, 1), (640, 2)]
+    assert model.number_of_inferences == 5
+
+
+def test_ladder_aligned_to_the_stride(model):
+    assert model.align_input_size(300) == 320
+    processor = RecordProcessor(model, input_sizes=[250, 320, 330, 320])
+    assert processor.input_sizes == [256, 320, 352]
+
+
+@pytest.mark.parametrize("streaming_decode", [False, True])
+def test_input_sizes_in_metadata(model, streaming_decode):
+    processor = RecordProcessor(
+        model,
+        input_sizes=SIZES,
+        streaming_decode=streaming_decode,
+        crop_encode_threads=1,
+    )
+    raw = RecordGenerator(num_flowers=(4, 4), crop_size=(100, 500)).record(0)
+    record = processor.decode(Record(seq=0, raw=json.dumps(raw).encode()))
+    assert (record.parser.data is not None) == streaming_decode
+    record = processor.infer(record)
+    metadata = record.generator.metadata["pollinator_inference"]
+    expected = [
+        choose_input_size(flower.width, flower.height, SIZES)
+        for flower in record.generator.flowers
+    ]
+    assert len(set(expected)) > 1
+    assert metadata["input_sizes"] == expected
+    inferred = [size for size, count in model.backend.calls for _ in range(count)]
+    assert sorted(inferred) == sorted(expected)
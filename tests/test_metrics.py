@@ -0,0 +1,231 @@
+"""
+Tests of the Prometheus text rendering of metricshelper.
+
+    python -m pytest tests
+"""
+
+import math
+import re
+import urllib.error
+import urllib.request
+
+import pytest
+
+from metricshelper import (
+    FLOWERS,
+    REGISTRY,
+    STAGE_SECONDS,
+    Counter,
+    Gauge,
+    Histogram,
+    MetricsServer,
+    Registry,
+    bucket_quantile,
+)
+from pipelinehelper import RecordProcessor, WorkerPool
+
+NAME = r"[a-zA-Z_:][a-zA-Z0-9_:]*"
+LABEL_VALUE = r'"(?:[^"\\\n]|\\\\|\\n|\\")*"'
+SAMPLE = re.compile(
+    r"^({name})(\{{({name}={value}(?:,{name}={value})*)\}})? (\S+)$".format(
+        name=NAME, value=LABEL_VALUE
+    )
+)
+LABEL = re.compile(r"({})=({})".format(NAME, LABEL_VALUE))
+
+
+def unescape(value):
+    return re.sub(
+        r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), value[1:-1]
+    )
+
+
+def parse(text):
+    """
+    Parses the text exposition format into {name: (help, type)} and a list
+    of (name, labels, value) samples, failing on a malformed line.
+    """
+    assert text.endswith("\n")
+    metadata = {}
+    samples = []
+    for line in text[:-1].split("\n"):
+        if line.startswith("# HELP "):
+            name, help = line[len("# HELP ") :].split(" ", 1)
+            metadata[name] = (help, None)
+        elif line.startswith("# TYPE "):
+            name, type = line[len("# TYPE ") :].split(" ")
+            assert name in metadata
+            metadata[name] = (metadata[name][0], type)
+        else:
+            match = SAMPLE.match(line)
+            assert match is not None, line
+            labels = {
+                name: unescape(value)
+                for name, value in LABEL.findall(match.group(3) or "")
+            }
+            samples.append((match.group(1), labels, float(match.group(4))))
+    return metadata, samples
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    counter = Counter("test_total", "Test", ["path"], registry=registry)
+    counter.labels('C:\\dir\n"name"').inc()
+    assert 'test_total{path="C:\\\\dir\\n\\"name\\""} 1' in registry.render()
+    metadata, samples = parse(registry.render())
+    assert samples == [("test_total", {"path": 'C:\\dir\n"name"'}, 1)]
+
+
+def test_exposition_format():
+    registry = Registry()
+    counter = Counter("test_records_total", "Records", ["result"], registry=registry)
+    gauge = Gauge("test_backlog", 'Backlog "a\\b"\nof queues', registry=registry)
+    broken = Gauge("test_broken", "Broken", ["queue"], registry=registry)
+    counter.labels("skipped").inc()
+    counter.labels(result="processed").inc(2)
+    gauge.set(1.5)
+    broken.labels("input").set_function(lambda: 1 / 0)
+    text = registry.render()
+    assert text == (
+        "# HELP test_records_total Records\n"
+        "# TYPE test_records_total counter\n"
+        'test_records_total{result="processed"} 2\n'
+        'test_records_total{result="skipped"} 1\n'
+        '# HELP test_backlog Backlog "a\\\\b"\\nof queues\n'
+        "# TYPE test_backlog gauge\n"
+        "test_backlog 1.5\n"
+        "# HELP test_broken Broken\n"
+        "# TYPE test_broken gauge\n"
+        'test_broken{queue="input"} NaN\n'
+    )
+    metadata, samples = parse(text)
+    assert metadata["test_records_total"] == ("Records", "counter")
+    assert math.isnan(samples[-1][2])
+
+
+def test_histogram_buckets():
+    registry = Registry()
+    histogram = Histogram(
+        "test_seconds", "Durations", ["stage"], buckets=(1, 0.5), registry=registry
+    )
+    for value in (0.1, 0.5, 0.7, 1, 3):
+        histogram.labels("decode").observe(value)
+    histogram.labels("infer").observe(math.inf)
+    text = registry.render()
+    assert (
+        'test_seconds_bucket{stage="decode",le="0.5"} 2\n'
+        'test_seconds_bucket{stage="decode",le="1.0"} 4\n'
+        'test_seconds_bucket{stage="decode",le="+Inf"} 5\n'
+        'test_seconds_sum{stage="decode"} 5.3\n'
+        'test_seconds_count{stage="decode"} 5\n'
+    ) in text
+    assert 'test_seconds_sum{stage="infer"} +Inf\n' in text
+    metadata, samples = parse(text)
+    assert metadata["test_seconds"] == ("Durations", "histogram")
+    assert [value for name, labels, value in samples if name.endswith("_bucket")] == [
+        2,
+        4,
+        5,
+        0,
+        0,
+        1,
+    ]
+
+
+def test_histogram_time():
+    registry = Registry()
+    histogram = Histogram("test_seconds", "Durations", registry=registry)
+    with histogram.time():
+        pass
+    counts, total = histogram.labels().snapshot()
+    assert sum(counts) == 1 and 0 <= total < 1
+
+
+def test_bucket_quantile():
+    buckets = (1, 2, 5)
+    assert bucket_quantile(buckets, [0, 0, 0, 0], 0.95) is None
+    assert bucket_quantile(buckets, [5, 4, 1, 0], 0.5) == 1
+    assert bucket_quantile(buckets, [5, 4, 1, 0], 0.95) == 5
+    assert bucket_quantile(buckets, [0, 0, 1, 1], 0.95) == math.inf
+
+
+def test_captured_observations_are_replayed():
+    registry = Registry()
+    counter = Counter("test_total", "Test", ["result"], registry=registry)
+    gauge = Gauge("test_gauge", "Test", registry=registry)
+    histogram = Histogram("test_seconds", "Test", buckets=(1,), registry=registry)
+    registry.start_capture()
+    counter.labels("processed").inc(2)
+    gauge.set(3)
+    gauge.dec()
+    histogram.observe(0.5)
+    captured = registry.drain()
+    assert registry.drain() == []
+    # nothing was applied in the capturing process
+    assert counter.labels("processed").value == 0
+    assert histogram.labels().snapshot() == ([0, 0], 0.0)
+    registry.captured = None
+    registry.replay(captured)
+    registry.replay(None)
+    assert counter.labels("processed").value == 2
+    assert gauge.labels().get() == 2
+    assert histogram.labels().snapshot() == ([1, 0], 0.5)
+
+
+class Model:
+    def set_num_threads(self, threads):
+        pass
+
+
+class MetricsProcessor(RecordProcessor):
+    """
+    Observes metrics in the stages run by the workers.
+    """
+
+    def __init__(self):
+        super().__init__(Model(), crop_encode_threads=1)
+
+    def decode(self, record):
+        FLOWERS.inc(record.raw)
+        STAGE_SECONDS.labels("test_worker").observe(record.raw)
+        return record
+
+    def infer(self, record):
+        return record
+
+    encode = infer
+
+    def output(self, record):
+        return record
+
+
+def test_metrics_of_forked_workers_are_replayed():
+    raws = iter([1, 2, 3, 4, 5, 6])
+    flowers = FLOWERS.labels().value
+    pool = WorkerPool(
+        MetricsProcessor(), lambda: next(raws, None), workers=2, threads_per_worker=1
+    )
+    pool.run()
+    assert FLOWERS.labels().value == flowers + 21
+    counts, total = STAGE_SECONDS.labels("test_worker").snapshot()
+    assert (sum(counts), total) == (6, 21)
+    assert REGISTRY.captured is None
+    assert 'pollinator_stage_seconds_count{stage="test_worker"} 6' in (
+        REGISTRY.render()
+    )
+
+
+def test_metrics_server():
+    registry = Registry()
+    Counter("test_total", "Test", registry=registry).inc()
+    server = MetricsServer(port=0, registry=registry).start()
+    try:
+        url = "http://127.0.0.1:{}".format(server.server.server_address[1])
+        with urllib.request.urlopen(url + "/metrics") as response:
+            assert response.headers["Content-Type"] == "text/plain; version=0.0.4"
+            assert response.read().decode() == registry.render()
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + "/other")
+        assert error.value.code == 404
+    finally:
+        server.close()
@@ -0,0 +1,135 @@
+"""
+Tests of packing small flower crops into mosaic canvases (mosaichelper,
+yolomodelhelper.YoloModel).
+
+    python -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+import yolomodelhelper
+from backendhelper import to_rgb_array
+from mosaichelper import build_canvas, pack_rectangles, split_detections
+from yolomodelhelper import YoloModel
+
+
+def white_boxes(array):
+    """
+    Returns [xmin, ymin, xmax, ymax] of the white rectangles of an image.
+    """
+    mask = (array == 255).all(axis=2)
+    boxes = []
+    while mask.any():
+        y, x = np.argwhere(mask)[0]
+        width = np.argmin(np.append(mask[y, x:], False))
+        height = np.argmin(np.append(mask[y:, x], False))
+        mask[y : y + height, x : x + width] = False
+        boxes.append([x, y, x + width, y + height])
+    return boxes
+
+
+class Backend:
+    """
+    Detects the white rectangles of the images, records the image sizes it
+    is called with.
+    """
+
+    name = "white"
+    stride = 32
+    names = {0: "bee"}
+
+    def __init__(self):
+        self.calls = []
+        self.timings = {}
+
+    def predict(self, images, size=640, augment=False, max_det=None):
+        results = []
+        for image in images:
+            array = to_rgb_array(image)
+            self.calls.append(array.shape[:2])
+            xyxy = [box + [0.9, 0] for box in white_boxes(array)]
+            results.append((np.array(xyxy, dtype=np.float64).reshape(-1, 6), array))
+        return results
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = Backend()
+    monkeypatch.setattr(
+        yolomodelhelper, "create_backend", lambda *args, **kwargs: backend
+    )
+    return backend
+
+
+def make_crop(width, height, box):
+    array = np.full((height, width, 3), 40, dtype=np.uint8)
+    xmin, ymin, xmax, ymax = box
+    array[ymin:ymax, xmin:xmax] = 255
+    return array
+
+
+def test_pack_rectangles():
+    rng = np.random.default_rng(0)
+    sizes = [tuple(int(v) for v in rng.integers(10, 200, size=2)) for _ in range(40)]
+    canvases = pack_rectangles(sizes, 320, gap=8)
+    placed = sorted(index for items in canvases for index, _, _ in items)
+    assert placed == list(range(len(sizes)))
+    assert len(canvases) < len(sizes)
+    for items in canvases:
+        occupied = np.zeros((320, 320), dtype=int)
+        for index, x, y in items:
+            width, height = sizes[index]
+            assert x + width <= 320 and y + height <= 320
+            # the rectangles do not overlap, with their gap
+            occupied[y : y + height + 8, x : x + width + 8] += 1
+        assert occupied.max() == 1
+
+
+def test_split_detections():
+    arrays = {0: make_crop(100, 80, (0, 0, 1, 1)), 1: make_crop(50, 50, (0, 0, 1, 1))}
+    items = [(0, 0, 0), (1, 120, 10)]
+    canvas = build_canvas(arrays, items, 200)
+    assert (canvas[10:60, 120:170] == arrays[1]).all()
+    assert (canvas[0:80, 100:120] == 114).all()
+    xyxy = np.array(
+        [
+            [10, 10, 30, 30, 0.5, 0],
+            [-1, 70, 20, 81, 0.6, 0],  # within the border tolerance
+            [90, 10, 130, 30, 0.9, 0],  # crosses into the gap
+            [125, 15, 135, 25, 0.7, 0],
+            [130, 20, 140, 30, 0.8, 0],
+        ],
+        dtype=np.float64,
+    )
+    detections = split_detections(xyxy, arrays, items, max_det=3)
+    assert detections[0].tolist() == [
+        [0, 70, 20, 80, 0.6, 0],
+        [10, 10, 30, 30, 0.5, 0],
+    ]
+    assert detections[1].tolist() == [[10, 10, 20, 20, 0.8, 0], [5, 5, 15, 15, 0.7, 0]]
+    assert len(split_detections(xyxy, arrays, items, max_det=1)[0]) == 1
+
+
+def test_mosaic_results_match_single_images(backend):
+    crops = [
+        make_crop(120, 90, (10, 20, 50, 60)),
+        make_crop(60, 100, (5, 5, 20, 30)),
+        make_crop(150, 150, (100, 100, 150, 150)),
+        make_crop(80, 40, (0, 0, 1, 1)),
+        make_crop(500, 300, (200, 100, 260, 180)),
+    ]
+    model = YoloModel("model.pt", max_batch_size=4)
+    expected = [result.boxes.tolist() for result in model.predict_batch(crops, 320)]
+    assert len(backend.calls) == len(crops)
+
+    backend.calls = []
+    model = YoloModel("model.pt", max_batch_size=4, mosaic=True, mosaic_gap=16)
+    results = model.predict_batch(crops, 320)
+    assert [result.boxes.tolist() for result in results] == expected
+    assert model.packed == [0, 1, 2, 3]
+    # the small crops run on one canvas, the large one on its own
+    assert backend.calls == [(320, 320), (300, 500)]
+    assert model.number_of_inferences == len(crops)
+    for result, crop in zip(results, crops):
+        assert result.image.shape == crop.shape
@@ -0,0 +1,133 @@
+"""
+Tests of the ONNX Runtime backend (backendhelper.OnnxBackend) on small
+generated models that return the same raw predictions for every image.
+
+    python -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+from backendhelper import OnnxBackend, create_backend, non_max_suppression
+
+onnx = pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+# raw predictions in input coordinates: x, y, w, h, objectness, class scores
+PREDICTIONS = [
+    [320, 160, 64, 32, 0.9, 0.9, 0.1],
+    # overlaps the first with a lower confidence, suppressed
+    [322, 161, 64, 32, 0.8, 0.9, 0.1],
+    # same box, other class, kept
+    [320, 160, 64, 32, 0.7, 0.1, 0.9],
+    # below the confidence threshold
+    [100, 100, 10, 10, 0.2, 0.9, 0.1],
+]
+
+
+def make_model(path, input_shape=("batch", 3, "height", "width")):
+    """
+    Writes a model returning PREDICTIONS for each image of the batch.
+    """
+    from onnx import TensorProto, helper
+
+    predictions = np.array([PREDICTIONS], dtype=np.float32)
+    nodes = [
+        helper.make_node("ReduceMean", ["images"], ["mean"], axes=[1, 2, 3]),
+        helper.make_node("Reshape", ["mean", "shape"], ["mean3"]),
+        helper.make_node("Mul", ["mean3", "zero"], ["zeros"]),
+        helper.make_node("Add", ["zeros", "predictions"], ["output0"]),
+    ]
+    initializers = [
+        helper.make_tensor("shape", TensorProto.INT64, [3], [-1, 1, 1]),
+        helper.make_tensor("zero", TensorProto.FLOAT, [], [0]),
+        helper.make_tensor(
+            "predictions", TensorProto.FLOAT, predictions.shape, predictions.ravel()
+        ),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "predictions",
+        [helper.make_tensor_value_info("images", TensorProto.FLOAT, input_shape)],
+        [
+            helper.make_tensor_value_info(
+                "output0", TensorProto.FLOAT, ["batch", len(PREDICTIONS), 7]
+            )
+        ],
+        initializers,
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    helper.set_model_props(model, {"stride": "32", "names": "{0: 'bee', 1: 'fly'}"})
+    onnx.save(model, str(path))
+    return str(path)
+
+
+def test_dynamic_input_shape(tmp_path):
+    backend = create_backend("onnx", make_model(tmp_path / "model.onnx"))
+    assert backend.input_shape is None and backend.batch_size is None
+    assert backend.names == {0: "bee", 1: "fly"}
+    # letterboxed to 320x640 without padding, a gain of 3.2
+    image = np.zeros((100, 200, 3), dtype=np.uint8)
+    [(detections, array)] = backend.predict([image], size=640)
+    assert np.array_equal(array, image)
+    np.testing.assert_allclose(
+        detections,
+        [[90, 45, 110, 55, 0.81, 0], [90, 45, 110, 55, 0.63, 1]],
+        rtol=1e-5,
+    )
+    assert set(backend.timings) == {"preprocess", "forward", "nms"}
+    [(detections, _)] = backend.predict([image], size=640, max_det=1)
+    assert len(detections) == 1
+
+
+def test_fixed_input_and_batch_size(tmp_path):
+    backend = OnnxBackend(make_model(tmp_path / "model.onnx", (2, 3, 640, 640)))
+    assert backend.input_shape == (640, 640) and backend.batch_size == 2
+    # scaled by 2 and padded by 160 above and below, the boxes are clipped to
+    # the image, the last batch is padded
+    images = [np.zeros((160, 320, 3), dtype=np.uint8)] * 3
+    results = backend.predict(images, size=320)
+    assert len(results) == 3
+    for detections, _ in results:
+        np.testing.assert_allclose(
+            detections[:, :4], [[144, 0, 176, 8], [144, 0, 176, 8]]
+        )
+
+
+def test_non_max_suppression_matches_yolov5():
+    torch = pytest.importorskip("torch")
+    general = pytest.importorskip("yolov5.utils.general")
+    rng = np.random.default_rng(0)
+    prediction = np.concatenate(
+        [
+            rng.uniform(0, 640, (500, 2)),
+            rng.uniform(10, 100, (500, 2)),
+            rng.uniform(0, 1, (500, 6)),
+        ],
+        axis=1,
+    ).astype(np.float32)
+    for multi_label in (False, True):
+        for agnostic in (False, True):
+            expected = general.non_max_suppression(
+                torch.from_numpy(prediction[None]),
+                0.25,
+                0.45,
+                agnostic=agnostic,
+                multi_label=multi_label,
+                max_det=50,
+            )[0].numpy()
+            detections = non_max_suppression(
+                prediction,
+                0.25,
+                0.45,
+                agnostic=agnostic,
+                multi_label=multi_label,
+                max_det=50,
+            )
+            np.testing.assert_allclose(detections, expected, atol=1e-3)
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        create_backend("tflite", "model.tflite")
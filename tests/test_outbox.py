@@ -0,0 +1,198 @@
+"""
+Tests of the outbox (outboxhelper) and the delivery of its entries.
+
+    python -m pytest tests
+"""
+
+import threading
+import time
+
+from messagehelper import HTTPClient
+from outboxhelper import Outbox, OutboxSender
+
+
+class Sink:
+    """
+    Accepts all payloads except b"bad", or none while down.
+    """
+
+    def __init__(self):
+        self.down = False
+        self.delivered = []
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def send(self, entries):
+        with self.lock:
+            self.calls += 1
+            if self.down:
+                return []
+            delivered = [entry for entry in entries if entry.payload != b"bad"]
+            self.delivered += [entry.payload for entry in delivered]
+            return [entry.id for entry in delivered]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_put_fetch_ack(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"))
+    outbox.put(["mqtt", "http"], b"1", filename="a", node_id="n", hostname="h")
+    outbox.put(["http"], b"2")
+    assert outbox.count() == 3
+    assert outbox.count("http") == 2
+    entries = outbox.fetch("http", 10)
+    assert [entry.payload for entry in entries] == [b"1", b"2"]
+    assert (entries[0].filename, entries[0].node_id, entries[0].hostname) == (
+        "a",
+        "n",
+        "h",
+    )
+    outbox.ack([entries[0].id])
+    assert [entry.payload for entry in outbox.fetch("http", 10)] == [b"2"]
+    assert outbox.count("mqtt") == 1
+
+
+def test_entries_survive_reopening(tmp_path):
+    path = str(tmp_path / "outbox.sqlite")
+    Outbox(path).put(["http"], b"1")
+    assert [entry.payload for entry in Outbox(path).fetch("http", 10)] == [b"1"]
+
+
+def test_fetch_waits_for_new_entries(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"))
+    threading.Timer(0.1, outbox.put, (["http"], b"1")).start()
+    assert [entry.payload for entry in outbox.fetch("http", 10, timeout=5)] == [b"1"]
+    assert outbox.fetch("mqtt", 10, timeout=0.01) == []
+
+
+def test_expired_entries_are_dropped(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), max_age=1, limit_check_interval=0)
+    outbox.put(["http"], b"old")
+    outbox.connection.execute("UPDATE outbox SET created = created - 7200")
+    outbox.put(["http"], b"new")
+    assert [entry.payload for entry in outbox.fetch("http", 10)] == [b"new"]
+
+
+def test_oldest_entries_are_dropped_over_max_size(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), max_size=1, limit_check_interval=0)
+    for i in range(3):
+        outbox.put(["http"], bytes([i]) * 400 * 1024)
+    assert [entry.payload[0] for entry in outbox.fetch("http", 10)] == [1, 2]
+
+
+def test_rejected_entries_are_fetched_last_and_dropped(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), max_attempts=2)
+    for payload in (b"1", b"bad", b"2"):
+        outbox.put(["http"], payload)
+    outbox.reject([outbox.fetch("http", 10)[1].id])
+    assert [entry.payload for entry in outbox.fetch("http", 10)] == [
+        b"1",
+        b"2",
+        b"bad",
+    ]
+    outbox.reject([outbox.fetch("http", 10)[2].id])
+    assert [entry.payload for entry in outbox.fetch("http", 10)] == [b"1", b"2"]
+
+
+def test_sender_drops_rejected_entry_without_backoff(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), max_attempts=2)
+    outbox.put(["http"], b"bad")
+    for i in range(12):
+        outbox.put(["http"], str(i).encode())
+    sink = Sink()
+    sender = OutboxSender(outbox, "http", sink.send, batch_size=4).start()
+    t0 = time.monotonic()
+    wait_for(lambda: outbox.count() == 0)
+    # no backoff after rounds that delivered some of the entries
+    assert time.monotonic() - t0 < 1
+    sender.close()
+    assert sink.delivered == [str(i).encode() for i in range(12)]
+
+
+def test_sender_keeps_entries_while_sink_is_down(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), max_attempts=1)
+    for i in range(3):
+        outbox.put(["http"], str(i).encode())
+    sink = Sink()
+    sink.down = True
+    sender = OutboxSender(outbox, "http", sink.send, backoff_max=0.01).start()
+    wait_for(lambda: sink.calls >= 5)
+    assert outbox.count() == 3
+    sink.down = False
+    wait_for(lambda: outbox.count() == 0)
+    sender.close()
+    assert sink.delivered == [b"0", b"1", b"2"]
+
+
+def test_sender_retries_after_send_errors(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), max_attempts=1)
+    for i in range(3):
+        outbox.put(["http"], str(i).encode())
+    sink = Sink()
+    errors = []
+
+    def send(entries):
+        if len(errors) < 2:
+            errors.append(len(entries))
+            raise ConnectionError("uplink down")
+        return sink.send(entries)
+
+    sender = OutboxSender(outbox, "http", send, backoff_max=0.01).start()
+    wait_for(lambda: outbox.count() == 0)
+    sender.close()
+    # errors are retried as a whole, they do not count as rejections
+    assert errors == [3, 3]
+    assert sink.delivered == [b"0", b"1", b"2"]
+
+
+def test_close_interrupts_the_backoff(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"))
+    outbox.put(["http"], b"1")
+    sink = Sink()
+    sink.down = True
+    sender = OutboxSender(outbox, "http", sink.send).start()
+    wait_for(lambda: sink.calls == 1)
+    t0 = time.monotonic()
+    sender.close()
+    assert time.monotonic() - t0 < 0.5
+    assert sink.calls == 1
+    assert outbox.count() == 1
+
+
+def test_rejected_http_batch_is_sent_one_at_a_time():
+    client = HTTPClient("http://localhost/results", None, None, batch_size=4)
+    requests = []
+
+    def send(url, data):
+        requests.append(data)
+        return 413 if b"bad" in data else 200
+
+    client._send = send
+    payloads = [b'"1"', b'"bad"', b'"2"', b'"3"', b'"4"']
+    assert client._send_payloads("http://localhost/results", payloads) == [0, 2, 3, 4]
+    assert requests == [
+        b'["1","bad","2","3"]',
+        b'"1"',
+        b'"bad"',
+        b'"2"',
+        b'"3"',
+        b'["4"]',
+    ]
+
+
+def test_failed_http_batch_is_not_split_without_response():
+    client = HTTPClient("http://localhost/results", None, None, batch_size=4)
+    requests = []
+
+    def send(url, data):
+        requests.append(data)
+        return None
+
+    client._send = send
+    assert client._send_payloads("http://localhost/results", [b"1", b"2"]) == []
+    assert requests == [b"[1,2]"]
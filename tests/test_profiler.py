@@ -0,0 +1,91 @@
+"""
+Tests of profiling records in the Pipeline (profilerhelper).
+
+    python -m pytest tests
+"""
+
+import json
+import os
+import threading
+import time
+
+from pipelinehelper import Pipeline, RecordProcessor
+from profilerhelper import Profiler
+
+
+class StageProcessor(RecordProcessor):
+    """
+    Stages that only burn some time and track how many run at once.
+    """
+
+    def __init__(self, profiler):
+        super().__init__(None, crop_encode_threads=1, profiler=profiler)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.outputs = []
+
+    def _work(self, record):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(0.002)
+            sum(i * i for i in range(2000))
+        finally:
+            with self.lock:
+                self.running -= 1
+        return record
+
+    decode = infer = encode = _work
+
+    def output(self, record):
+        self.outputs.append(record.seq)
+        return record
+
+
+def run_pipeline(processor, num_records):
+    raws = iter(range(num_records))
+    done = []
+    pipeline = Pipeline(
+        processor,
+        lambda: next(raws, None),
+        decode_threads=4,
+        encode_threads=4,
+        done=done.append,
+    )
+    pipeline.run()
+    return done
+
+
+def test_profiled_records_in_concurrent_threads(tmp_path):
+    profiler = Profiler(directory=str(tmp_path), records=40)
+    profiler.request()
+    processor = StageProcessor(profiler)
+    done = run_pipeline(processor, 40)
+    assert [record.seq for record in done] == list(range(40))
+    assert processor.outputs == list(range(40))
+    assert not any(record.failed for record in done)
+    # the profiled stages took turns
+    assert processor.max_running == 1
+    infos = [
+        json.load(open(os.path.join(tmp_path, name)))
+        for name in os.listdir(tmp_path)
+        if name.endswith(".json")
+    ]
+    assert sorted(info["seq"] for info in infos) == list(range(40))
+    assert all(info["result"] == "processed" for info in infos)
+    assert all(
+        set(info["stage_seconds"]) == {"decode", "infer", "encode", "output"}
+        for info in infos
+    )
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".prof")]) == 40
+
+
+def test_records_not_profiled_run_concurrently(tmp_path):
+    profiler = Profiler(directory=str(tmp_path), every=0)
+    processor = StageProcessor(profiler)
+    done = run_pipeline(processor, 40)
+    assert not any(record.failed for record in done)
+    assert processor.max_running > 1
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,140 @@
+"""
+Tests of reprocessing stored input messages with a checkpoint
+(reprocesshelper).
+
+    python -m pytest tests
+"""
+
+import json
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from pipelinehelper import Pipeline, Record, RecordProcessor
+from reprocesshelper import Checkpoint, InputArchive, Reprocessor
+
+
+def store_messages(directory, count, bad=()):
+    """
+    Stores count messages in directory/<node>/..., those at the indexes in
+    bad are not valid JSON. Returns their keys in order.
+    """
+    keys = []
+    for i in range(count):
+        key = os.path.join("node{}".format(i // 4), "{:03d}.json".format(i))
+        os.makedirs(os.path.join(directory, os.path.dirname(key)), exist_ok=True)
+        with open(os.path.join(directory, key), "wb") as f:
+            f.write(b"{broken" if i in bad else json.dumps({"index": i}).encode())
+        keys.append(key)
+    return keys
+
+
+class JSONProcessor(RecordProcessor):
+    """
+    Parses the messages, an invalid one fails the record.
+    """
+
+    def __init__(self):
+        super().__init__(None, crop_encode_threads=1)
+        self.outputs = []
+
+    def decode(self, record):
+        record.raw = json.loads(record.raw)
+        return record
+
+    def infer(self, record):
+        return record
+
+    encode = infer
+
+    def output(self, record):
+        self.outputs.append(record.raw["index"])
+        return record
+
+
+def run(reprocessor):
+    processor = JSONProcessor()
+    Pipeline(processor, reprocessor.fetch, done=reprocessor.done).run()
+    reprocessor.close()
+    return processor.outputs
+
+
+def test_archives(tmp_path):
+    directory = tmp_path / "inputs"
+    keys = store_messages(str(directory), 6)
+    with tarfile.open(tmp_path / "inputs.tar.gz", "w:gz") as tar:
+        for key in keys:
+            tar.add(directory / key, arcname=key)
+    with zipfile.ZipFile(tmp_path / "inputs.zip", "w") as archive:
+        for key in keys:
+            archive.write(directory / key, arcname=key)
+    for path in (directory, tmp_path / "inputs.tar.gz", tmp_path / "inputs.zip"):
+        archive = InputArchive(str(path))
+        assert archive.keys == keys
+        assert [json.loads(archive.read(i))["index"] for i in range(6)] == list(
+            range(6)
+        )
+        archive.close()
+    with pytest.raises(ValueError):
+        InputArchive(str(directory / keys[0]))
+
+
+def test_resume_after_interruption(tmp_path):
+    directory = str(tmp_path / "inputs")
+    keys = store_messages(directory, 10, bad=(2, 7))
+    reprocessor = Reprocessor(directory, checkpoint_interval=0)
+    # interrupted after the output of 5 records, without close()
+    for seq in range(5):
+        raw = reprocessor.fetch()
+        reprocessor.done(Record(seq=seq, raw=raw, failed=seq == 2))
+    reprocessor.fetch()
+    checkpoint = json.load(open(directory + ".checkpoint.json"))
+    assert checkpoint["done"] == 5 and checkpoint["last_key"] == keys[4]
+    assert checkpoint["failed"] == [keys[2]]
+
+    reprocessor = Reprocessor(directory, checkpoint_interval=0)
+    assert reprocessor.start == 5
+    assert run(reprocessor) == [5, 6, 8, 9]
+    checkpoint = json.load(open(directory + ".checkpoint.json"))
+    assert checkpoint["done"] == 10 and checkpoint["last_key"] == keys[9]
+    assert checkpoint["failed"] == [keys[2], keys[7]]
+    assert checkpoint["source"] == os.path.abspath(directory)
+    # nothing left to do
+    assert run(Reprocessor(directory)) == []
+
+
+def test_failures_updated_when_output_again(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = Checkpoint(path)
+    checkpoint.update(1, "a", failed=True)
+    checkpoint.update(2, "b", failed=True, force=True)
+    # the messages since the last checkpoint are output again after a restart
+    checkpoint = Checkpoint(path)
+    checkpoint.update(1, "a", failed=True)
+    checkpoint.update(2, "b", failed=False, force=True)
+    assert Checkpoint(path).state["failed"] == ["a"]
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_changed_input_is_refused(tmp_path):
+    directory = str(tmp_path / "inputs")
+    keys = store_messages(directory, 4)
+    run(Reprocessor(directory))
+    os.remove(os.path.join(directory, keys[1]))
+    with pytest.raises(ValueError, match="changed since the checkpoint"):
+        Reprocessor(directory)
+    other = str(tmp_path / "other")
+    store_messages(other, 4)
+    with pytest.raises(ValueError, match="belongs to"):
+        Reprocessor(other, checkpoint_path=directory + ".checkpoint.json")
+
+
+@pytest.mark.parametrize("streaming_decode", [False, True])
+def test_unparsable_message_fails(streaming_decode):
+    processor = RecordProcessor(
+        None, streaming_decode=streaming_decode, crop_encode_threads=1
+    )
+    record = processor.decode(Record(seq=0, raw=b'{"metadata": {"node_id"'))
+    assert record.skip and record.failed
@@ -0,0 +1,95 @@
+"""
+Tests of the hourly segment store of the file output (storehelper).
+
+    python -m pytest tests
+"""
+
+import datetime
+import os
+
+from PIL import Image
+
+from messagehelper import Flower, MessageGenerator, Pollinator
+from storehelper import SEGMENT_EXTENSION, SegmentStore, read_segment, segment_path
+
+
+def make_generator(node_id, timestamp, num_pollinators=2):
+    generator = MessageGenerator()
+    generator.set_node_id(node_id)
+    generator.set_timestamp(timestamp)
+    generator.set_metadata({"node_id": node_id})
+    generator.add_flower(Flower(0, "flower", 0.9, 100, 80))
+    for i in range(num_pollinators):
+        crop = Image.new("RGB", (20 + i, 12), (i * 90, 40, 200))
+        generator.add_pollinator(Pollinator(i, 0, "bee", 0.7, 20 + i, 12, crop))
+    generator.encode_crops()
+    return generator
+
+
+def expected_record(generator):
+    record = {
+        "node_id": generator.node_id,
+        "timestamp": generator.timestamp.isoformat(),
+        "filename": generator.generate_filename(),
+    }
+    record.update(generator.generate_message(raw_crops=True))
+    return record
+
+
+START = datetime.datetime(2024, 6, 1, 12, 0, 0)
+
+
+def test_round_trip(tmp_path):
+    store = SegmentStore(str(tmp_path), fsync_records=0)
+    generators = [
+        make_generator(node_id, START + datetime.timedelta(minutes=minutes), i % 3)
+        for i, (node_id, minutes) in enumerate(
+            [("a", 0), ("b", 1), ("a", 2), ("a", 61), ("b", 3)]
+        )
+    ]
+    paths = [store.append(generator) for generator in generators]
+    store.close()
+    assert paths[0] == paths[2] != paths[3]
+    assert paths[0] == segment_path(str(tmp_path), "a", START) + SEGMENT_EXTENSION
+    assert os.path.exists(paths[0][: -len(SEGMENT_EXTENSION)] + ".pack")
+    for path in set(paths):
+        stored = [generator for generator, p in zip(generators, paths) if p == path]
+        assert list(read_segment(path)) == [expected_record(g) for g in stored]
+    # without crops, the references into the pack are kept
+    pack = open(paths[0][: -len(SEGMENT_EXTENSION)] + ".pack", "rb").read()
+    crops = [
+        pollinator["crop"]
+        for record in read_segment(paths[0], crops=False)
+        for pollinator in record["detections"]["pollinators"]
+    ]
+    assert [pack[o : o + n] for o, n in crops] == [
+        p.crop_jpeg for g in (generators[0], generators[2]) for p in g.pollinators
+    ]
+
+
+def test_without_crops(tmp_path):
+    store = SegmentStore(str(tmp_path), save_crops=False)
+    path = store.append(make_generator("a", START))
+    store.close()
+    [record] = read_segment(path)
+    assert [p["crop"] for p in record["detections"]["pollinators"]] == [None, None]
+    assert os.path.getsize(path[: -len(SEGMENT_EXTENSION)] + ".pack") == 0
+
+
+def test_partial_line_skipped_and_truncated(tmp_path):
+    store = SegmentStore(str(tmp_path))
+    first = make_generator("a", START)
+    path = store.append(first)
+    store.close()
+    # an interrupted write: the crops reached the pack, the line only partly
+    with open(path[: -len(SEGMENT_EXTENSION)] + ".pack", "ab") as f:
+        f.write(b"\xff\xd8 partial crop")
+    with open(path, "ab") as f:
+        f.write(b'{"node_id": "a", "timest')
+    assert list(read_segment(path)) == [expected_record(first)]
+    # reopening the segment truncates the partial line and appends after it
+    store = SegmentStore(str(tmp_path))
+    second = make_generator("a", START + datetime.timedelta(minutes=1))
+    assert store.append(second) == path
+    store.close()
+    assert list(read_segment(path)) == [expected_record(first), expected_record(second)]
@@ -0,0 +1,209 @@
+"""
+Tests of the streaming decode of records (messagehelper.MessageParser).
+
+    python -m pytest tests
+"""
+
+import base64
+import gc
+import json
+import random
+import weakref
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import formathelper
+from messagehelper import MessageParser
+
+
+def make_record(sizes):
+    flowers = []
+    for i, (width, height) in enumerate(sizes):
+        buf = BytesIO()
+        Image.new("RGB", (width, height), (i * 40, 100, 200)).save(buf, "JPEG")
+        flowers.append(
+            {
+                "class_name": "flower{}".format(i),
+                "score": 0.5 + i / 10,
+                "crop": base64.b64encode(buf.getvalue()).decode(),
+            }
+        )
+    return {
+        "metadata": {
+            "node_id": "node",
+            "capture_timestamp": "2024-06-01T12:00:00",
+            "original_image": {
+                "size": [1920, 1080],
+                "capture_duration": 0.1,
+                "source": "camera",
+            },
+            "flower_inference": {
+                "confidence_threshold": 0.25,
+                "iou_threshold": 0.45,
+                "margin": 10,
+                "model_name": "flowers",
+                "max_det": 300,
+                "inference_times": [0.1],
+            },
+        },
+        "detections": {"flowers": flowers},
+    }
+
+
+def received_frame(record):
+    """
+    Returns a buffer of the serialized record as received, and a weak
+    reference to it to tell when it was released.
+    """
+    frame = np.frombuffer(json.dumps(record, indent=1).encode(), dtype=np.uint8)
+    return memoryview(frame), weakref.ref(frame)
+
+
+def test_streaming_matches_parse_message():
+    record = make_record([(64, 48), (32, 80), (50, 50)])
+    parser = MessageParser()
+    assert parser.parse_message(json.dumps(record))
+    streaming = MessageParser(streaming=True)
+    assert streaming.parse_message(json.dumps(record).encode())
+    assert streaming.get_metadata() == parser.get_metadata()
+    images = [np.asarray(image) for _, image in streaming.iter_images()]
+    assert streaming.num_detections == parser.num_detections == 3
+    assert streaming.classes == parser.classes
+    assert streaming.scores == parser.scores
+    assert streaming.image_sizes == parser.image_sizes
+    for image, expected in zip(images, parser.images):
+        assert np.array_equal(image, np.asarray(expected))
+
+
+def test_frame_released_once_last_crop_was_read():
+    data, frame = received_frame(make_record([(64, 48), (32, 80), (50, 50)]))
+    parser = MessageParser(streaming=True)
+    assert parser.parse_message(data)
+    del data
+    alive = []
+    for flower_index, image in parser.iter_images():
+        gc.collect()
+        alive.append(frame() is not None)
+    assert alive == [True, True, False]
+
+
+def test_frame_released_when_iteration_stops():
+    data, frame = received_frame(make_record([(64, 48), (32, 80)]))
+    parser = MessageParser(streaming=True)
+    assert parser.parse_message(data)
+    del data
+    images = parser.iter_images()
+    next(images)
+    images.close()
+    gc.collect()
+    assert frame() is None
+    assert parser.data is None
+
+
+def test_record_without_flowers():
+    data, frame = received_frame(make_record([]))
+    parser = MessageParser(streaming=True)
+    assert parser.parse_message(data)
+    del data
+    assert list(parser.iter_images()) == []
+    assert parser.num_detections == 0
+    gc.collect()
+    assert frame() is None
+
+
+def parse(data, streaming):
+    """
+    Returns what a parser read from the serialized record, None if it
+    failed.
+    """
+    parser = MessageParser(streaming=streaming)
+    try:
+        if not parser.parse_message(data):
+            return None
+        if streaming:
+            images = [np.asarray(image).tobytes() for _, image in parser.iter_images()]
+        else:
+            images = [np.asarray(image).tobytes() for image in parser.images]
+    except Exception:
+        # fails the record, as in RecordProcessor
+        return None
+    return (
+        parser.get_metadata(),
+        parser.classes,
+        parser.scores,
+        parser.image_sizes,
+        images,
+    )
+
+
+def serialized_record():
+    record = make_record([(8, 6), (5, 9)])
+    record["metadata"]["note"] = {"nested": [1, {"path": "C:\\"}], "quote": 'a"b'}
+    record["detections"]["flowers"][0]["bbox"] = [1, 2.5, None, True]
+    return json.dumps(record).encode()
+
+
+def test_streaming_matches_json_on_mutated_records():
+    data = serialized_record()
+    assert parse(data, True) == parse(data, False) is not None
+    rng = random.Random(0)
+    results = set()
+    for _ in range(1000):
+        mutated = bytearray(data)
+        position = rng.randrange(len(data))
+        char = rng.choice(b'{}[]",:\\ 0e-')
+        mutation = rng.choice(["truncate", "delete", "insert", "replace"])
+        if mutation == "truncate":
+            del mutated[position:]
+        elif mutation == "delete":
+            del mutated[position]
+        elif mutation == "insert":
+            mutated.insert(position, char)
+        else:
+            mutated[position] = char
+        expected = parse(bytes(mutated), False)
+        assert parse(bytes(mutated), True) == expected, (mutation, position)
+        results.add(expected is None)
+    assert results == {True, False}
+
+
+MALFORMED = {
+    "trailing data": lambda data: data + b"x",
+    "second object": lambda data: data + b"{}",
+    "broken unused member": lambda data: data[:-1] + b', "extra": [1, }]}',
+    "broken scalar": lambda data: data[:-1] + b', "extra": tru}',
+    "broken flower member": lambda data: data.replace(
+        b'"bbox"', b'"bbox": {"a" 1}, "b"'
+    ),
+    "number": lambda data: data.replace(b"2.5", b"2.5.1"),
+    "missing colon": lambda data: data.replace(b'"score":', b'"score"', 1),
+    "missing comma": lambda data: data.replace(b"}, {", b"} {"),
+    "bracket mismatch": lambda data: data.replace(b"true]", b"true}"),
+    "invalid utf-8": lambda data: data.replace(b"flower0", b"flower\xff"),
+    "not an object": lambda data: b"[" + data + b"]",
+}
+
+
+@pytest.mark.parametrize("name", sorted(MALFORMED))
+@pytest.mark.parametrize("orjson", [True, False])
+def test_malformed_records_fail(name, orjson, monkeypatch):
+    if not orjson:
+        monkeypatch.setattr(formathelper, "orjson", None)
+    data = MALFORMED[name](serialized_record())
+    assert data != serialized_record()
+    assert parse(data, False) is None
+    assert parse(data, True) is None
+
+
+@pytest.mark.parametrize("orjson", [True, False])
+def test_nan_score_as_loads_json(orjson, monkeypatch):
+    # only the json module accepts NaN
+    if not orjson:
+        monkeypatch.setattr(formathelper, "orjson", None)
+    data = serialized_record().replace(b'"score": 0.5', b'"score": NaN')
+    expected = parse(data, False)
+    assert (expected is None) == orjson
+    assert parse(data, True) == expected
@@ -0,0 +1,87 @@
+"""
+Tests of the multi-process worker pool (pipelinehelper.WorkerPool).
+
+    python -m pytest tests
+"""
+
+import os
+import random
+import time
+
+from pipelinehelper import RecordProcessor, WorkerPool
+
+
+class Model:
+    def set_num_threads(self, threads):
+        self.threads = threads
+
+
+class WorkerProcessor(RecordProcessor):
+    """
+    Stages that take a random time, fail on raw "error" and kill their
+    worker on raw "exit".
+    """
+
+    def __init__(self):
+        super().__init__(Model(), crop_encode_threads=1)
+        self.outputs = []
+
+    def decode(self, record):
+        if record.raw == "error":
+            raise ValueError("broken record")
+        if record.raw == "exit":
+            os._exit(1)
+        time.sleep(random.uniform(0, 0.01))
+        record.payloads = {"info": (record.raw, os.getpid(), self.model.threads)}
+        return record
+
+    def infer(self, record):
+        return record
+
+    encode = infer
+
+    def output(self, record):
+        self.outputs.append(record.payloads["info"])
+        return record
+
+
+def run_pool(raws, workers=3):
+    raws = iter(raws)
+    processor = WorkerProcessor()
+    done = []
+    pool = WorkerPool(
+        processor,
+        lambda: next(raws, None),
+        workers=workers,
+        threads_per_worker=2,
+        queue_size=2,
+        done=done.append,
+    )
+    pool.run()
+    return processor, done
+
+
+def test_records_output_in_order():
+    processor, done = run_pool(range(30))
+    assert [record.seq for record in done] == list(range(30))
+    assert [raw for raw, pid, threads in processor.outputs] == list(range(30))
+    pids = {pid for raw, pid, threads in processor.outputs}
+    assert os.getpid() not in pids and 1 < len(pids) <= 3
+    assert {threads for raw, pid, threads in processor.outputs} == {2}
+
+
+def test_failed_record_is_skipped():
+    processor, done = run_pool([0, 1, "error", 3])
+    assert [record.seq for record in done] == [0, 1, 2, 3]
+    assert [record.failed for record in done] == [False, False, True, False]
+    assert [raw for raw, pid, threads in processor.outputs] == [0, 1, 3]
+
+
+def test_dead_worker_is_replaced():
+    processor, done = run_pool([0, 1, "exit"] + list(range(3, 20)), workers=2)
+    assert [record.seq for record in done] == list(range(20))
+    assert done[2].failed
+    # records dispatched to the same worker as the one that killed it fail too
+    outputs = [raw for raw, pid, threads in processor.outputs]
+    assert [record.seq for record in done if not record.failed] == outputs
+    assert outputs[-5:] == list(range(15, 20))
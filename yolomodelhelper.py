@@ -1,9 +1,202 @@
-import torch
+import math
 import time
-import os
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
-import logging
+
+from backendhelper import create_backend, letterbox_shape, to_rgb_array
+from mosaichelper import build_canvas, pack_rectangles, split_detections
+from metricshelper import STAGE_SECONDS
+
+
+def compute_iou_matrix(boxes):
+    """
+    Calculate the pairwise Intersection over Union (IoU) of bounding boxes.
+
+    Parameters
+    ----------
+    boxes : array of shape (N, 4)
+        box format: [xmin, ymin, xmax, ymax]
+
+    Returns
+    -------
+    array of shape (N, N)
+        in [0, 1], 0 for pairs involving a box without area
+
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    x_left = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    y_top = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    x_right = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+    y_bottom = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+    intersection_area = np.clip(x_right - x_left, 0, None) * np.clip(
+        y_bottom - y_top, 0, None
+    )
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    union_area = areas[:, None] + areas[None, :] - intersection_area
+    iou = np.zeros_like(intersection_area)
+    np.divide(intersection_area, union_area, out=iou, where=union_area > 0)
+    return iou
+
+
+def group_overlapping_boxes(boxes, iou_threshold):
+    """
+    Assign a group index to each box, boxes are in the same group if they are
+    connected by a chain of pairs with IoU > iou_threshold.
+    Groups are numbered in order of their first box.
+    """
+    num_boxes = len(boxes)
+    overlapping = np.triu(compute_iou_matrix(boxes) > iou_threshold, k=1)
+    # union-find (disjoint-set) with path halving
+    parents = list(range(num_boxes))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i, j in zip(*np.nonzero(overlapping)):
+        root_i, root_j = find(int(i)), find(int(j))
+        if root_i != root_j:
+            parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    group_ids = {}
+    groups = np.zeros(num_boxes, dtype=int)
+    for i in range(num_boxes):
+        groups[i] = group_ids.setdefault(find(i), len(group_ids))
+    return groups
+
+
+def group_input_shapes(shapes, max_padding, max_batch_size):
+    """
+    Groups images by their letterboxed input shape (height, width) into
+    batches of up to max_batch_size. A batch is letterboxed to the largest
+    height and width of its images, an image is only batched with others
+    if that pads it by at most max_padding pixels per side.
+    Returns lists of indexes into shapes.
+    """
+    batches = []
+    batch = []
+    for index in sorted(range(len(shapes)), key=lambda i: tuple(shapes[i])):
+        shape = shapes[index]
+        if len(batch) > 0:
+            low = np.minimum(low, shape)
+            high = np.maximum(high, shape)
+            if len(batch) < max_batch_size and (high - low).max() <= max_padding:
+                batch.append(index)
+                continue
+            batches.append(batch)
+        batch = [index]
+        low = high = np.asarray(shape)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+class DetectionResult:
+    """
+    Detections of a single image.
+
+    Backed by one float array with a row per detection, see the column
+    constants below. The crop columns hold the box extended by the margin
+    and clipped to the image, as slice bounds into image.
+    """
+
+    XMIN, YMIN, XMAX, YMAX = 0, 1, 2, 3
+    SCORE = 4
+    CLASS = 5
+    GROUP = 6
+    CROP_X_START, CROP_Y_START, CROP_X_END, CROP_Y_END = 7, 8, 9, 10
+    NUM_COLUMNS = 11
+
+    def __init__(self, xyxy, groups, image, class_names, margin=0):
+        """
+        xyxy: array with rows [xmin, ymin, xmax, ymax, confidence, class]
+        groups: group index per detection
+        image: the image as array (height, width, channels)
+        class_names: class_id -> name lookup (list or dict)
+        """
+        self.image = image
+        self.margin = margin
+        self.data = np.zeros((len(xyxy), self.NUM_COLUMNS), dtype=np.float64)
+        if len(xyxy) == 0:
+            self.names = []
+            return
+        self.data[:, :6] = xyxy[:, :6]
+        self.data[:, self.GROUP] = groups
+        self.data[:, self.CROP_X_START : self.CROP_Y_END + 1] = _crop_bounds(
+            xyxy[:, :4], image.shape, margin
+        )
+        self.names = [class_names[c] for c in self.classes.tolist()]
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def boxes(self):
+        return self.data[:, self.XMIN : self.YMAX + 1]
+
+    @property
+    def scores(self):
+        return self.data[:, self.SCORE]
+
+    @property
+    def classes(self):
+        return self.data[:, self.CLASS].astype(int)
+
+    @property
+    def groups(self):
+        return self.data[:, self.GROUP].astype(int)
+
+    @property
+    def crop_slices(self):
+        """
+        [x_start, y_start, x_end, y_end] per detection
+        """
+        return self.data[:, self.CROP_X_START : self.CROP_Y_END + 1].astype(int)
+
+    def crops(self, image=None):
+        """
+        Returns the crops as views into image.
+        If another image is given, e.g. a higher resolution decode of the same
+        picture, the boxes are scaled to its size before adding the margin.
+        """
+        if image is None or image.shape[:2] == self.image.shape[:2]:
+            image = self.image
+            crop_slices = self.crop_slices
+        else:
+            scale_y = image.shape[0] / self.image.shape[0]
+            scale_x = image.shape[1] / self.image.shape[1]
+            boxes = self.boxes * np.array([scale_x, scale_y, scale_x, scale_y])
+            crop_slices = _crop_bounds(boxes, image.shape, self.margin).astype(int)
+        return [
+            image[y_start:y_end, x_start:x_end]
+            for x_start, y_start, x_end, y_end in crop_slices.tolist()
+        ]
+
+
+def _crop_bounds(boxes, image_shape, margin):
+    """
+    Extends the boxes by margin and clips them to the image.
+    Returns [x_start, y_start, x_end, y_end] per box.
+    """
+    image_height, image_width = image_shape[:2]
+    bounds = np.empty((len(boxes), 4), dtype=np.float64)
+    bounds[:, :2] = np.maximum(np.trunc(boxes[:, :2]) - margin, 0)
+    bounds[:, 2] = np.minimum(np.trunc(boxes[:, 2]) + margin, image_width)
+    bounds[:, 3] = np.minimum(np.trunc(boxes[:, 3]) + margin, image_height)
+    return bounds
+
+
+def choose_input_size(width, height, sizes):
+    """
+    Returns the smallest of sizes that is at least the longer side of a
+    width x height image, or the largest size if the image is larger.
+    """
+    longest = max(width, height)
+    for size in sorted(sizes):
+        if size >= longest:
+            return size
+    return max(sizes)
 
 
 class YoloModel:
@@ -21,39 +214,131 @@ class YoloModel:
         amp=False,
         agnostic=False,
         max_det=10,
+        max_batch_size=8,
+        max_batch_padding=64,
+        backend="torch",
+        onnx_quantize=False,
+        num_threads=None,
+        cache_dir=None,
+        mosaic=False,
+        mosaic_max_crop_size=None,
+        mosaic_gap=16,
+        mosaic_size=None,
     ):
-        if yolov5_path is None:
-            self.model = torch.hub.load("ultralytics/yolov5", "custom", model_path)
-        else:
-            self.model = torch.hub.load(
-                yolov5_path, "custom", model_path, source="local"
+        """
+        backend: "torch" (YOLOv5 via torch.hub) or "onnx" (model_path is an
+        exported .onnx model, run with ONNX Runtime on the CPU)
+        onnx_quantize: with the onnx backend, use an int8 quantized copy of the model
+        num_threads: with the onnx backend, number of intra-op threads
+        cache_dir: with the torch backend, directory to cache the loaded model in
+        max_batch_padding: in predict_batch, max pixels per side an image is
+        padded by to batch it with images of a larger input shape, 0 batches
+        only images of the same shape
+        mosaic: in predict_batch, pack images whose longer side is at most
+        mosaic_max_crop_size (default: half of mosaic_size) into square mosaic
+        canvases of mosaic_size (default: the largest inference size of the
+        batch), mosaic_gap pixels apart
+        """
+        t0 = time.time()
+        backend_options = dict(
+            confidence_threshold=confidence_threshold,
+            iou_threshold=iou_threshold,
+            agnostic=agnostic,
+            multi_label=multi_label,
+            max_det=max_det,
+        )
+        if backend == "torch":
+            backend_options.update(
+                yolov5_path=yolov5_path, amp=amp, cache_dir=cache_dir
             )
+        elif backend == "onnx":
+            backend_options.update(quantize=onnx_quantize, num_threads=num_threads)
+        self.backend = create_backend(backend, model_path, **backend_options)
         self.model_name = model_path.split("/")[-1]
-        self.model.conf = confidence_threshold
-        self.model.iou = iou_threshold
-        self.model.agnostic = agnostic  # NMS class-agnostic
-        self.model.multi_label = multi_label  # NMS multiple labels per box
-        self.model.max_det = max_det  # maximum number of detections per image
-        self.model.amp = amp  # Automatic Mixed Precision (AMP) inference
-        self.model.classes = None  # (optional list) filter by class, i.e. = [0, 15, 16] for COCO persons, cats and dogs
+        self.confidence_threshold = confidence_threshold
+        self.iou_threshold = iou_threshold
+        self.multi_label = multi_label
+        self.max_det = max_det
         self.margin = margin
         self.augment = augment
         self.class_names = class_names
         self.multi_label_iou_threshold = multi_label_iou_threshold
-        self.results = None
+        self.max_batch_size = max_batch_size
+        self.max_batch_padding = max_batch_padding
+        self.mosaic = mosaic
+        self.mosaic_max_crop_size = mosaic_max_crop_size
+        self.mosaic_gap = mosaic_gap
+        self.mosaic_size = mosaic_size
+        # indexes of the images packed into mosaics by the last predict_batch()
+        self.packed = []
+        self.detections = None
+        self.batch_detections = []
         self.total_inference_time = 0
         self.number_of_inferences = 0
+        self.load_time = time.time() - t0
+        self.warmup_time = None
+        # seconds from process start until the model was ready, set by main
+        self.startup_time = None
+
+    def warmup(self, sizes):
+        """
+        Runs inference once on a blank image at each input size and, with
+        mosaic packing, at the mosaic canvas size, so that one-time
+        initialization does not delay the first record. The images are not
+        packed into mosaics, each size runs as given.
+        """
+        t0 = time.time()
+        sizes = set(sizes)
+        if self.mosaic and self.mosaic_size is not None:
+            sizes.add(self.align_input_size(self.mosaic_size))
+        for size in sorted(sizes):
+            image = np.full((size, size, 3), 114, dtype=np.uint8)
+            self.backend.predict([image], size=size, augment=self.augment)
+        self.reset_inference_times()
+        self.detections = None
+        self.batch_detections = []
+        self.warmup_time = time.time() - t0
+        return self.warmup_time
+
+    def set_num_threads(self, num_threads):
+        """
+        Sets the number of threads used for inference.
+        """
+        self.backend.set_num_threads(num_threads)
+
+    @property
+    def stride(self):
+        return self.backend.stride
+
+    @property
+    def fixed_input_shape(self):
+        """
+        (height, width) of an ONNX model with a fixed input shape, else None
+        """
+        return getattr(self.backend, "input_shape", None)
+
+    def align_input_size(self, size):
+        """
+        Rounds size up to a multiple of the model stride, the size the
+        model actually runs at.
+        """
+        return math.ceil(size / self.stride) * self.stride
 
     def get_metadata(self):
         metadata = {}
-        metadata["confidence_threshold"] = self.model.conf
-        metadata["iou_threshold"] = self.model.iou
+        metadata["backend"] = self.backend.name
+        metadata["confidence_threshold"] = self.confidence_threshold
+        metadata["iou_threshold"] = self.iou_threshold
         metadata["margin"] = self.margin
-        metadata["multi_label"] = self.model.multi_label
+        metadata["multi_label"] = self.multi_label
         metadata["multi_label_iou_threshold"] = self.multi_label_iou_threshold
         metadata["model_name"] = self.model_name
-        metadata["max_det"] = self.model.max_det
+        metadata["max_det"] = self.max_det
         metadata["augment"] = self.augment
+        metadata["max_batch_size"] = self.max_batch_size
+        metadata["max_batch_padding"] = self.max_batch_padding
+        if self.startup_time is not None:
+            metadata["startup_time"] = self.startup_time
         total_inference_time, average_inference_time = self.get_inference_times()
         if total_inference_time is not None:
             metadata["inference_times"] = [
@@ -78,185 +363,163 @@ class YoloModel:
         )
 
     def predict(self, input, model_img_size=640):
+        """
+        Runs inference on a single image.
+        Returns a DetectionResult, which also becomes the current result for
+        the getters.
+        """
         t0 = time.time()
-        self.results = self.model.forward(input, augment=self.augment, size=model_img_size)
+        xyxy, image = self.backend.predict(
+            [input], size=model_img_size, augment=self.augment
+        )[0]
         self.total_inference_time += time.time() - t0
+        self._observe_timings()
         self.number_of_inferences += 1
-        return self.results
+        self.detections = self._to_detection_result(xyxy, image)
+        self.batch_detections = [self.detections]
+        return self.detections
+
+    def predict_batch(self, images, model_img_size=640):
+        """
+        Runs inference on a list of images, using one forward pass for up to
+        max_batch_size images.
+        model_img_size: the inference size, or a list with the inference size
+        of each image. Images of the same size are batched if their
+        letterboxed input shapes differ by at most max_batch_padding pixels
+        per side, see group_input_shapes(). With 0, a batch is not padded and
+        the results are the same as with one image at a time.
+        Returns a list with one DetectionResult per input image,
+        use select() to make an entry the current result for the getters.
+        """
+        if isinstance(model_img_size, int):
+            model_img_size = [model_img_size] * len(images)
+        self.batch_detections = [None] * len(images)
+        packed = set()
+        if self.mosaic and len(images) > 0:
+            packed = self._predict_mosaic(
+                images, self.mosaic_size or max(model_img_size)
+            )
+        buckets = {}
+        for index, size in enumerate(model_img_size):
+            if index not in packed:
+                buckets.setdefault(size, []).append(index)
+        for size, indexes in sorted(buckets.items()):
+            shapes = [
+                self.fixed_input_shape or letterbox_shape(images[i], size, self.stride)
+                for i in indexes
+            ]
+            for group in group_input_shapes(
+                shapes, self.max_batch_padding, self.max_batch_size
+            ):
+                batch_indexes = [indexes[i] for i in group]
+                batch = [images[i] for i in batch_indexes]
+                t0 = time.time()
+                results = self.backend.predict(batch, size=size, augment=self.augment)
+                self.total_inference_time += time.time() - t0
+                self._observe_timings()
+                self.number_of_inferences += len(batch)
+                for index, (xyxy, image) in zip(batch_indexes, results):
+                    self.batch_detections[index] = self._to_detection_result(
+                        xyxy, image
+                    )
+        self.packed = sorted(packed)
+        if len(self.batch_detections) > 0:
+            self.detections = self.batch_detections[0]
+        return self.batch_detections
+
+    def _predict_mosaic(self, images, size):
+        """
+        Runs inference on the small images packed into canvases of the
+        inference size, sets their results in batch_detections.
+        Returns the indexes of the packed images.
+        """
+        canvas_size = self.align_input_size(size)
+        if self.fixed_input_shape is not None:
+            canvas_size = min(self.fixed_input_shape)
+        max_crop_size = self.mosaic_max_crop_size or canvas_size // 2
+        arrays = {}
+        for index, image in enumerate(images):
+            array = to_rgb_array(image)
+            if max(array.shape[:2]) <= min(max_crop_size, canvas_size):
+                arrays[index] = array
+        if len(arrays) == 0:
+            return set()
+        indexes = list(arrays)
+        canvases = [
+            [(indexes[i], x, y) for i, x, y in items]
+            for items in pack_rectangles(
+                [arrays[i].shape[1::-1] for i in indexes], canvas_size, self.mosaic_gap
+            )
+        ]
+        for start in range(0, len(canvases), self.max_batch_size):
+            batch_items = canvases[start : start + self.max_batch_size]
+            batch = [build_canvas(arrays, items, canvas_size) for items in batch_items]
+            # max_det applies per crop, not per canvas
+            max_crops = max(len(items) for items in batch_items)
+            t0 = time.time()
+            results = self.backend.predict(
+                batch,
+                size=canvas_size,
+                augment=self.augment,
+                max_det=self.max_det * max_crops,
+            )
+            self.total_inference_time += time.time() - t0
+            self._observe_timings()
+            for items, (xyxy, _) in zip(batch_items, results):
+                self.number_of_inferences += len(items)
+                crop_detections = split_detections(xyxy, arrays, items, self.max_det)
+                for index, detections in crop_detections.items():
+                    self.batch_detections[index] = self._to_detection_result(
+                        detections, arrays[index]
+                    )
+        return set(indexes)
+
+    def _observe_timings(self):
+        for stage, seconds in self.backend.timings.items():
+            STAGE_SECONDS.labels(stage).observe(seconds)
+
+    def select(self, index):
+        """
+        Selects the result of the image at position index of the last
+        predict_batch() call.
+        """
+        self.detections = self.batch_detections[index]
+        return self.detections
+
+    def empty_result(self, image):
+        """
+        Returns a DetectionResult without detections for image, for images
+        that were not run through the model.
+        """
+        return self._to_detection_result(np.zeros((0, 6)), np.asarray(image))
+
+    def _to_detection_result(self, xyxy, image):
+        class_names = self.class_names
+        if class_names is None:
+            class_names = self.backend.names
+        groups = self._get_groups(xyxy[:, :4])
+        return DetectionResult(xyxy, groups, image, class_names, self.margin)
 
     def get_classes(self):
-        res = self.results
-        classes = res.pandas().xyxy[0]["class"].tolist()
-        return classes
+        return self.detections.classes.tolist()
 
     def get_names(self):
-        if self.class_names is None:
-            res = self.results
-            names = res.pandas().xyxy[0]["name"].tolist()
-            return names
-        else:
-            classes = self.get_classes()
-            names = []
-            for i in range(len(classes)):
-                names.append(self.class_names[classes[i]])
-            return names
+        return self.detections.names
 
     def get_scores(self):
-        res = self.results
-        scores = res.pandas().xyxy[0]["confidence"].tolist()
-        return scores
+        return self.detections.scores.tolist()
 
     def get_boxes(self):
-        res = self.results
-        boxes = []
-        for i in range(len(res.pandas().xyxy[0])):
-            box = []
-            box.append(res.pandas().xyxy[0].get("xmin")[i])
-            box.append(res.pandas().xyxy[0].get("ymin")[i])
-            box.append(res.pandas().xyxy[0].get("xmax")[i])
-            box.append(res.pandas().xyxy[0].get("ymax")[i])
-            boxes.append(box)
-
-        return boxes
+        return self.detections.boxes.tolist()
 
     def get_indexes(self):
-        boxes = self.get_boxes()
-        if self.model.multi_label:
-            overlapping = []
-            for bb1 in range(len(boxes)):
-                overlapping_bb1 = []
-                for bb2 in range(bb1 + 1, len(boxes)):
-                    # for bb2 in range( len(boxes)):
-                    iou = self._compute_iou(boxes[bb1], boxes[bb2])
-                    if iou > self.multi_label_iou_threshold:
-                        overlapping_bb1.append(bb2)
-                overlapping.append(overlapping_bb1)
-            return self._get_overlapping_objects(overlapping)
-        else:
-            return [i for i in range(len(boxes))]
+        return self.detections.groups.tolist()
 
     def get_crops(self):
-        res = self.results
-        crops = []
-        for i in range(len(res.imgs)):
-            img_array = res.imgs[i]
-            image_width = img_array.shape[1]
-            image_height = img_array.shape[0]
-
-            for coordlist in res.xyxy[i].tolist():
-                x_start = int(coordlist[0])
-                if x_start - self.margin < 0:
-                    x_start = 0
-                else:
-                    x_start = x_start - self.margin
-                y_start = int(coordlist[1])
-                if y_start - self.margin < 0:
-                    y_start = 0
-                else:
-                    y_start = y_start - self.margin
-                x_end = int(coordlist[2])
-                if x_end + self.margin > image_width:
-                    x_end = image_width
-                else:
-                    x_end = x_end + self.margin
-                y_end = int(coordlist[3])
-                if y_end + self.margin > image_height:
-                    y_end = image_height
-                else:
-                    y_end = y_end + self.margin
-                crop = img_array[y_start:y_end, x_start:x_end]
-                crops.append(crop)
-        return crops
-
-    # https://stackoverflow.com/a/42874377
-    def _compute_iou(self, bb1, bb2):
-        """
-        Calculate the Intersection over Union (IoU) of two bounding boxes.
-
-        Parameters
-        ----------
-        bb1 : list
-            box format: [xmin, ymin, xmax, ymax]
+        return self.detections.crops()
 
-        bb2 : list
-            box format: [xmin, ymin, xmax, ymax]
-
-        Returns
-        -------
-        float
-            in [0, 1]
-
-        """
-
-        assert bb1[0] < bb1[2]
-        assert bb1[1] < bb1[3]
-        assert bb2[0] < bb2[2]
-        assert bb2[1] < bb2[3]
-
-        # determine the coordinates of the intersection rectangle
-        x_left = max(bb1[0], bb2[0])
-        y_top = max(bb1[1], bb2[1])
-        x_right = min(bb1[2], bb2[2])
-        y_bottom = min(bb1[3], bb2[3])
-
-        if x_right < x_left or y_bottom < y_top:
-            return 0.0
-
-        # The intersection of two axis-aligned bounding boxes is always an
-        # axis-aligned bounding box
-        intersection_area = (x_right - x_left) * (y_bottom - y_top)
-
-        # compute the area of both AABBs
-        bb1_area = (bb1[2] - bb1[0]) * (bb1[3] - bb1[1])
-        bb2_area = (bb2[2] - bb2[0]) * (bb2[3] - bb2[1])
-
-        # compute the intersection over union by taking the intersection
-        # area and dividing it by the sum of prediction + ground-truth
-        # areas - the interesection area
-        iou = intersection_area / float(bb1_area + bb2_area - intersection_area)
-        assert iou >= 0.0
-        assert iou <= 1.0
-        return iou
-
-    def _get_overlapping_objects(self, overlapping):
-        """
-        Get the overlapping objects from a list of overlapping objects.
-        """
-        indexes = []
-        known_ids = []
-        new_indexes = [0 for i in range(len(overlapping))]
-        for i in range(len(overlapping)):
-            if i not in known_ids:
-                idx = self._get_related_elements(overlapping, i, [i])
-                known_ids += idx
-                indexes.append(idx)
-
-        for i in range(len(indexes)):
-            for j in range(len(indexes[i])):
-                new_indexes[indexes[i][j]] = i
-
-        return new_indexes
-
-    def _get_related_elements(self, list, index, known_elements=[]):
-        elements = known_elements
-        # if not index in elements:
-        #    elements.append(index)
-
-        for item in list[index]:
-            if item not in elements:
-                elements.append(item)
-                # print("append ",item,"to",elements)
-                additional_elements = self._get_related_elements(list, item, elements)
-                for element in additional_elements:
-                    if element not in elements:
-                        elements.append(element)
-                        # print("append ",element,"to",elements)
-
-        for i in range(len(list)):
-            for item in list[i]:
-                if item in elements:
-                    if i not in elements:
-                        # print("append ",i,"to",elements)
-                        elements.append(i)
-
-        return sorted(elements)
+    def _get_groups(self, boxes):
+        if self.multi_label:
+            return group_overlapping_boxes(boxes, self.multi_label_iou_threshold)
+        else:
+            return np.arange(len(boxes))
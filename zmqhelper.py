@@ -0,0 +1,214 @@
+import collections
+import json
+import logging
+import queue
+import random
+import re
+import sys
+import threading
+import time
+
+import zmq
+
+from formathelper import loads_json
+from metricshelper import QUEUE_WAIT
+
+log = logging.getLogger(__name__)
+log.propagate = False
+log.setLevel(logging.INFO)
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(
+    logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+)
+log.addHandler(handler)
+
+# request codes
+GET_FIRST = 0  # get first message
+POP_FIRST = 1  # get first message and remove it from queue
+REMOVE_FIRST = 2  # remove first message from queue
+# response codes
+NO_DATA = 0  # no data available
+REMOVED = 1  # first message removed from queue
+RECORD_START = re.compile(rb"\s*\{")
+
+
+class ZMQInputClient:
+    """
+    Requests records from a ZMQMessageQueue server in a background thread and
+    keeps up to `prefetch` records in a local buffer.
+
+    A record is read with GET_FIRST and removed with REMOVE_FIRST once it
+    was received, so a reply lost to a timeout does not lose a record. The
+    removal and the request for the next record are sent together, the
+    server answers them in order, so a record costs one round trip. While
+    the buffer is full, the next request waits for room. When the queue is
+    empty, requests are delayed with exponential backoff and jitter. If the
+    server does not answer within request_timeout, the socket (a DEALER, so
+    that unanswered requests can be abandoned) is recreated and the request
+    is sent again. A record whose removal was not confirmed is recognized
+    when it is received again and only removed.
+
+    REMOVE_FIRST removes whatever record is first in the queue, so this
+    client must be the only consumer of the queue and producers must only
+    append to it. A second consumer, or a producer inserting at the front,
+    makes it remove records that were not read.
+
+    Records in the local buffer are already removed from the server queue,
+    so up to `prefetch` records are lost if the process is killed.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        prefetch=2,
+        request_timeout=3000,
+        backoff_min=0.1,
+        backoff_max=5.0,
+        decode_records=True,
+    ):
+        """
+        request_timeout: in milliseconds
+        backoff_min, backoff_max: in seconds
+        decode_records: return the records as dicts, otherwise as a
+        memoryview of the received JSON (for MessageParser streaming)
+        """
+        self.address = "tcp://{}:{}".format(host, port)
+        self.prefetch = max(1, prefetch)
+        self.request_timeout = request_timeout
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.decode_records = decode_records
+        self.buffer = queue.Queue(maxsize=self.prefetch)
+        self.context = None
+        self.socket = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        log.info("Connecting to ZMQ server on {}".format(self.address))
+        # the context starts its I/O thread, not before start()
+        self.context = zmq.Context.instance()
+        self.thread = threading.Thread(target=self._run, name="zmq-input", daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def get(self, timeout=None):
+        """
+        Returns the next record, blocks until one is available.
+        Returns None if timeout (in seconds) expires first.
+        """
+        try:
+            received, reply = self.buffer.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        QUEUE_WAIT.labels("input").observe(time.monotonic() - received)
+        return reply
+
+    def _connect(self):
+        if self.socket is not None:
+            self.socket.setsockopt(zmq.LINGER, 0)
+            self.socket.close()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.connect(self.address)
+
+    def _send_request(self, code):
+        # a REP server expects the empty delimiter frame in front of the request
+        self.socket.send_multipart([b"", json.dumps(code).encode("utf-8")])
+
+    def _increase_backoff(self, backoff):
+        return min(max(backoff * 2, self.backoff_min), self.backoff_max)
+
+    def _jitter(self, backoff):
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def _run(self):
+        self._connect()
+        # the requests awaiting their reply, answered in this order
+        outstanding = collections.deque()
+        # the frame of the last record until its removal is confirmed
+        received = None
+        # the frame of a record whose removal was not confirmed, the server
+        # may still have it first in the queue
+        unconfirmed = None
+        backoff = 0
+        next_request = 0
+        last_activity = time.monotonic()
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            if (
+                GET_FIRST not in outstanding
+                and now >= next_request
+                and self.buffer.qsize() < self.prefetch
+            ):
+                # after a pending removal, the server answers that first
+                if len(outstanding) == 0:
+                    last_activity = now
+                self._send_request(GET_FIRST)
+                outstanding.append(GET_FIRST)
+
+            if len(outstanding) > 0:
+                poll_timeout = self.request_timeout - (now - last_activity) * 1000
+            else:
+                poll_timeout = min(max(next_request - now, 0.01), 0.1) * 1000
+            if (self.socket.poll(max(poll_timeout, 0)) & zmq.POLLIN) != 0:
+                frame = self.socket.recv_multipart(copy=False)[-1]
+                last_activity = time.monotonic()
+                if outstanding.popleft() == REMOVE_FIRST:
+                    # REMOVED, or NO_DATA if the queue was emptied meanwhile
+                    received = None
+                    continue
+                # parsed from the frame's buffer, without copying it
+                reply = frame.buffer
+                if self.decode_records or RECORD_START.match(reply) is None:
+                    reply = loads_json(reply)
+                if type(reply) in (dict, memoryview):
+                    backoff = 0
+                    if unconfirmed is not None and unconfirmed.buffer == frame.buffer:
+                        log.info("Removing the record received before reconnecting")
+                    else:
+                        self.buffer.put((last_activity, reply))
+                    unconfirmed = None
+                    # removed only now that it was received, a lost reply
+                    # leaves it in the server queue
+                    self._send_request(REMOVE_FIRST)
+                    outstanding.append(REMOVE_FIRST)
+                    received = frame
+                    if self.buffer.qsize() < self.prefetch:
+                        self._send_request(GET_FIRST)
+                        outstanding.append(GET_FIRST)
+                elif reply == NO_DATA:
+                    unconfirmed = None
+                    backoff = self._increase_backoff(backoff)
+                    next_request = last_activity + self._jitter(backoff)
+                    log.info(
+                        "No data available, next request in {:.2f}s".format(
+                            next_request - last_activity
+                        )
+                    )
+            elif (
+                len(outstanding) > 0
+                and (time.monotonic() - last_activity) * 1000 >= self.request_timeout
+            ):
+                if REMOVE_FIRST in outstanding:
+                    log.warning(
+                        "No response to the removal of the last record, "
+                        "reconnecting, it is skipped if received again"
+                    )
+                    unconfirmed = received
+                else:
+                    log.warning(
+                        "No response from server, reconnecting, no record was lost"
+                    )
+                received = None
+                outstanding.clear()
+                self._connect()
+                backoff = self._increase_backoff(backoff)
+                next_request = time.monotonic() + self._jitter(backoff)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.close()